@@ -14,12 +14,37 @@ Commands which are implemented:
     dd          - dump hex data at certain address(compatibility with .gdbinit)
                   this shoud be db command
     ctx/context - dump registers and assembly
+                  (ctx all-threads dumps registers of every thread,
+                   ctx off/on/every N throttles rendering on stops,
+                   ctx --json / ctx json-stream on for JSON output,
+                   ctx theme nocolor (or NO_COLOR set) for plain text)
     lb          - load breakpoints from file and apply(only func names)
     u           - dump instructions at certain address(SoftICE u command style)
+    uf          - disassemble a whole function page by page
     ddword      - dump data as dword
     dq          - dump data as qword
     dw          - dump data as word
+                  (dd/dq/ddword/dw/u accept --json for structured output)
     iphone      - connect to debugserver running on iPhone
+    remote      - fewer round trips per stop on remote connections
+    reghist     - show the values of a register at the last stops
+    regdiff     - show registers changed since an earlier stop
+    bpsilent    - stop at breakpoints without rendering the context
+    calltrace   - count calls of functions matching a module or regex
+    cov         - basic block coverage of a module (drcov output)
+    msgtrace    - trace objc_msgSend without the expression evaluator
+    ctxlog      - append every context to a log file
+    ctxsave     - save the current stop to a file
+    replay      - inspect a stop saved by ctxsave without a process
+    gadgets     - list ROP/JOP gadgets of a module
+    strings     - printable strings of a memory range or module
+    watchmem    - memory shown in every context with changes highlighted
+    runto       - continue to an address, optionally if a condition holds
+    stepuntil   - run until a register or memory condition holds
+    icount      - count and profile the instructions between two addresses
+    wlog        - log memory accesses with a hardware watchpoint
+    dt          - display memory as a structure
+    bt2         - compact backtrace, with a frame pointer fallback
 
 '''
 
@@ -33,62 +58,100 @@ except:
 
 import thread
 import time
+import os
+import gzip
+import shutil
 import struct
+import array
+import bisect
+import csv
+import re
+import json
+import binascii
+import mmap
+import tempfile
+import socket
+import operator
+import threading
+from collections import OrderedDict, namedtuple, deque
 
-old_eax = 0
-old_ecx = 0
-old_edx = 0
-old_ebx = 0
-old_esp = 0
-old_ebp = 0
-old_esi = 0
-old_edi = 0
-old_eip = 0
-old_eflags = 0
-old_cs = 0
-old_ds = 0
-old_fs = 0
-old_gs = 0
-old_ss = 0
-old_es = 0
-
-old_rax = 0
-old_rcx = 0
-old_rdx = 0
-old_rbx = 0
-old_rsp = 0
-old_rbp = 0
-old_rsi = 0
-old_rdi = 0
-old_r8 = 0
-old_r9 = 0
-old_r10 = 0
-old_r11 = 0
-old_r12 = 0
-old_r13 = 0
-old_r14 = 0
-old_r15 = 0
-old_rflags = 0
-old_rip = 0
-
-old_arm_r0 = 0
-old_arm_r1 = 0
-old_arm_r2 = 0
-old_arm_r3 = 0
-old_arm_r4 = 0
-old_arm_r5 = 0
-old_arm_r6 = 0
-old_arm_r7 = 0
-old_arm_r8 = 0
-old_arm_r9 = 0
-old_arm_r10 = 0
-old_arm_r11 = 0
-old_arm_r12 = 0
-old_arm_sp = 0
-old_arm_lr = 0
-old_arm_pc = 0
-old_arm_cpsr = 0
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+'''
+    Register layouts used by the [regs] view. Each entry is a
+    (register, label, format) tuple or a newline string. A format of
+    None marks the flags register which is decoded bit by bit instead of
+    being printed as a value. The position of a register in the layout is
+    its index in the per-thread array of previous values.
+'''
+FMT_REG32 = "0x%.08X"
+FMT_REG64 = "0x%.016lX"
+FMT_SEGMENT = "%.04X"
+
+REGS_X86_LAYOUT = (
+    ("eax", "  EAX: ", FMT_REG32), ("ebx", "  EBX: ", FMT_REG32),
+    ("ecx", "  ECX: ", FMT_REG32), ("edx", "  EDX: ", FMT_REG32),
+    ("eflags", "  ", None), "\n",
+    ("esi", "  ESI: ", FMT_REG32), ("edi", "  EDI: ", FMT_REG32),
+    ("ebp", "  EBP: ", FMT_REG32), ("esp", "  ESP: ", FMT_REG32),
+    ("eip", "  EIP: ", FMT_REG32), "\n",
+    ("cs", "  CS:  ", FMT_SEGMENT), ("ds", "  DS: ", FMT_SEGMENT),
+    ("es", "  ES: ", FMT_SEGMENT), ("fs", "  FS: ", FMT_SEGMENT),
+    ("gs", "  GS: ", FMT_SEGMENT), ("ss", "  SS: ", FMT_SEGMENT), "\n",
+)
+
+REGS_X64_LAYOUT = (
+    ("rax", "  RAX: ", FMT_REG64), ("rbx", "  RBX: ", FMT_REG64),
+    ("rbp", "  RBP: ", FMT_REG64), ("rsp", "  RSP: ", FMT_REG64),
+    ("rflags", "  ", None), "\n",
+    ("rdi", "  RDI: ", FMT_REG64), ("rsi", "  RSI: ", FMT_REG64),
+    ("rdx", "  RDX: ", FMT_REG64), ("rcx", "  RCX: ", FMT_REG64),
+    ("rip", "  RIP: ", FMT_REG64), "\n",
+    ("r8", "  R8:  ", FMT_REG64), ("r9", "  R9:  ", FMT_REG64),
+    ("r10", "  R10: ", FMT_REG64), ("r11", "  R11: ", FMT_REG64),
+    ("r12", "  R12: ", FMT_REG64), "\n",
+    ("r13", "  R13: ", FMT_REG64), ("r14", "  R14: ", FMT_REG64),
+    ("r15", "  R15: ", FMT_REG64), "\n",
+    ("cs", "  CS:  ", FMT_SEGMENT), ("fs", "  FS: ", FMT_SEGMENT),
+    ("gs", "  GS: ", FMT_SEGMENT), "\n",
+)
+
+REGS_ARM_LAYOUT = (
+    ("r0", "  R0:  ", FMT_REG32), ("r1", "  R1:  ", FMT_REG32),
+    ("r2", "  R2:  ", FMT_REG32), ("r3", "  R3:  ", FMT_REG32),
+    ("cpsr", " ", None), "\n",
+    ("r4", "  R4:  ", FMT_REG32), ("r5", "  R5:  ", FMT_REG32),
+    ("r6", "  R6:  ", FMT_REG32), ("r7", "  R7:  ", FMT_REG32), "\n",
+    ("r8", "  R8:  ", FMT_REG32), ("r9", "  R9:  ", FMT_REG32),
+    ("r10", "  R10: ", FMT_REG32), ("r11", "  R11: ", FMT_REG32), "\n",
+    ("r12", "  R12: ", FMT_REG32), ("sp", "  SP:  ", FMT_REG32),
+    ("lr", "  LR:  ", FMT_REG32), ("pc", "  PC:  ", FMT_REG32), "\n",
+)
+
+
+def layout_registers(layout):
+    return tuple(x[0] for x in layout if x != "\n")
+
+REGS_X86 = layout_registers(REGS_X86_LAYOUT)
+REGS_X64 = layout_registers(REGS_X64_LAYOUT)
+REGS_ARM = layout_registers(REGS_ARM_LAYOUT)
 
+try:
+    array.array("Q")
+    REG_ARRAY_TYPE = "Q"
+except ValueError:
+    REG_ARRAY_TYPE = "L"
+
+# previous register values per (pid, tid), least recently used first
+RegStates = OrderedDict()
+REG_STATES_MAX = 64
+
+# register snapshots of the last stops, see RegHistory
+RegHistoryRing = None
+REG_HISTORY_SIZE = 4096
 BLACK = 0
 RED = 1
 GREEN = 2
@@ -104,32 +167,168 @@ COLOR_REGVAL_MODIFIED = RED
 COLOR_SEPARATOR = BLUE
 COLOR_CPUFLAGS = RED
 COLOR_HIGHLIGHT_LINE = CYAN
-
-arm_type = "thumbv7-apple-ios"
-
-GlobalListOutput = []
+COLOR_BRANCH = YELLOW
 
 hook_stop_added = 0
 
+# context rendering from the stop hook, see ctx on/off/every and bpsilent
+CtxEnabled = True
+CtxEvery = 1
+SilentBreakpoints = set()
+SilentBreakpointNames = set()
+HookStats = {"stops": 0, "silent": 0, "throttled": 0, "renders": 0,
+             "check_time": 0.0, "render_time": 0.0, "contexts": 0,
+             "lookups": 0, "reads": 0}
+
+# StopContext of the current stop, see get_stop
+CurrentStop = None
+
+# guards the state shared by the stop hook, ctx, breakpoint and watchpoint
+# callbacks (run on lldb's threads) and the commands reading what they
+# write. The state is per script instance, shared by all debuggers.
+StateLock = threading.RLock()
+
+# stop hook prints one JSON line per stop instead of the context
+CtxJsonStream = False
+
+# ContextLog written by ctxlog
+ContextLogger = None
+CTXLOG_QUEUE_SIZE = 1024
+CTXLOG_KEEP = 5
+
+# SymbolIndex per module UUID
+SymbolIndexes = {}
+
+# ModuleMap of the selected target, see get_module_map
+CurrentModuleMap = None
+
+# state of calltrace, see calltrace_start
+CallTrace = None
+
+# state of cov, see cov_start
+Coverage = None
+COV_BATCH = 2000
+COV_MAX_FUNCTION = 0x100000
+
+# state of msgtrace, see msgtrace_start
+MsgTrace = None
+MSGTRACE_CACHE_SIZE = 8192
+MSGTRACE_LOG_SIZE = 100000
+MSGTRACE_FLUSH = 4096
+
+# ContextSnapshot loaded by replay
+Replay = None
+# snapshot shown by the running command, see with_replay
+ReplayScope = threading.local()
+CTXSAVE_MAGIC = b"LLCTX1\0\0"
+CTXSAVE_WINDOW = 0x1000
+CTXSAVE_INSNS = 32
+
+# paging state of uf, see uf
+UfCursor = None
+UF_PAGE = 64
+
+# on-disk caches, see get_cache_path
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".lldbinit")
+
+# disassembly targets per triple, see get_triple_target
+TripleTargets = {}
+
+# gadgets per module UUID, see get_gadgets
+GadgetCache = {}
+GADGET_MAX_INSNS = 5
+GADGET_MAX_BYTES = 20
+GADGETS_SHOW = 500
+
+# connection of iphone, see IphoneConnect
+IphoneURL = None
+IPHONE_TIMEOUT = 5
+IPHONE_RETRIES = 4
+IPHONE_BACKOFF = 0.5
+IPHONE_PINGS = 5
+
+# RemoteSession of remote mode, see remote_enable
+RemoteMode = None
+REMOTE_WINDOW = 0x400
+# the packet timeout is left to iphone --timeout
+REMOTE_SETTINGS = (
+    "settings set plugin.process.gdb-remote.use-g-packet-for-reading true",
+)
+
+# read-only module strings per UUID and options, see strings_module
+StringsCache = {}
+STRINGS_CHUNK = 0x400000
+STRINGS_MINLEN = 4
+STRINGS_SHOW = 1000
+STRINGS_PRINTABLE = bytes(bytearray(range(0x20, 0x7f))) + b"\t"
+
+# ranges of the [data] view, see watchmem
+WatchedMemory = []
+WatchmemCollapse = False
+WATCHMEM_LENGTH = 0x40
+WATCHMEM_GAP = 0x100
+
+# breakpoint/watchpoint of runto and stepuntil, removed on the next stop
+RuntoPending = False
+RuntoWatchpoint = None
+# depth of suppress_hook, the stop hook renders nothing while > 0
+HookSuppressed = 0
+STEPUNTIL_MAX = 1000000
+CONDITION_TERM = re.compile(r"^\s*(\[[^\]]+\]|\$?\w+)\s*(==|!=|<=|>=|<|>)\s*(\w+)\s*$")
+SYMBOL_NAME = re.compile(r"^[A-Za-z_][\w.$:]*$")
+CONDITION_OPERAND = re.compile(r"^\$?(\w+)\s*(?:([+-])\s*(\w+))?$")
+CONDITION_OPERATORS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt,
+                       "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+# defaults of icount
+ICOUNT_BUDGET = 1000000
+ICOUNT_TOP = 20
+
+# accesses logged by wlog watchpoints and their last known contents
+WLOG_SIZE = 10000
+WatchLog = deque(maxlen=WLOG_SIZE)
+WatchLogRanges = {}
+
+# structure layouts of dt, from DT_FILE and from debug info
+DT_FILE = os.path.join(CACHE_DIR, "layouts")
+DT_TYPES = {"u8": "B", "u16": "H", "u32": "I", "u64": "Q",
+            "i8": "b", "i16": "h", "i32": "i", "i64": "q",
+            "ptr": "Q", "float": "f", "double": "d"}
+DtLayouts = {"stamp": None, "file": {}, "types": {}}
+
+# unwinding of bt2, see get_backtrace
+BT2_MAX = 100000
+BT2_CHUNK = 0x4000
+BT2_FLUSH = 256
+BT2_FP_REGS = ("rbp", "ebp", "fp", "x29", "r7")
+
+# ArchInfo per triple, see get_arch_info
+ArchInfos = {}
+
+# one disassembled instruction, see read_instructions
+InsnRecord = namedtuple("InsnRecord",
+                        "addr size mnemonic operands comment branch")
+
 # For debug
 Isdprint = False
 
 
 def dprint(msg):
     global Isdprint
-    global GlobalListOutput
     if Isdprint is True:
-        GlobalListOutput.append(msg)
+        print(msg)
 
 
 def wait_for_hook_stop():
     while True:
         dprint("Waiting...")
-        res = lldb.SBCommandReturnObject()
-        handleCmd = lldb.debugger.GetCommandInterpreter().HandleCommand
-        handleCmd("target stop-hook add -o \"handleHookStop\"", res)
-        if res.Succeeded() is True:
-            return
+        # only use the interpreter from this thread once there's a target
+        if lldb.debugger.GetNumTargets() > 0:
+            res = lldb.SBCommandReturnObject()
+            handleCmd = lldb.debugger.GetCommandInterpreter().HandleCommand
+            handleCmd("target stop-hook add -o \"handleHookStop\"", res)
+            if res.Succeeded() is True:
+                return
         time.sleep(0.05)
 
 
@@ -160,7 +359,7 @@ def __lldb_init_module(debugger, internal_dict):
     handleCmd = dbg.GetCommandInterpreter().HandleCommand
     handleCmd("settings set target.x86-disassembly-flavor intel", res)
     handleCmd("command script add -f lldbinit.stepo stepo", res)
-    handleCmd("command script add -f lldbinit.handleHookStop handleHookStop", res)
+    handleCmd("command script add -f lldbinit.HookStop handleHookStop", res)
     handleCmd("command script add -f lldbinit.dd dd", res)
     handleCmd("command script add -f lldbinit.si si", res)
     handleCmd("command script add -f lldbinit.c c", res)
@@ -174,6 +373,26 @@ def __lldb_init_module(debugger, internal_dict):
     handleCmd("command script add -f lldbinit.ddword ddword", res)
     handleCmd("command script add -f lldbinit.dw dw", res)
     handleCmd("command script add -f lldbinit.IphoneConnect iphone", res)
+    handleCmd("command script add -f lldbinit.reghist reghist", res)
+    handleCmd("command script add -f lldbinit.regdiff regdiff", res)
+    handleCmd("command script add -f lldbinit.bpsilent bpsilent", res)
+    handleCmd("command script add -f lldbinit.calltrace calltrace", res)
+    handleCmd("command script add -f lldbinit.cov cov", res)
+    handleCmd("command script add -f lldbinit.msgtrace msgtrace", res)
+    handleCmd("command script add -f lldbinit.ctxlog ctxlog", res)
+    handleCmd("command script add -f lldbinit.ctxsave ctxsave", res)
+    handleCmd("command script add -f lldbinit.replay replay", res)
+    handleCmd("command script add -f lldbinit.uf uf", res)
+    handleCmd("command script add -f lldbinit.gadgets gadgets", res)
+    handleCmd("command script add -f lldbinit.remote remote", res)
+    handleCmd("command script add -f lldbinit.strings strings", res)
+    handleCmd("command script add -f lldbinit.watchmem watchmem", res)
+    handleCmd("command script add -f lldbinit.runto runto", res)
+    handleCmd("command script add -f lldbinit.stepuntil stepuntil", res)
+    handleCmd("command script add -f lldbinit.icount icount", res)
+    handleCmd("command script add -f lldbinit.wlog wlog", res)
+    handleCmd("command script add -f lldbinit.dt dt", res)
+    handleCmd("command script add -f lldbinit.bt2 bt2", res)
 
     '''
         target stop-hook can be added only when target is loaded, thus I create
@@ -188,13 +407,160 @@ def __lldb_init_module(debugger, internal_dict):
     return
 
 
+def get_replay():
+    '''
+        Returns the snapshot the running command shows or None when it
+        shows the process. Only ctx (not the stop hook), u, dd, dq, ddword
+        and dw show a loaded replay, everything else stays on the process.
+    '''
+    return getattr(ReplayScope, "snapshot", None)
+
+
+def with_replay(function):
+    '''
+        Decorates a command which shows the loaded replay instead of the
+        process.
+    '''
+    def command(debugger, command, result, dict):
+        previous = get_replay()
+        ReplayScope.snapshot = Replay
+        try:
+            return function(debugger, command, result, dict)
+        finally:
+            ReplayScope.snapshot = previous
+    command.__name__ = function.__name__
+    command.__doc__ = function.__doc__
+    return command
+
+
+def get_triple():
+    replay = get_replay()
+    if replay is not None:
+        return replay.triple
+    return lldb.debugger.GetSelectedTarget().triple
+
+
 def get_arch():
-    return lldb.debugger.GetSelectedTarget().triple.split('-')[0]
+    return get_triple().split('-')[0]
 
 
-def get_frame():
+class StopContext(object):
+    '''
+        Target, process, thread, frame and what is derived from them for
+        one stop. Each part is resolved on first access and shared by all
+        commands until the process resumes or another thread or frame is
+        selected (up, down, frame select).
+    '''
+    def __init__(self, target, process, thread, frame, key):
+        self.target = target
+        self.process = process
+        self.thread = thread
+        self.frame = frame
+        self.key = key
+        self._regs = None
+        self._stop_reason = None
+        self._symbol_context = None
+        self.backtraces = {}
+        self.symbols = {}
+        self.memory = {}
+        self.insns = {}
+        HookStats["contexts"] += 1
+
+    @property
+    def regs(self):
+        if self._regs is None:
+            self._regs = get_register_snapshot(self.frame)
+        return self._regs
+
+    def read_registers(self):
+        '''
+            Refreshes the register snapshot, registers can be written
+            without the process resuming.
+        '''
+        self._regs = get_register_snapshot(self.frame)
+        return self._regs
+
+    @property
+    def stop_reason(self):
+        if self._stop_reason is None:
+            self._stop_reason = str(self.thread.GetStopDescription(100))
+        return self._stop_reason
+
+    @property
+    def symbol_context(self):
+        if self._symbol_context is None:
+            self._symbol_context = self.frame.GetSymbolContext(lldb.eSymbolContextEverything)
+        return self._symbol_context
+
+    def read_memory(self, addr, size):
+        '''
+            Returns size bytes at addr or None, read once per stop. A replay
+            shown by the command (see get_replay) and remote mode are
+            served from their own memory.
+        '''
+        replay = get_replay()
+        if replay is not None:
+            return replay.read_memory(addr, size)
+        data = self.memory.get((addr, size))
+        if data is None and RemoteMode is not None:
+            data = RemoteMode.read_memory(addr, size)
+        if data is None:
+            err = lldb.SBError()
+            data = self.process.ReadMemory(addr, size, err)
+            HookStats["reads"] += 1
+            if err.Fail():
+                return None
+        self.memory[(addr, size)] = data
+        return data
+
+    def disassemble(self, addr, count):
+        '''
+            Returns up to count InsnRecords at addr, disassembled once per
+            stop.
+        '''
+        records = self.insns.get((addr, count))
+        if records is None:
+            records = read_instructions(self.target, addr, count)
+            self.insns[(addr, count)] = records
+        return records
+
+
+def get_stop():
+    '''
+        Returns the StopContext of the current stop, building a new one
+        when the stop ID, the selected thread or its selected frame changed.
+        Each call still walks target, process, thread and frame to build
+        the key, only what is derived from them is shared.
+    '''
+    global CurrentStop
+
     target = lldb.debugger.GetSelectedTarget()
-    return target.process.selected_thread.GetSelectedFrame()
+    process = target.GetProcess()
+    thread = process.GetSelectedThread()
+    frame = thread.GetSelectedFrame()
+    HookStats["lookups"] += 1
+    key = (process.GetProcessID(), process.GetStopID(), thread.GetThreadID(),
+           frame.GetFrameID())
+    with StateLock:
+        stop = CurrentStop
+        if stop is None or stop.key != key:
+            stop = StopContext(target, process, thread, frame, key)
+            CurrentStop = stop
+    return stop
+
+
+def get_frame():
+    return get_stop().frame
+
+
+def suppress_hook(on):
+    '''
+        Suppresses the stop hook while a command steps or continues on its
+        own. Calls nest, so the helpers doing it can call each other.
+    '''
+    global HookSuppressed
+    with StateLock:
+        HookSuppressed += on and 1 or -1
 
 
 def is_i386():
@@ -221,42 +587,69 @@ def is_arm():
     return False
 
 
-def color_reset():
-    output("\033[0m")
+def is_arm64():
+    arch = get_arch()
+    if arch in ("arm64", "arm64e", "aarch64"):
+        dprint("ARM64 platform")
+        return True
+    return False
+
 
+class Theme(object):
+    '''
+        Escape codes used by OutputBuffer, precomputed for every color so
+        that coloring is a table lookup. A theme of empty strings emits no
+        escape codes at all.
+    '''
+    def __init__(self, colors, bold, underline, reset):
+        self.colors = colors
+        self.bold = bold
+        self.underline = underline
+        self.reset = reset
+
+THEME_ANSI = Theme(["\033[%dm" % (30 + x) for x in range(8)],
+                   "\033[1m", "\033[4m", "\033[0m")
+THEME_NOCOLOR = Theme([""] * 8, "", "", "")
+Themes = {"default": THEME_ANSI, "nocolor": THEME_NOCOLOR}
+CurrentTheme = THEME_ANSI
+if os.environ.get("NO_COLOR"):
+    CurrentTheme = THEME_NOCOLOR
+
+
+class OutputBuffer(object):
+    '''
+        Render buffer of one command invocation. Fragments are collected
+        in a list and written out once with flush(), so nested commands
+        each have their own buffer.
+    '''
+    def __init__(self, theme=None):
+        self.theme = theme or CurrentTheme
+        self.parts = []
+        self.write = self.parts.append
+        if self.theme is THEME_NOCOLOR:
+            self.color = self.skip
+            self.bold = self.underline = self.reset = self.skip
 
-def color_bold():
-    output("\033[1m")
+    def skip(self, *args):
+        pass
 
+    def color(self, x):
+        self.parts.append(self.theme.colors[x])
 
-def color_underline():
-    output("\033[4m")
+    def bold(self):
+        self.parts.append(self.theme.bold)
 
+    def underline(self):
+        self.parts.append(self.theme.underline)
 
-def color(x):
-    out_col = ""
-    if x == BLACK:
-        out_col = "\033[30m"
-    elif x == RED:
-        out_col = "\033[31m"
-    elif x == GREEN:
-        out_col = "\033[32m"
-    elif x == YELLOW:
-        out_col = "\033[33m"
-    elif x == BLUE:
-        out_col = "\033[34m"
-    elif x == MAGENTA:
-        out_col = "\033[35m"
-    elif x == CYAN:
-        out_col = "\033[36m"
-    elif x == WHITE:
-        out_col = "\033[37m"
-    output(out_col)
+    def reset(self):
+        self.parts.append(self.theme.reset)
 
+    def getvalue(self):
+        return "".join(self.parts)
 
-def output(x):
-    global GlobalListOutput
-    GlobalListOutput.append(x)
+    def flush(self, result):
+        result.PutCString(self.getvalue())
 
 
 def get_register(reg_name):
@@ -280,732 +673,494 @@ def get_registers(kind):
     return None
 
 
-def dump_eflags(eflags):
-    if (eflags >> 0xB) & 1:
-        output("O ")
-    else:
-        output("o ")
+def get_register_snapshot(frame):
+    '''
+        Returns the general purpose registers of frame as a dict of
+        name -> int, fetched with a single pass over the register set.
+    '''
+    regs = {}
+    for kind in frame.GetRegisters():
+        if "general purpose" not in kind.GetName().lower():
+            continue
+        for reg in kind:
+            value = reg.GetValue()
+            if value is None:
+                continue
+            try:
+                regs[reg.GetName()] = int(value, 16)
+            except ValueError:
+                pass
+        break
+    return regs
+
+
+# (bit, letter) of the decoded flags, upper case when the bit is set
+EFLAGS_BITS = ((0xB, "O"), (0xA, "D"), (9, "I"), (8, "T"), (7, "S"), (6, "Z"),
+               (4, "A"), (2, "P"), (0, "C"))
+CPSR_BITS = ((31, "N"), (30, "Z"), (29, "C"), (28, "V"), (27, "Q"), (24, "J"),
+             (9, "E"), (8, "A"), (7, "I"), (6, "F"), (5, "T"))
 
-    if (eflags >> 0xA) & 1:
-        output("D ")
-    else:
-        output("d ")
 
-    if (eflags >> 9) & 1:
-        output("I ")
-    else:
-        output("i ")
+'''
+    Condition codes of conditional instructions. The conditions are
+    written over the flags they test and expanded at load time into one
+    mask per condition with a bit for every combination of those flags,
+    so evaluating a condition on a stop is a shift and an and.
+'''
+X86_COND_FLAGS = (0, 2, 6, 7, 0xB)      # C P Z S O
+X86_CONDITIONS = {
+    "o": lambda c, p, z, s, o: o,
+    "no": lambda c, p, z, s, o: not o,
+    "b": lambda c, p, z, s, o: c,
+    "ae": lambda c, p, z, s, o: not c,
+    "e": lambda c, p, z, s, o: z,
+    "ne": lambda c, p, z, s, o: not z,
+    "be": lambda c, p, z, s, o: c or z,
+    "a": lambda c, p, z, s, o: not c and not z,
+    "s": lambda c, p, z, s, o: s,
+    "ns": lambda c, p, z, s, o: not s,
+    "p": lambda c, p, z, s, o: p,
+    "np": lambda c, p, z, s, o: not p,
+    "l": lambda c, p, z, s, o: s != o,
+    "ge": lambda c, p, z, s, o: s == o,
+    "le": lambda c, p, z, s, o: z or s != o,
+    "g": lambda c, p, z, s, o: not z and s == o,
+}
+X86_COND_ALIASES = {"c": "b", "nae": "b", "nb": "ae", "nc": "ae", "z": "e",
+                    "nz": "ne", "na": "be", "nbe": "a", "pe": "p",
+                    "po": "np", "nge": "l", "nl": "ge", "ng": "le",
+                    "nle": "g"}
+
+ARM_COND_FLAGS = (31, 30, 29, 28)       # N Z C V
+ARM_CONDITIONS = {
+    "eq": lambda n, z, c, v: z,
+    "ne": lambda n, z, c, v: not z,
+    "hs": lambda n, z, c, v: c,
+    "lo": lambda n, z, c, v: not c,
+    "mi": lambda n, z, c, v: n,
+    "pl": lambda n, z, c, v: not n,
+    "vs": lambda n, z, c, v: v,
+    "vc": lambda n, z, c, v: not v,
+    "hi": lambda n, z, c, v: c and not z,
+    "ls": lambda n, z, c, v: not c or z,
+    "ge": lambda n, z, c, v: n == v,
+    "lt": lambda n, z, c, v: n != v,
+    "gt": lambda n, z, c, v: not z and n == v,
+    "le": lambda n, z, c, v: z or n != v,
+    "al": lambda n, z, c, v: True,
+}
+ARM_COND_ALIASES = {"cs": "hs", "cc": "lo"}
+
+# ARM instructions (without the s suffix) whose condition is shown
+ARM_COND_BASES = frozenset((
+    "b", "bl", "bx", "blx", "mov", "mvn", "add", "adc", "sub", "sbc", "rsb",
+    "rsc", "and", "orr", "eor", "bic", "cmp", "cmn", "tst", "teq", "mul",
+    "mla", "ldr", "ldrb", "ldrh", "ldrsb", "ldrsh", "ldrd", "str", "strb",
+    "strh", "strd", "ldm", "stm", "push", "pop", "lsl", "lsr", "asr", "ror"))
+ARM_BRANCHES = frozenset(("b", "bl", "bx", "blx", "cbz", "cbnz"))
+
+
+def condition_table(conditions, aliases, count):
+    table = {}
+    for name, cond in conditions.items():
+        mask = 0
+        for i in range(1 << count):
+            if cond(*[(i >> bit) & 1 for bit in range(count)]):
+                mask |= 1 << i
+        table[name] = mask
+    for alias, name in aliases.items():
+        table[alias] = table[name]
+    return table
+
+X86_COND_TABLE = condition_table(X86_CONDITIONS, X86_COND_ALIASES,
+                                 len(X86_COND_FLAGS))
+ARM_COND_TABLE = condition_table(ARM_CONDITIONS, ARM_COND_ALIASES,
+                                 len(ARM_COND_FLAGS))
+
+
+def condition_holds(table, cond, flags, value):
+    index = 0
+    for i, bit in enumerate(flags):
+        index |= ((value >> bit) & 1) << i
+    return (table[cond] >> index) & 1 == 1
 
-    if (eflags >> 8) & 1:
-        output("T ")
-    else:
-        output("t ")
 
-    if (eflags >> 7) & 1:
-        output("S ")
-    else:
-        output("s ")
+def dump_flags_bits(out, value, bits):
+    out.write(" ".join([(value >> bit) & 1 and x or x.lower() for bit, x in bits]))
 
-    if (eflags >> 6) & 1:
-        output("Z ")
-    else:
-        output("z ")
 
-    if (eflags >> 4) & 1:
-        output("A ")
-    else:
-        output("a ")
+def dump_eflags(out, eflags):
+    dump_flags_bits(out, eflags, EFLAGS_BITS)
 
-    if (eflags >> 2) & 1:
-        output("P ")
-    else:
-        output("p ")
 
-    if eflags & 1:
-        output("C")
-    else:
-        output("c")
-
-
-def reg64():
-    global old_cs
-    global old_ds
-    global old_fs
-    global old_gs
-    global old_ss
-    global old_es
-    global old_rax
-    global old_rcx
-    global old_rdx
-    global old_rbx
-    global old_rsp
-    global old_rbp
-    global old_rsi
-    global old_rdi
-    global old_r8
-    global old_r9
-    global old_r10
-    global old_r11
-    global old_r12
-    global old_r13
-    global old_r14
-    global old_r15
-    global old_rflags
-    global old_rip
-
-    rax = int(get_register("rax"), 16)
-    rcx = int(get_register("rcx"), 16)
-    rdx = int(get_register("rdx"), 16)
-    rbx = int(get_register("rbx"), 16)
-    rsp = int(get_register("rsp"), 16)
-    rbp = int(get_register("rbp"), 16)
-    rsi = int(get_register("rsi"), 16)
-    rdi = int(get_register("rdi"), 16)
-    r8 = int(get_register("r8"), 16)
-    r9 = int(get_register("r9"), 16)
-    r10 = int(get_register("r10"), 16)
-    r11 = int(get_register("r11"), 16)
-    r12 = int(get_register("r12"), 16)
-    r13 = int(get_register("r13"), 16)
-    r14 = int(get_register("r14"), 16)
-    r15 = int(get_register("r15"), 16)
-    rip = int(get_register("rip"), 16)
-    rflags = int(get_register("rflags"), 16)
-    cs = int(get_register("cs"), 16)
-    gs = int(get_register("gs"), 16)
-    fs = int(get_register("fs"), 16)
-
-    color(COLOR_REGNAME)
-    output("  RAX: ")
-    if rax == old_rax:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rax))
-    old_rax = rax
-
-    color(COLOR_REGNAME)
-    output("  RBX: ")
-    if rbx == old_rbx:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rbx))
-    old_rbx = rbx
-
-    color(COLOR_REGNAME)
-    output("  RBP: ")
-    if rbp == old_rbp:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rbp))
-    old_rbp = rbp
-
-    color(COLOR_REGNAME)
-    output("  RSP: ")
-    if rsp == old_rsp:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rsp))
-    old_rsp = rsp
-
-    output("  ")
-    color_bold()
-    color_underline()
-    color(COLOR_CPUFLAGS)
-    dump_eflags(rflags)
-    color_reset()
-
-    output("\n")
-
-    color(COLOR_REGNAME)
-    output("  RDI: ")
-    if rdi == old_rdi:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rdi))
-    old_rdi = rdi
-
-    color(COLOR_REGNAME)
-    output("  RSI: ")
-    if rsi == old_rsi:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rsi))
-    old_rsi = rsi
-
-    color(COLOR_REGNAME)
-    output("  RDX: ")
-    if rdx == old_rdx:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rsp))
-    old_rdx = rdx
-
-    color(COLOR_REGNAME)
-    output("  RCX: ")
-    if rcx == old_rcx:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rcx))
-    old_rcx = rcx
-
-    color(COLOR_REGNAME)
-    output("  RIP: ")
-    if rip == old_rip:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (rip))
-    old_rip = rip
-    output("\n")
-
-    color(COLOR_REGNAME)
-    output("  R8:  ")
-    if r8 == old_r8:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (r8))
-    old_r8 = r8
-
-    color(COLOR_REGNAME)
-    output("  R9:  ")
-    if r9 == old_r9:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (r9))
-    old_r9 = r9
-
-    color(COLOR_REGNAME)
-    output("  R10: ")
-    if r10 == old_r10:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (r10))
-    old_r10 = r10
-
-    color(COLOR_REGNAME)
-    output("  R11: ")
-    if r11 == old_r11:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (r11))
-    old_r11 = r11
-
-    color(COLOR_REGNAME)
-    output("  R12: ")
-    if r12 == old_r12:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (r12))
-    old_r12 = r12
+def dump_cpsr(out, cpsr):
+    dump_flags_bits(out, cpsr, CPSR_BITS)
 
-    output("\n")
 
-    color(COLOR_REGNAME)
-    output("  R13: ")
-    if r13 == old_r13:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (r13))
-    old_r13 = r13
-
-    color(COLOR_REGNAME)
-    output("  R14: ")
-    if r14 == old_r14:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (r14))
-    old_r14 = r14
-
-    color(COLOR_REGNAME)
-    output("  R15: ")
-    if r15 == old_r15:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.016lX" % (r15))
-    old_r15 = r15
-    output("\n")
-
-    color(COLOR_REGNAME)
-    output("  CS:  ")
-    if cs == old_cs:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (cs))
-    old_cs = cs
-
-    color(COLOR_REGNAME)
-    output("  FS: ")
-    if fs == old_fs:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (fs))
-    old_fs = fs
-
-    color(COLOR_REGNAME)
-    output("  GS: ")
-    if gs == old_gs:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (gs))
-    old_gs = gs
-    output("\n")
-
-
-def reg32():
-    global old_eax
-    global old_ecx
-    global old_edx
-    global old_ebx
-    global old_esp
-    global old_ebp
-    global old_esi
-    global old_edi
-    global old_eflags
-    global old_cs
-    global old_ds
-    global old_fs
-    global old_gs
-    global old_ss
-    global old_es
-    global old_eip
-
-    color(COLOR_REGNAME)
-    output("  EAX: ")
-    eax = int(get_register("eax"), 16)
-    if eax == old_eax:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (eax))
-    old_eax = eax
-
-    color(COLOR_REGNAME)
-    output("  EBX: ")
-    ebx = int(get_register("ebx"), 16)
-    if ebx == old_ebx:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (ebx))
-    old_ebx = ebx
-
-    color(COLOR_REGNAME)
-    output("  ECX: ")
-    ecx = int(get_register("ecx"), 16)
-    if ecx == old_ecx:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (ecx))
-    old_ecx = ecx
-
-    color(COLOR_REGNAME)
-    output("  EDX: ")
-    edx = int(get_register("edx"), 16)
-    if edx == old_edx:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (edx))
-    old_edx = edx
-
-    output("  ")
-    eflags = int(get_register("eflags"), 16)
-    color_bold()
-    color_underline()
-    color(COLOR_CPUFLAGS)
-    dump_eflags(eflags)
-    color_reset()
-
-    output("\n")
-
-    color(COLOR_REGNAME)
-    output("  ESI: ")
-    esi = int(get_register("esi"), 16)
-    if esi == old_esi:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (esi))
-    old_esi = esi
-
-    color(COLOR_REGNAME)
-    output("  EDI: ")
-    edi = int(get_register("edi"), 16)
-    if edi == old_edi:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (edi))
-    old_edi = edi
-
-    color(COLOR_REGNAME)
-    output("  EBP: ")
-    ebp = int(get_register("ebp"), 16)
-    if ebp == old_ebp:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (ebp))
-    old_ebp = ebp
-
-    color(COLOR_REGNAME)
-    output("  ESP: ")
-    esp = int(get_register("esp"), 16)
-    if esp == old_esp:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (esp))
-    old_esp = esp
-
-    color(COLOR_REGNAME)
-    output("  EIP: ")
-    eip = int(get_register("eip"), 16)
-    if eip == old_eip:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (eip))
-    old_eip = eip
-    output("\n")
-
-    color(COLOR_REGNAME)
-    output("  CS:  ")
-    cs = int(get_register("cs"), 16)
-    if cs == old_cs:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (cs))
-    old_cs = cs
-
-    color(COLOR_REGNAME)
-    output("  DS: ")
-    ds = int(get_register("ds"), 16)
-    if ds == old_ds:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (ds))
-    old_ds = ds
-
-    color(COLOR_REGNAME)
-    output("  ES: ")
-    es = int(get_register("es"), 16)
-    if es == old_es:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (es))
-    old_es = es
-
-    color(COLOR_REGNAME)
-    output("  FS: ")
-    fs = int(get_register("fs"), 16)
-    if fs == old_fs:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (fs))
-    old_fs = fs
-
-    color(COLOR_REGNAME)
-    output("  GS: ")
-    gs = int(get_register("gs"), 16)
-    if gs == old_gs:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (gs))
-    old_gs = gs
-
-    color(COLOR_REGNAME)
-    output("  SS: ")
-    ss = int(get_register("ss"), 16)
-    if ss == old_ss:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("%.04X" % (ss))
-    old_ss = ss
-    output("\n")
+class RegState(object):
+    '''
+        Previous register values of one thread, stored in an array indexed
+        like the register layout of its architecture. A fresh state has
+        nothing to compare against, so nothing is shown as modified.
+    '''
+    def __init__(self, tid, count):
+        self.tid = tid
+        self.prev = array.array(REG_ARRAY_TYPE, [0] * count)
+        self.valid = False
 
 
-def dump_cpsr(cpsr):
-    if (cpsr >> 31) & 1:
-        output("N ")
-    else:
-        output("n ")
+def thread_key(thread):
+    return (thread.GetProcess().GetProcessID(), thread.GetThreadID())
 
-    if (cpsr >> 30) & 1:
-        output("Z ")
-    else:
-        output("z ")
 
-    if (cpsr >> 29) & 1:
-        output("C ")
-    else:
-        output("c ")
+def get_reg_state(key, layout):
+    '''
+        Returns the RegState of the thread identified by key (see
+        thread_key). Only the REG_STATES_MAX most recently shown threads
+        are remembered.
+    '''
+    count = len(layout_registers(layout))
+    state = RegStates.pop(key, None)
+    if state is None or len(state.prev) != count:
+        state = RegState(key[1], count)
+    RegStates[key] = state
+    while len(RegStates) > REG_STATES_MAX:
+        RegStates.popitem(last=False)
+    return state
 
-    if (cpsr >> 28) & 1:
-        output("V ")
-    else:
-        output("v ")
 
-    if (cpsr >> 27) & 1:
-        output("Q ")
-    else:
-        output("q ")
+def dump_register_layout(out, layout, regs, state, dump_flags):
+    '''
+        Output registers from regs (name -> int) in layout order, marking
+        the ones that changed since the last time state was rendered.
+    '''
+    colors = out.theme.colors
+    regname = colors[COLOR_REGNAME]
+    regval = colors[COLOR_REGVAL]
+    modified = colors[COLOR_REGVAL_MODIFIED]
+    index = 0
+    prev = state.prev
+    for entry in layout:
+        if entry == "\n":
+            out.write("\n")
+            continue
+        name, label, fmt = entry
+        value = regs.get(name, 0)
+        if fmt is None:
+            out.write(label)
+            out.bold()
+            out.underline()
+            out.color(COLOR_CPUFLAGS)
+            dump_flags(out, value)
+            out.reset()
+        elif state.valid is False or value == prev[index]:
+            out.write(regname + label + regval + fmt % (value))
+        else:
+            out.write(regname + label + modified + fmt % (value))
+        prev[index] = value
+        index += 1
+    state.valid = True
 
-    if (cpsr >> 24) & 1:
-        output("J ")
-    else:
-        output("j ")
 
-    if (cpsr >> 9) & 1:
-        output("E ")
-    else:
-        output("e ")
-    if (cpsr >> 8) & 1:
-        output("A ")
-    else:
-        output("a ")
-    if (cpsr >> 7) & 1:
-        output("I ")
-    else:
-        output("i ")
-    if (cpsr >> 6) & 1:
-        output("F ")
-    else:
-        output("f ")
-    if (cpsr >> 5) & 1:
-        output("T")
-    else:
-        output("t")
-
-
-def regarm():
-    global old_arm_r0
-    global old_arm_r1
-    global old_arm_r2
-    global old_arm_r3
-    global old_arm_r4
-    global old_arm_r5
-    global old_arm_r6
-    global old_arm_r7
-    global old_arm_r8
-    global old_arm_r9
-    global old_arm_r10
-    global old_arm_r11
-    global old_arm_r12
-    global old_arm_sp
-    global old_arm_lr
-    global old_arm_pc
-    global old_arm_cpsr
-
-    color(COLOR_REGNAME)
-    output("  R0:  ")
-    r0 = int(get_register("r0"), 16)
-    if r0 == old_arm_r0:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r0))
-    old_arm_r0 = r0
-
-    color(COLOR_REGNAME)
-    output("  R1:  ")
-    r1 = int(get_register("r1"), 16)
-    if r1 == old_arm_r1:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r1))
-    old_arm_r1 = r1
-
-    color(COLOR_REGNAME)
-    output("  R2:  ")
-    r2 = int(get_register("r2"), 16)
-    if r2 == old_arm_r2:
-        color(COLOR_REGVAL)
-    else:
-        color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r2))
-    old_arm_r2 = r2
-
-    color(COLOR_REGNAME)
-    output("  R3:  ")
-    r3 = int(get_register("r3"), 16)
-    if r3 == old_arm_r3:
-        color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r3))
-    old_arm_r3 = r3
-
-    output(" ")
-    color_bold()
-    color_underline()
-    color(COLOR_CPUFLAGS)
-    cpsr = int(get_register("cpsr"), 16)
-    dump_cpsr(cpsr)
-    color_reset()
-
-    output("\n")
-
-    color(COLOR_REGNAME)
-    output("  R4:  ")
-    r4 = int(get_register("r4"), 16)
-    if r4 == old_arm_r4:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r4))
-    old_arm_r4 = r4
-
-    color(COLOR_REGNAME)
-    output("  R5:  ")
-    r5 = int(get_register("r5"), 16)
-    if r5 == old_arm_r5:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r5))
-    old_arm_r5 = r5
-
-    color(COLOR_REGNAME)
-    output("  R6:  ")
-    r6 = int(get_register("r6"), 16)
-    if r6 == old_arm_r6:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r6))
-    old_arm_r6 = r6
-
-    color(COLOR_REGNAME)
-    output("  R7:  ")
-    r7 = int(get_register("r7"), 16)
-    if r7 == old_arm_r7:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r7))
-    old_arm_r7 = r7
+def reg64(out, regs, state):
+    dump_register_layout(out, REGS_X64_LAYOUT, regs, state, dump_eflags)
 
-    output("\n")
 
-    color(COLOR_REGNAME)
-    output("  R8:  ")
-    r8 = int(get_register("r8"), 16)
-    if r8 == old_arm_r8:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r8))
-    old_arm_r8 = r8
-
-    color(COLOR_REGNAME)
-    output("  R9:  ")
-    r9 = int(get_register("r9"), 16)
-    if r9 == old_arm_r9:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r9))
-    old_arm_r9 = r9
-
-    color(COLOR_REGNAME)
-    output("  R10: ")
-    r10 = int(get_register("r10"), 16)
-    if r10 == old_arm_r10:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r10))
-    old_arm_r10 = r10
-
-    color(COLOR_REGNAME)
-    output("  R11: ")
-    r11 = int(get_register("r11"), 16)
-    if r11 == old_arm_r11:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r11))
-    old_arm_r11 = r11
+def reg32(out, regs, state):
+    dump_register_layout(out, REGS_X86_LAYOUT, regs, state, dump_eflags)
 
-    output("\n")
 
-    color(COLOR_REGNAME)
-    output("  R12: ")
-    r12 = int(get_register("r12"), 16)
-    if r12 == old_arm_r12:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (r12))
-    old_arm_r12 = r12
-
-    color(COLOR_REGNAME)
-    output("  SP:  ")
-    sp = int(get_register("sp"), 16)
-    if sp == old_arm_sp:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (sp))
-    old_arm_sp = sp
-
-    color(COLOR_REGNAME)
-    output("  LR:  ")
-    lr = int(get_register("lr"), 16)
-    if lr == old_arm_lr:
-            color(COLOR_REGVAL)
-    else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (lr))
-    old_arm_lr = lr
-
-    color(COLOR_REGNAME)
-    output("  PC:  ")
-    pc = int(get_register("pc"), 16)
-    if pc == old_arm_pc:
-            color(COLOR_REGVAL)
+def regarm(out, regs, state):
+    dump_register_layout(out, REGS_ARM_LAYOUT, regs, state, dump_cpsr)
+
+
+def dprint_registers(out, key, regs):
+    '''
+        Output registers of the thread identified by key from its register
+        snapshot regs. Returns (layout, RegState) used for the render or
+        None.
+    '''
+    if is_i386():
+        layout = REGS_X86_LAYOUT
+        state = get_reg_state(key, layout)
+        reg32(out, regs, state)
+    elif is_x64():
+        layout = REGS_X64_LAYOUT
+        state = get_reg_state(key, layout)
+        reg64(out, regs, state)
+    elif is_arm():
+        layout = REGS_ARM_LAYOUT
+        state = get_reg_state(key, layout)
+        regarm(out, regs, state)
     else:
-            color(COLOR_REGVAL_MODIFIED)
-    output("0x%.08X" % (pc))
-    old_arm_pc = pc
-    output("\n")
+        return None
+    return (layout, state)
 
 
-def dprint_registers():
+def get_register_layout():
     if is_i386():
-        reg32()
+        return REGS_X86_LAYOUT
     elif is_x64():
-        reg64()
+        return REGS_X64_LAYOUT
     elif is_arm():
-        regarm()
+        return REGS_ARM_LAYOUT
+    return None
+
+
+def diff_registers(layout, regs, state):
+    '''
+        Same bookkeeping as dump_register_layout without any output.
+        Returns the names of the registers which changed.
+    '''
+    changed = []
+    prev = state.prev
+    for index, name in enumerate(layout_registers(layout)):
+        value = regs.get(name, 0)
+        if state.valid is True and value != prev[index]:
+            changed.append(name)
+        prev[index] = value
+    state.valid = True
+    return changed
+
+
+def get_pc_name():
+    if is_i386():
+        return "eip"
+    elif is_x64():
+        return "rip"
+    return "pc"
+
+
+def context_record(key, regs, code, stop):
+    '''
+        Structured form of the context built from the register snapshot
+        and instruction records, without rendering any text.
+    '''
+    layout = get_register_layout()
+    state = get_reg_state(key, layout)
+    changed = diff_registers(layout, regs, state)
+    if key[0] != "replay":
+        record_reg_history(layout, state)
+    return {"triple": get_triple(), "thread": key[1],
+            "pc": regs.get(get_pc_name(), 0), "regs": regs,
+            "changed": changed, "code": [x._asdict() for x in code],
+            "stop": stop}
+
+
+def dump_all_threads(out):
+    '''
+        Output registers of every thread of the selected process. Registers
+        of each thread are fetched once and shared by value and diff.
+    '''
+    process = lldb.debugger.GetSelectedTarget().GetProcess()
+    for th in process:
+        out.color(COLOR_SEPARATOR)
+        out.bold()
+        out.write("[thread #%d tid 0x%x" % (th.GetIndexID(), th.GetThreadID()))
+        if th.GetName():
+            out.write(" " + th.GetName())
+        out.write("]\n")
+        out.reset()
+        regs = get_register_snapshot(th.GetFrameAtIndex(0))
+        dprint_registers(out, thread_key(th), regs)
+
+
+class RegHistory(object):
+    '''
+        Fixed capacity ring buffer of register snapshots. All values live in
+        one flat array of capacity * len(names) entries, a snapshot is
+        addressed by its sequence number (the stop number shown by reghist).
+    '''
+    def __init__(self, layout, capacity):
+        self.layout = layout
+        self.names = layout_registers(layout)
+        self.width = len(self.names)
+        self.capacity = capacity
+        self.values = array.array(REG_ARRAY_TYPE, [0] * (capacity * self.width))
+        self.tids = array.array(REG_ARRAY_TYPE, [0] * capacity)
+        self.count = 0
+        self.pc_index = 0
+        for name in ("eip", "rip", "pc"):
+            if name in self.names:
+                self.pc_index = self.names.index(name)
+
+    def first(self):
+        return max(0, self.count - self.capacity)
+
+    def push(self, tid, values):
+        if self.count > 0:
+            last = self.count - 1
+            if self.tids[last % self.capacity] == tid and \
+               self.snapshot(last) == values:
+                return
+        base = (self.count % self.capacity) * self.width
+        self.values[base:base + self.width] = values
+        self.tids[self.count % self.capacity] = tid
+        self.count += 1
+
+    def snapshot(self, seq):
+        base = (seq % self.capacity) * self.width
+        return self.values[base:base + self.width]
+
+    def value(self, seq, index):
+        return self.values[(seq % self.capacity) * self.width + index]
+
+    def tid(self, seq):
+        return self.tids[seq % self.capacity]
+
+    def stops(self, tid):
+        '''
+            Returns the sequence numbers of the snapshots of thread tid
+            still in the ring, oldest first.
+        '''
+        return [x for x in range(self.first(), self.count) if self.tid(x) == tid]
+
+
+def record_reg_history(layout, state):
+    '''
+        Push the values just rendered from state into the register history.
+        Uses the values already fetched for the [regs] view, so it costs no
+        extra SB calls.
+    '''
+    global RegHistoryRing
+    if RegHistoryRing is None or RegHistoryRing.layout is not layout:
+        RegHistoryRing = RegHistory(layout, REG_HISTORY_SIZE)
+    RegHistoryRing.push(state.tid, state.prev)
+
+
+def reghist(debugger, command, result, dict):
+    '''
+        Show the values a register had at the last stops of the selected
+        thread, together with the pc of each stop. Changed values are
+        highlighted.
+
+        Example:
+            reghist rax
+            reghist r0 100
+            reghist size 8192   (entries kept in the history)
+    '''
+    global RegHistoryRing
+    global REG_HISTORY_SIZE
+
+    out = OutputBuffer()
+
+    cmd = command.split()
+    if len(cmd) == 2 and cmd[0] == "size":
+        try:
+            REG_HISTORY_SIZE = max(1, int(cmd[1], 0))
+        except ValueError:
+            out.write("Invalid history size : " + cmd[1])
+            out.flush(result)
+            return
+        RegHistoryRing = None
+        out.write("Register history size : %d" % REG_HISTORY_SIZE)
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    if len(cmd) == 0 or len(cmd) > 2:
+        out.write("reghist <register> [count]")
+        out.flush(result)
+        return
+
+    hist = RegHistoryRing
+    name = cmd[0].lower()
+    if hist is None or name not in hist.names:
+        out.write("No history for register : " + cmd[0])
+        out.flush(result)
+        return
+    count = 32
+    if len(cmd) == 2:
+        try:
+            count = int(cmd[1], 0)
+        except ValueError:
+            out.write("Invalid count : " + cmd[1])
+            out.flush(result)
+            return
+
+    index = hist.names.index(name)
+    fmts = [x[2] for x in hist.layout if x != "\n"]
+    fmt = fmts[index] or FMT_REG64
+    pcfmt = fmts[hist.pc_index]
+    tid = get_stop().thread.GetThreadID()
+    stops = hist.stops(tid)
+    prev = None
+    if len(stops) > count:
+        prev = hist.value(stops[-count - 1], index)
+        stops = stops[-count:]
+    for seq in stops:
+        value = hist.value(seq, index)
+        out.color(COLOR_REGNAME)
+        out.write("  #%-6d pc: " % seq)
+        out.write(pcfmt % hist.value(seq, hist.pc_index))
+        out.write("  %s: " % name.upper())
+        if prev is None or value == prev:
+            out.color(COLOR_REGVAL)
+        else:
+            out.color(COLOR_REGVAL_MODIFIED)
+        out.write(fmt % (value))
+        out.reset()
+        out.write("\n")
+        prev = value
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def regdiff(debugger, command, result, dict):
+    '''
+        Show registers which changed between stop n of the register history
+        (as numbered by reghist) and the last stop of the selected thread.
+        A negative n counts stops back from the last one.
+
+        Example:
+            regdiff 120
+            regdiff -5
+    '''
+
+    out = OutputBuffer()
+
+    hist = RegHistoryRing
+    try:
+        seq = int(command.strip(), 0)
+    except ValueError:
+        out.write("regdiff <stop>")
+        out.flush(result)
+        return
+    if hist is None:
+        out.write("Register history is empty")
+        out.flush(result)
+        return
+
+    stops = hist.stops(get_stop().thread.GetThreadID())
+    if seq < 0 and -seq < len(stops):
+        seq = stops[seq - 1]
+    if seq not in stops:
+        out.write("Stop #%d is not in the register history" % seq)
+        out.flush(result)
+        return
+
+    last = stops[-1]
+    fmts = [x[2] for x in hist.layout if x != "\n"]
+    out.write("Changes from stop #%d to #%d:\n" % (seq, last))
+    for index, name in enumerate(hist.names):
+        old = hist.value(seq, index)
+        new = hist.value(last, index)
+        if old == new:
+            continue
+        fmt = fmts[index] or FMT_REG64
+        out.color(COLOR_REGNAME)
+        out.write("  %-6s " % name.upper())
+        out.color(COLOR_REGVAL)
+        out.write(fmt % (old))
+        out.write(" -> ")
+        out.color(COLOR_REGVAL_MODIFIED)
+        out.write(fmt % (new))
+        out.reset()
+        out.write("\n")
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
 
 
 def get_GPRs():
@@ -1022,124 +1177,533 @@ def get_GPRs():
     return get_registers("general purpose")
 
 
-def handleHookStop(debugger, command, result, dict):
+def ctx_mode(out, cmd):
     '''
-        Dump current registers and instruction. It will dump when stop at
-        breakpoint. Dump by manual with ctx or context command.
+        Handles ctx off/on/every/stats/json-stream/theme. Returns True if
+        cmd was one of them.
     '''
-    global GlobalListOutput
-    global arm_type
+    global CtxEnabled
+    global CtxEvery
+    global CtxJsonStream
+    global CurrentTheme
+
+    if len(cmd) == 2 and cmd[0] == "theme" and cmd[1] in Themes:
+        CurrentTheme = Themes[cmd[1]]
+        out.write("Context theme : " + cmd[1])
+    elif len(cmd) == 2 and cmd[0] == "json-stream" and cmd[1] in ("on", "off"):
+        CtxJsonStream = cmd[1] == "on"
+        out.write("Context JSON stream : " + cmd[1])
+    elif len(cmd) == 1 and cmd[0] == "off":
+        CtxEnabled = False
+        out.write("Context on stop : off")
+    elif len(cmd) == 1 and cmd[0] == "on":
+        CtxEnabled = True
+        CtxEvery = 1
+        out.write("Context on stop : on")
+    elif len(cmd) == 2 and cmd[0] == "every":
+        try:
+            CtxEvery = max(1, int(cmd[1], 0))
+        except ValueError:
+            out.write("ctx every <count>")
+            return True
+        CtxEnabled = True
+        out.write("Context on stop : every %d stops" % CtxEvery)
+    elif len(cmd) == 1 and cmd[0] == "stats":
+        stops = HookStats["stops"]
+        renders = HookStats["renders"]
+        out.write("Stops        : %d\n" % stops)
+        out.write("Silent       : %d\n" % HookStats["silent"])
+        out.write("Throttled    : %d\n" % HookStats["throttled"])
+        out.write("Renders      : %d\n" % renders)
+        out.write("Check time   : %.3f ms" % (HookStats["check_time"] * 1000))
+        if stops:
+            out.write(" (%.1f us/stop)" % (HookStats["check_time"] * 1e6 / stops))
+        out.write("\n")
+        out.write("Render time  : %.3f ms" % (HookStats["render_time"] * 1000))
+        if renders:
+            out.write(" (%.3f ms/render)" % (HookStats["render_time"] * 1000 / renders))
+        out.write("\n")
+        out.write("Stop contexts: %d built for %d lookups, %d memory reads" % (
+            HookStats["contexts"], HookStats["lookups"], HookStats["reads"]))
+    else:
+        return False
+    return True
 
-    GlobalListOutput = []
 
-    arch = get_arch()
-    if not is_i386() and not is_x64() and not is_arm():
-        #this is for ARM probably in the future... when I will need it...
-        dprint("Unknown architecture : " + arch)
-        return
+def is_silent_stop(thread):
+    '''
+        Returns True when thread stopped at a breakpoint marked by bpsilent.
+    '''
+    if not SilentBreakpoints and not SilentBreakpointNames:
+        return False
+    if thread.GetStopReason() != lldb.eStopReasonBreakpoint:
+        return False
+    bp_id = thread.GetStopReasonDataAtIndex(0)
+    if bp_id in SilentBreakpoints:
+        return True
+    if SilentBreakpointNames:
+        bp = thread.GetProcess().GetTarget().FindBreakpointByID(bp_id)
+        for name in SilentBreakpointNames:
+            if bp.MatchesName(name):
+                return True
+    return False
 
-    output("\n")
-    color(COLOR_SEPARATOR)
-    if is_i386() or is_arm():
-            output(
-                "----------------------------------------------------------" +
-                "-----------------------")
-    elif is_x64():
-            output(
-                "----------------------------------------------------------" +
-                "----------------------------------------------------------" +
-                "---")
 
-    color_bold()
-    output("[regs]\n")
-    color_reset()
-    dprint_registers()
+def HookStop(debugger, command, result, dict):
+    '''
+        Entry point of the target stop-hook. Decides cheaply whether this
+        stop should render a context at all and accounts the time spent.
+    '''
+    if HookSuppressed > 0:
+        return
+    with StateLock:
+        hook_stop(debugger, command, result, dict)
 
-    color(COLOR_SEPARATOR)
-    if is_i386() or is_arm():
-            output(
-                "---------------------------------------------------------" +
-                "------------------------")
-    elif is_x64():
-            output(
-                "---------------------------------------------------------" +
-                "---------------------------------------------------------" +
-                "-----")
-    color_bold()
-    output("[code]\n")
-    color_reset()
 
-    if is_i386():
-            pc = get_register("eip")
-    elif is_x64():
-            pc = get_register("rip")
-    elif is_arm():
-        pc = get_register("pc")
-    #debugger.HandleCommand("disassemble --start-address=" + pc + " --count=8")
-    res = lldb.SBCommandReturnObject()
-    if is_arm():
-        cpsr = int(get_register("cpsr"), 16)
-        t = (cpsr >> 5) & 1
-        if t:
-            #it's thumb
-            arm_type = "thumbv7-apple-ios"
-        else:
-            arm_type = "armv7-apple-ios"
-        lldb.debugger.GetCommandInterpreter().HandleCommand(
-            "disassemble -A " + arm_type + " --start-address=" + pc + " -c 8",
-            res)
-    else:
-        lldb.debugger.GetCommandInterpreter().HandleCommand(
-            "disassemble --start-address=" + pc + " -c 8",
-            res)
-    data = res.GetOutput()
-    #split lines... and mark currently executed code...
-    data = data.split("\n")
-    for x in data:
-        if x[0:2] == "->":
-            color(COLOR_HIGHLIGHT_LINE)
-            color_bold()
-            output(x)
-            color_reset()
-        else:
-            output(x)
-        output("\n")
-    #output(res.GetOutput())
-    color(COLOR_SEPARATOR)
-    if is_i386() or is_arm():
-            output(
-                "-------------------------------------------------------" +
-                "--------------------------------")
-    elif is_x64():
-            output(
-                "--------------------------------------------------------" +
-                "--------------------------------------------------------" +
-                "-------------")
-    color_reset()
-    output("\n")
+def hook_stop(debugger, command, result, dict):
+    '''
+        Body of HookStop, run with StateLock held so a stop never renders
+        while another thread updates the shared state.
+    '''
+    if RuntoPending is True:
+        runto_cleanup(lldb.debugger.GetSelectedTarget())
+    start = time.time()
+    HookStats["stops"] += 1
+    if CtxEnabled is False or HookStats["stops"] % CtxEvery != 0:
+        HookStats["throttled"] += 1
+        HookStats["check_time"] += time.time() - start
+        return
+    if is_silent_stop(get_stop().thread) is True:
+        HookStats["silent"] += 1
+        HookStats["check_time"] += time.time() - start
+        return
+    checked = time.time()
+    HookStats["check_time"] += checked - start
 
-    proc = lldb.debugger.GetSelectedTarget().process.selected_thread
-    output("Stop reason : " + str(proc.GetStopDescription(100)))
+    handleHookStop(debugger, command, result, dict, live=True)
+    HookStats["renders"] += 1
+    HookStats["render_time"] += time.time() - checked
 
-    result.PutCString("".join(GlobalListOutput))
-    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
 
+def bpsilent(debugger, command, result, dict):
+    '''
+        Mark breakpoints (by id or name) as silent: stops at them do not
+        render the context. With -c they are also set to auto-continue so
+        lldb does not even stop. -d removes the mark.
 
-def LoadBreakPoints(debugger, command, result, dict):
+        Example:
+            bpsilent               (list silent breakpoints)
+            bpsilent 3 logger
+            bpsilent -c 4
+            bpsilent -d 3
+            bpsilent -d -c 4       (also stop auto-continuing)
     '''
-        load breakpoints from file and apply them (currently only func names
-        are applied)
+
+    out = OutputBuffer()
+
+    cmd = command.split()
+    delete = "-d" in cmd
+    auto_continue = "-c" in cmd
+    cmd = [x for x in cmd if x not in ("-d", "-c")]
+    if len(cmd) == 0:
+        out.write("Silent breakpoints : %s\n" % " ".join(
+            [str(x) for x in sorted(SilentBreakpoints)] +
+            sorted(SilentBreakpointNames)))
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    target = lldb.debugger.GetSelectedTarget()
+    for x in cmd:
+        try:
+            bp_id = int(x, 0)
+        except ValueError:
+            bp_id = None
+        if bp_id is None:
+            names = SilentBreakpointNames
+            key = x
+            bps = [bp for bp in target.breakpoint_iter() if bp.MatchesName(x)]
+        else:
+            names = SilentBreakpoints
+            key = bp_id
+            bp = target.FindBreakpointByID(bp_id)
+            if bp.IsValid() is False:
+                out.write("No breakpoint with id : " + x + "\n")
+                continue
+            bps = [bp]
+        if delete is True:
+            names.discard(key)
+        else:
+            names.add(key)
+        if auto_continue is True:
+            for bp in bps:
+                bp.SetAutoContinue(not delete)
+        out.write("%s breakpoint : %s\n" % (delete and "Unsilenced" or "Silenced", x))
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def handleHookStop(debugger, command, result, dict, live=False):
+    '''
+        Dump current registers and instruction. It will dump when stop at
+        breakpoint. Dump by manual with ctx or context command.
+
+        Example:
+            ctx
+            ctx all-threads
+            ctx off | ctx on     (context rendering on stops)
+            ctx every 10         (render every 10th stop only)
+            ctx stats            (stop hook time accounting)
+            ctx --json           (context as one JSON record)
+            ctx json-stream on   (stops print NDJSON instead of text)
+            ctx theme nocolor    (or default)
+            ctx bench 1000       (time per render)
+
+        While a snapshot is replayed ctx shows it, stops of the live
+        process (live=True from the stop hook) still render the process.
+    '''
+    with StateLock:
+        previous = get_replay()
+        ReplayScope.snapshot = live is False and Replay or None
+        try:
+            context_command(debugger, command, result, dict)
+        finally:
+            ReplayScope.snapshot = previous
+
+
+def context_command(debugger, command, result, dict):
+    out = OutputBuffer()
+    replay = get_replay()
+
+    command, as_json = split_json_flag(command)
+    if ctx_mode(out, command.split()) is True:
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    arch = get_arch()
+    if not is_i386() and not is_x64() and not is_arm():
+        #this is for ARM probably in the future... when I will need it...
+        dprint("Unknown architecture : " + arch)
+        return
+
+    if command.strip() == "all-threads" and replay is None:
+        dump_all_threads(out)
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    if replay is not None:
+        key = ("replay", replay.thread)
+        regs = replay.regs
+        code = replay.code
+        stop = replay.stop
+    else:
+        context = get_stop()
+        key = thread_key(context.thread)
+        regs = context.read_registers()
+        code = None
+        stop = context.stop_reason
+        if RemoteMode is not None:
+            RemoteMode.prefetch(context.process, regs)
+
+    if as_json is True or CtxJsonStream is True:
+        if code is None:
+            target = lldb.debugger.GetSelectedTarget()
+            code = read_instructions(target, regs.get(get_pc_name(), 0), 8)
+        output_json(out, context_record(key, regs, code, stop))
+        if ContextLogger is not None:
+            ContextLogger.put(out.getvalue())
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    if code is None:
+        lines = None
+        if RemoteMode is not None:
+            lines = remote_code(lldb.debugger.GetSelectedTarget(), regs)
+        if lines is None:
+            lines = disassemble_context(regs)
+    else:
+        lines = format_insn_lines(code, regs.get(get_pc_name(), 0))
+
+    cmd = command.split()
+    if len(cmd) in (1, 2) and cmd[0] == "bench":
+        try:
+            count = len(cmd) == 2 and int(cmd[1], 0) or 100
+        except ValueError:
+            out.write("ctx bench [count]")
+            out.flush(result)
+            return
+        ctx_bench(out, key, regs, lines, stop, count)
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    render_context(out, key, regs, lines, stop)
+    if WatchedMemory:
+        render_watched(out, lldb.debugger.GetSelectedTarget().GetProcess())
+    if RemoteMode is not None and replay is None:
+        out.write("\n[remote] %d packets since the last stop" % RemoteMode.count_packets())
+
+    if ContextLogger is not None:
+        ContextLogger.put(out.getvalue())
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def disassemble_context(regs):
+    '''
+        Returns the lines of lldb's disassembly at pc for the [code] view.
+    '''
+    if is_i386():
+            pc = "0x%x" % regs.get("eip", 0)
+    elif is_x64():
+            pc = "0x%x" % regs.get("rip", 0)
+    elif is_arm():
+        pc = "0x%x" % regs.get("pc", 0)
+    #debugger.HandleCommand("disassemble --start-address=" + pc + " --count=8")
+    res = lldb.SBCommandReturnObject()
+    if is_arm():
+        cpsr = regs.get("cpsr", 0)
+        t = (cpsr >> 5) & 1
+        if t:
+            #it's thumb
+            arm_type = "thumbv7-apple-ios"
+        else:
+            arm_type = "armv7-apple-ios"
+        lldb.debugger.GetCommandInterpreter().HandleCommand(
+            "disassemble -A " + arm_type + " --start-address=" + pc + " -c 8",
+            res)
+    else:
+        lldb.debugger.GetCommandInterpreter().HandleCommand(
+            "disassemble --start-address=" + pc + " -c 8",
+            res)
+    data = res.GetOutput()
+    #split lines... and mark currently executed code...
+    return data.split("\n")
+
+
+def format_insn_lines(records, pc):
+    '''
+        Formats InsnRecords like lldb's disassemble output, marking pc.
+    '''
+    lines = []
+    for record in records:
+        line = "0x%x: %-7s %s" % (record.addr, record.mnemonic, record.operands)
+        if record.comment:
+            line = line + " ; " + record.comment
+        if record.addr == pc:
+            lines.append("->  " + line)
+        else:
+            lines.append("    " + line)
+    return lines
+
+
+def predict_x86(mnemonic, regs):
+    '''
+        Returns True/False if the x86 conditional jump mnemonic will be
+        taken with the registers regs, None if it isn't one.
+    '''
+    flags = regs.get(is_x64() and "rflags" or "eflags", 0)
+    if mnemonic[0] == "j" and mnemonic[1:] in X86_COND_TABLE:
+        return condition_holds(X86_COND_TABLE, mnemonic[1:], X86_COND_FLAGS,
+                               flags)
+    counter = regs.get(is_x64() and "rcx" or "ecx", 0)
+    if mnemonic in ("jcxz", "jecxz", "jrcxz"):
+        mask = {"jcxz": 0xffff, "jecxz": 0xffffffff}.get(mnemonic, (1 << 64) - 1)
+        return counter & mask == 0
+    if mnemonic == "loop":
+        return counter != 1
+    if mnemonic in ("loope", "loopz"):
+        return counter != 1 and condition_holds(X86_COND_TABLE, "e",
+                                                X86_COND_FLAGS, flags)
+    if mnemonic in ("loopne", "loopnz"):
+        return counter != 1 and condition_holds(X86_COND_TABLE, "ne",
+                                                X86_COND_FLAGS, flags)
+    return None
+
+
+def predict_arm(mnemonic, operands, regs):
+    '''
+        Returns True/False if the conditional ARM/Thumb instruction will
+        execute (or branch) with the registers regs, None if it isn't
+        conditional. Instructions inside an IT block carry their condition
+        in the mnemonic so they are handled the same way.
+    '''
+    parts = mnemonic.split(".")
+    if len(parts) == 2 and parts[0] == "b" and parts[1] in ARM_COND_TABLE:
+        # arm64 b.cond
+        return condition_holds(ARM_COND_TABLE, parts[1], ARM_COND_FLAGS,
+                               regs.get("cpsr", 0))
+    mnemonic = parts[0]
+    if mnemonic in ("cbz", "cbnz"):
+        reg = operands.split(",")[0].strip()
+        if reg not in regs:
+            return None
+        return (regs[reg] == 0) == (mnemonic == "cbz")
+    cond = mnemonic[-2:]
+    base = mnemonic[:-2]
+    if cond not in ARM_COND_TABLE or cond == "al":
+        return None
+    if base not in ARM_COND_BASES and not (base[-1:] == "s" and base[:-1] in ARM_COND_BASES):
+        return None
+    return condition_holds(ARM_COND_TABLE, cond, ARM_COND_FLAGS,
+                           regs.get("cpsr", 0))
+
+
+def is_arm_branch(mnemonic):
+    '''
+        True for b, bl, bx, blx (conditional or not, with a .w/.n width),
+        b.cond and cbz/cbnz, but not for bic, bfi, bfc and the like.
+    '''
+    base = mnemonic.split(".")[0]
+    if base in ARM_BRANCHES:
+        return True
+    return base[-2:] in ARM_COND_TABLE and base[:-2] in ARM_BRANCHES
+
+
+def predict_branch(line, regs):
+    '''
+        Annotation for the current instruction in the [code] view line:
+        whether a conditional jump is taken (with its target) or whether
+        a conditional ARM instruction executes. Evaluated from the flags
+        in the register snapshot, None for other instructions. The target
+        is named by the symbol lldb prints in the line's comment, nothing
+        is resolved here as this runs on every stop.
+    '''
+    match = re.match(r"^->\s+.*?:\s+([a-z][\w.]*)\s*([^;]*)(?:;\s*(.*))?", line)
+    if match is None:
+        return None
+    mnemonic = match.group(1)
+    operands = match.group(2).strip()
+    if is_arm():
+        taken = predict_arm(mnemonic, operands, regs)
+        branch = is_arm_branch(mnemonic)
+    else:
+        taken = predict_x86(mnemonic, regs)
+        branch = True
+    if taken is None:
+        return None
+    if branch is False:
+        return taken and "executed" or "skipped"
+    if taken is False:
+        return "not taken"
+    target = re.search(r"0x[0-9a-fA-F]+\s*$", operands)
+    if target is None:
+        return "taken"
+    comment = match.group(3) and match.group(3).strip()
+    if comment:
+        return "taken -> %s %s" % (target.group(0), comment)
+    return "taken -> " + target.group(0)
+
+
+def render_context(out, key, regs, lines, stop):
+    '''
+        Render the [regs] view of the thread identified by key, the [code]
+        view from the disassembly lines and the stop reason into out.
+    '''
+    out.write("\n")
+    out.color(COLOR_SEPARATOR)
+    if is_i386() or is_arm():
+            out.write(
+                "----------------------------------------------------------" +
+                "-----------------------")
+    elif is_x64():
+            out.write(
+                "----------------------------------------------------------" +
+                "----------------------------------------------------------" +
+                "---")
+
+    out.bold()
+    out.write("[regs]\n")
+    out.reset()
+    rendered = dprint_registers(out, key, regs)
+    # replayed snapshots are not stops of the live process
+    if rendered is not None and key[0] != "replay":
+        record_reg_history(rendered[0], rendered[1])
+
+    out.color(COLOR_SEPARATOR)
+    if is_i386() or is_arm():
+            out.write(
+                "---------------------------------------------------------" +
+                "------------------------")
+    elif is_x64():
+            out.write(
+                "---------------------------------------------------------" +
+                "---------------------------------------------------------" +
+                "-----")
+    out.bold()
+    out.write("[code]\n")
+    out.reset()
+
+    for x in lines:
+        if x[0:2] == "->":
+            out.color(COLOR_HIGHLIGHT_LINE)
+            out.bold()
+            out.write(x)
+            out.reset()
+            prediction = predict_branch(x, regs)
+            if prediction is not None:
+                out.color(COLOR_BRANCH)
+                out.write("  [" + prediction + "]")
+                out.reset()
+        else:
+            out.write(x)
+        out.write("\n")
+    #out.write(res.GetOutput())
+    out.color(COLOR_SEPARATOR)
+    if is_i386() or is_arm():
+            out.write(
+                "-------------------------------------------------------" +
+                "--------------------------------")
+    elif is_x64():
+            out.write(
+                "--------------------------------------------------------" +
+                "--------------------------------------------------------" +
+                "-------------")
+    out.reset()
+    out.write("\n")
+
+    out.write("Stop reason : " + stop)
+
+
+def ctx_bench(out, key, regs, lines, stop, count):
+    '''
+        Render the context count times into throwaway buffers and report
+        time and fragments per render. The register diff state of the
+        thread is restored afterwards so the next real stop is unaffected.
+    '''
+    state = get_reg_state(key, get_register_layout())
+    saved = (array.array(REG_ARRAY_TYPE, state.prev), state.valid)
+    parts = 0
+    start = time.time()
+    for i in range(count):
+        buf = OutputBuffer(out.theme)
+        render_context(buf, key, regs, lines, stop)
+        parts += len(buf.parts)
+    elapsed = time.time() - start
+    state.prev[:] = saved[0]
+    state.valid = saved[1]
+    out.write("%d renders : %.3f ms/render, %d fragments/render" % (
+        count, elapsed * 1000 / max(count, 1), parts // max(count, 1)))
+
+
+def LoadBreakPoints(debugger, command, result, dict):
+    '''
+        load breakpoints from file and apply them (currently only func names
+        are applied)
 
         Example
             lb [filename]
     '''
-    global GlobalOutputList
-    GlobalOutputList = []
+    out = OutputBuffer()
     try:
         f = open(command, "r")
     except:
-        output("Failed to load file : " + command)
-        result.PutCString("".join(GlobalListOutput))
+        out.write("Failed to load file : " + command)
+        out.flush(result)
         return
     while True:
         line = f.readline()
@@ -1188,6 +1752,7 @@ def r(debugger, command, result, dict):
         res)
 
 
+@with_replay
 def DumpInstructions(debugger, command, result, dict):
     '''
         Dump instructions at certain address, also handles output of
@@ -1195,10 +1760,51 @@ def DumpInstructions(debugger, command, result, dict):
 
         Example:
             u 0x100000f10
+            u --json 0x100000f10 16
     '''
-    global GlobalListOutput
-    global arm_type
-    GlobalListOutput = []
+    out = OutputBuffer()
+
+    command, as_json = split_json_flag(command)
+    replay = get_replay()
+    if replay is not None:
+        cmd = command.split()
+        addr = dump_address(out, len(cmd) > 0 and cmd[0] or "$pc")
+        if addr is None:
+            out.flush(result)
+            return
+        count = 8
+        if len(cmd) > 1:
+            try:
+                count = int(cmd[1], 0)
+            except ValueError:
+                pass
+        records = replay.disassemble(addr, count)
+        if as_json is True:
+            output_json(out, [x._asdict() for x in records])
+        else:
+            pc = replay.regs.get(get_pc_name(), 0)
+            out.write("\n".join(format_insn_lines(records, pc)))
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    if as_json is True:
+        cmd = command.split()
+        addr = dump_address(out, len(cmd) > 0 and cmd[0] or "$pc")
+        if addr is None:
+            out.flush(result)
+            return
+        count = 8
+        if len(cmd) > 1:
+            try:
+                count = int(cmd[1], 0)
+            except ValueError:
+                pass
+        target = lldb.debugger.GetSelectedTarget()
+        output_json(out, [x._asdict() for x in read_instructions(target, addr, count)])
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
 
     if is_arm():
         cpsr = int(get_register("cpsr"), 16)
@@ -1234,16 +1840,17 @@ def DumpInstructions(debugger, command, result, dict):
             lldb.debugger.GetCommandInterpreter().HandleCommand(
                 "disassemble -A " + arm_type + " --start-address=" + cmd[0] + " --count=" + cmd[1],
                 res)
+        else:
             lldb.debugger.GetCommandInterpreter().HandleCommand(
                 "disassemble --start-address=" + cmd[0] + " --count=" + cmd[1],
                 res)
 
     if res.Succeeded() is True:
-        output(res.GetOutput())
+        out.write(res.GetOutput())
     else:
-        output("Error getting instructions for : " + command)
+        out.write("Error getting instructions for : " + command)
 
-    result.PutCString("".join(GlobalListOutput))
+    out.flush(result)
     result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
 
 
@@ -1271,9 +1878,7 @@ def stepo(debugger, command, result, dict):
 
         Example:    setpo
     '''
-    global GlobalListOutput
-    global arm_type
-    GlobalListOutput = []
+    out = OutputBuffer()
 
     target = lldb.debugger.GetSelectedTarget()
     #if is_i386():
@@ -1303,7 +1908,8 @@ def stepo(debugger, command, result, dict):
             res)
 
     if res.Succeeded() is not True:
-        output("[X] Error in stepo... can't disassemble at pc")
+        out.write("[X] Error in stepo... can't disassemble at pc")
+        out.flush(result)
         return
 
     stuff = res.GetOutput()
@@ -1358,15 +1964,16 @@ def stepo(debugger, command, result, dict):
         if "blx" in pc_inst or "bl" in pc_inst:
             breakpoint = target.BreakpointCreateByAddress(next_pc)
             breakpoint.SetOneShot(True)
-            debugger.HandleCommand("c")
+            target.GetProcess().Continue()
             return
 
+    # resume through SB, the c and si commands would re-enter our overrides
     if "call" in pc_inst or "movs" in pc_inst or "stos" in pc_inst or "loop" in pc_inst or "cmps" in pc_inst:
         breakpoint = target.BreakpointCreateByAddress(next_pc)
         breakpoint.SetOneShot(True)
-        debugger.HandleCommand("c")
+        target.GetProcess().Continue()
     else:
-        debugger.HandleCommand("si")
+        target.GetProcess().GetSelectedThread().StepInstruction(False)
 
 
 def hexdump(addr, chars, sep, width):
@@ -1384,8 +1991,117 @@ def hexdump(addr, chars, sep, width):
     return "\n".join(l)
 
 
+# byte -> itself for ASCII letters and digits, "." for everything else
+QUOTE_TABLE = bytes(bytearray(i < 0x80 and chr(i).isalnum() and i or 0x2e
+                              for i in range(256)))
+
+
 def quotechars(chars):
-    return ''.join(['.', c][c.isalnum()] for c in chars)
+    chars = chars.translate(QUOTE_TABLE)
+    if not isinstance(chars, str):
+        chars = chars.decode("ascii")
+    return chars
+
+
+def split_json_flag(command):
+    '''
+        Returns (command without --json, True if --json was given).
+    '''
+    cmd = command.split()
+    if "--json" not in cmd:
+        return (command, False)
+    return (" ".join([x for x in cmd if x != "--json"]), True)
+
+
+def output_json(out, record):
+    out.write(json.dumps(record, sort_keys=True, separators=(",", ":")))
+
+
+def dump_address(out, command):
+    '''
+        Evaluates the address expression of a dump command. Returns None
+        after reporting the error if it can't be evaluated.
+    '''
+    replay = get_replay()
+    if replay is not None:
+        return replay_address(out, replay, command)
+    value = get_frame().EvaluateExpression(command)
+    if value.IsValid() is False:
+        out.write("Error evaluating expression : " + command)
+        return None
+    try:
+        return int(value.GetValue(), 10)
+    except:
+        out.write("Error evaluating expression value: " + command)
+        return None
+
+
+def replay_address(out, replay, command):
+    '''
+        dump_address while replaying: a number or a saved register with
+        an optional +/- offset, e.g. $rsp+0x20.
+    '''
+    match = re.match(r"^\s*\$?(\w+)\s*(?:([+-])\s*(\w+))?\s*$", command)
+    if match is None:
+        out.write("Error evaluating expression : " + command)
+        return None
+    name = match.group(1)
+    if name == "pc":
+        name = get_pc_name()
+    try:
+        if name in replay.regs:
+            addr = replay.regs[name]
+        else:
+            addr = int(name, 0)
+        if match.group(2) is not None:
+            delta = int(match.group(3), 0)
+            addr = match.group(2) == "+" and addr + delta or addr - delta
+    except ValueError:
+        out.write("Error evaluating expression : " + command)
+        return None
+    return addr
+
+
+def read_dump_memory(out, addr, step):
+    '''
+        Reads 0x100 bytes at addr for the dump commands. When the whole
+        range isn't readable the size is shrunk by step and the rest is
+        padded with zeros. Returns None after reporting the error if
+        nothing could be read.
+    '''
+    replay = get_replay()
+    if replay is not None:
+        membuff = replay.read_memory(addr, 0x100)
+        if membuff is None:
+            out.write("Address 0x%x not saved in %s" % (addr, replay.filename))
+            return None
+        return membuff + b"\x00" * (0x100 - len(membuff))
+    if RemoteMode is not None:
+        membuff = RemoteMode.read_memory(addr, 0x100)
+        if membuff is not None:
+            return membuff
+    err = lldb.SBError()
+    target = lldb.debugger.GetSelectedTarget()
+    size = 0x100
+    while size > 0:
+        membuff = target.GetProcess().ReadMemory(addr, size, err)
+        if err.Success() is True:
+            return membuff + b"\x00" * (0x100 - size)
+        size = size - step
+    out.write(str(err))
+    return None
+
+
+def dump_record(addr, membuff, fmt):
+    '''
+        Structured form of a dump: the raw bytes as hex and the values of
+        the given struct format.
+    '''
+    count = len(membuff) // struct.calcsize(fmt)
+    return {"addr": addr, "size": len(membuff),
+            "unit": struct.calcsize(fmt),
+            "hex": binascii.hexlify(membuff).decode("ascii"),
+            "values": list(struct.unpack("%d%s" % (count, fmt), membuff))}
 
 
 '''
@@ -1394,55 +2110,48 @@ def quotechars(chars):
 '''
 
 
+@with_replay
 def dd(debugger, command, result, dict):
     '''
         dump hex data at certain address.
 
         Example:
             dd 0x100000ef0
+            dd --json 0x100000ef0
     '''
-    global GlobalListOutput
 
-    GlobalListOutput = []
+    out = OutputBuffer()
 
-    value = get_frame().EvaluateExpression(command)
-    if value.IsValid() is False:
-        output("Error evaluating expression : " + command)
-        result.PutCString("".join(GlobalListOutput))
+    command, as_json = split_json_flag(command)
+    value = dump_address(out, command)
+    if value is None:
+        out.flush(result)
         return
-    try:
-        value = int(value.GetValue(), 10)
-    except:
-        output("Error evaluating expression value: " + command)
-        result.PutCString("".join(GlobalListOutput))
+    membuff = read_dump_memory(out, value, 1)
+    if membuff is None:
+        out.flush(result)
         return
 
-    err = lldb.SBError()
-    target = lldb.debugger.GetSelectedTarget()
-    size = 0x100
-    while size != 0:
-        membuff = target.GetProcess().ReadMemory(value, size, err)
-        if err.Success() is False and size == 0:
-            output(str(err))
-            result.PutCString("".join(GlobalListOutput))
-            return
-        if err.Success() is True:
-            break
-        size = size - 1
+    if as_json is True:
+        output_json(out, dump_record(value, membuff, "B"))
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
 
-    membuff = membuff + "\x00" * (0x100 - size)
-    color(BLUE)
+    out.color(BLUE)
     if is_i386() or is_arm():
-        output("[0x0000:0x%.08X]" % value)
-        output("------------------------------------------------------")
+        out.write("[0x0000:0x%.08X]" % value)
+        out.write("------------------------------------------------------")
     elif is_x64():
-        output("[0x0000:0x%.016lX]" % value)
-        output("------------------------------------------------------")
-    color_bold()
-    output("[data]")
-    color_reset()
-    output("\n")
-    #output(hexdump(value, membuff, " ", 16))
+        out.write("[0x0000:0x%.016lX]" % value)
+        out.write("------------------------------------------------------")
+    out.bold()
+    out.write("[data]")
+    out.reset()
+    out.write("\n")
+    #out.write(hexdump(value, membuff, " ", 16))
+    bold = out.theme.bold
+    reset = out.theme.reset
     index = 0
     while index < 0x100:
         data = struct.unpack("B" * 16, membuff[index:index + 0x10])
@@ -1452,8 +2161,10 @@ def dd(debugger, command, result, dict):
             szaddr = "0x%.016lX" % value
         fmtnice = "%.02X %.02X %.02X %.02X %.02X %.02X %.02X %.02X"
         fmtnice = fmtnice + " - " + fmtnice
-        output("\033[1m %s:\033[0m %.02X %.02X %.02X %.02X %.02X %.02X %.02X %.02X - %.02X %.02X %.02X %.02X %.02X %.02X %.02X %.02X \033[1m%s\033[0m" % (
+        out.write("%s %s:%s %.02X %.02X %.02X %.02X %.02X %.02X %.02X %.02X - %.02X %.02X %.02X %.02X %.02X %.02X %.02X %.02X %s%s%s" % (
+            bold,
             szaddr,
+            reset,
             data[0],
             data[1],
             data[2],
@@ -1470,67 +2181,57 @@ def dd(debugger, command, result, dict):
             data[13],
             data[14],
             data[15],
-            quotechars(membuff[index:index + 0x10])))
+            bold,
+            quotechars(membuff[index:index + 0x10]),
+            reset))
         if index + 0x10 != 0x100:
-            output("\n")
+            out.write("\n")
         index += 0x10
         value += 0x10
-    color_reset()
+    out.reset()
     #last element of the list has all data output...
     #so we remove last \n
-    result.PutCString("".join(GlobalListOutput))
+    out.flush(result)
     result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
 
 
+@with_replay
 def dq(debugger, command, result, dict):
     '''
-        dump data as qword
+        dump data as qword (--json for a structured record)
     '''
-    global GlobalListOutput
 
-    GlobalListOutput = []
+    out = OutputBuffer()
 
-    value = get_frame().EvaluateExpression(command)
-    if value.IsValid() is False:
-        output("Error evaluating expression : " + command)
-        result.PutCString("".join(GlobalListOutput))
+    command, as_json = split_json_flag(command)
+    value = dump_address(out, command)
+    if value is None:
+        out.flush(result)
         return
-    try:
-        value = int(value.GetValue(), 10)
-    except:
-        output("Error evaluating expression : " + command)
-        result.PutCString("".join(GlobalListOutput))
+    membuff = read_dump_memory(out, value, 8)
+    if membuff is None:
+        out.flush(result)
         return
 
-    err = lldb.SBError()
-    target = lldb.debugger.GetSelectedTarget()
-    size = 0x100
-    while size != 0:
-        membuff = target.GetProcess().ReadMemory(value, size, err)
-        if err.Success() is False and size == 0:
-            output(str(err))
-            result.PutCString("".join(GlobalListOutput))
-            return
-        if err.Success() is True:
-            break
-        size = size - 8
-        membuff = membuff + "\x00" * (0x100 - size)
-    if err.Success() is False:
-        output(str(err))
-        result.PutCString("".join(GlobalListOutput))
+    if as_json is True:
+        output_json(out, dump_record(value, membuff, "Q"))
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
         return
 
-    color(BLUE)
+    out.color(BLUE)
     if is_i386() or is_arm():
-        output("[0x0000:0x%.08X]" % value)
-        output("-------------------------------------------------------")
+        out.write("[0x0000:0x%.08X]" % value)
+        out.write("-------------------------------------------------------")
     elif is_x64():
-        output("[0x0000:0x%.016lX]" % value)
-        output("-------------------------------------------------------")
-    color_bold()
-    output("[data]")
-    color_reset()
-    output("\n")
+        out.write("[0x0000:0x%.016lX]" % value)
+        out.write("-------------------------------------------------------")
+    out.bold()
+    out.write("[data]")
+    out.reset()
+    out.write("\n")
+    bold = out.theme.bold
+    reset = out.theme.reset
     index = 0
     while index < 0x100:
         (mem0, mem1, mem2, mem3) = struct.unpack("QQQQ", membuff[index:index + 0x20])
@@ -1538,63 +2239,57 @@ def dq(debugger, command, result, dict):
             szaddr = "0x%.08X" % value
         elif is_x64():
             szaddr = "0x%.016lX" % value
-        output("\033[1m%s :\033[0m %.016lX %.016lX %.016lX %.016lX" % (szaddr, mem0, mem1, mem2, mem3))
+        out.write("%s%s :%s %.016lX %.016lX %.016lX %.016lX" % (bold, szaddr, reset, mem0, mem1, mem2, mem3))
         if index + 0x20 != 0x100:
-            output("\n")
+            out.write("\n")
         index += 0x20
         value += 0x20
-    color_reset()
-    result.PutCString("".join(GlobalListOutput))
+    out.reset()
+    out.flush(result)
     result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
 
 
+@with_replay
 def ddword(debugger, command, result, dict):
     '''
         dump data as dword
 
         Example:
             ddword 0x100000ef0
+            ddword --json 0x100000ef0
     '''
-    global GlobalListOutput
 
-    GlobalListOutput = []
+    out = OutputBuffer()
 
-    value = get_frame().EvaluateExpression(command)
-    if value.IsValid() is False:
-        output("Error evaluating expression : " + command)
-        result.PutCString("".join(GlobalListOutput))
+    command, as_json = split_json_flag(command)
+    value = dump_address(out, command)
+    if value is None:
+        out.flush(result)
         return
-    try:
-        value = int(value.GetValue(), 10)
-    except:
-        output("Error evaluating expression : " + command)
-        result.PutCString("".join(GlobalListOutput))
+    membuff = read_dump_memory(out, value, 4)
+    if membuff is None:
+        out.flush(result)
         return
 
-    err = lldb.SBError()
-    target = lldb.debugger.GetSelectedTarget()
-    size = 0x100
-    while size != 0:
-        membuff = target.GetProcess().ReadMemory(value, size, err)
-        if err.Success() is False and size == 0:
-            output(str(err))
-            result.PutCString("".join(GlobalListOutput))
-            return
-        if err.Success() is True:
-            break
-        size = size - 4
-    membuff = membuff + "\x00" * (0x100 - size)
-    color(BLUE)
+    if as_json is True:
+        output_json(out, dump_record(value, membuff, "I"))
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    out.color(BLUE)
     if is_i386() or is_arm():
-            output("[0x0000:0x%.08X]" % value)
-            output("----------------------------------------")
+            out.write("[0x0000:0x%.08X]" % value)
+            out.write("----------------------------------------")
     elif is_x64():
-            output("[0x0000:0x%.016lX]" % value)
-            output("----------------------------------------")
-    color_bold()
-    output("[data]")
-    color_reset()
-    output("\n")
+            out.write("[0x0000:0x%.016lX]" % value)
+            out.write("----------------------------------------")
+    out.bold()
+    out.write("[data]")
+    out.reset()
+    out.write("\n")
+    bold = out.theme.bold
+    reset = out.theme.reset
     index = 0
     while index < 0x100:
         (mem0, mem1, mem2, mem3) = struct.unpack("IIII", membuff[index:index + 0x10])
@@ -1602,67 +2297,63 @@ def ddword(debugger, command, result, dict):
             szaddr = "0x%.08X" % value
         elif is_x64():
             szaddr = "0x%.016lX" % value
-        output("\033[1m%s :\033[0m %.08X %.08X %.08X %.08X \033[1m%s\033[0m" % (
+        out.write("%s%s :%s %.08X %.08X %.08X %.08X %s%s%s" % (
+            bold,
             szaddr,
+            reset,
             mem0,
             mem1,
             mem2,
             mem3,
-            quotechars(membuff[index:index + 0x10])))
+            bold,
+            quotechars(membuff[index:index + 0x10]),
+            reset))
         if index + 0x10 != 0x100:
-            output("\n")
+            out.write("\n")
         index += 0x10
         value += 0x10
-    color_reset()
-    result.PutCString("".join(GlobalListOutput))
+    out.reset()
+    out.flush(result)
     result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
 
 
+@with_replay
 def dw(debugger, command, result, dict):
     '''
-        dump data as word
+        dump data as word (--json for a structured record)
     '''
-    global GlobalListOutput
 
-    GlobalListOutput = []
+    out = OutputBuffer()
 
-    value = get_frame().EvaluateExpression(command)
-    if value.IsValid() is False:
-        output("Error evaluating expression : " + command)
-        result.PutCString("".join(GlobalListOutput))
+    command, as_json = split_json_flag(command)
+    value = dump_address(out, command)
+    if value is None:
+        out.flush(result)
         return
-    try:
-        value = int(value.GetValue(), 10)
-    except:
-        output("Error evaluating expression : " + command)
-        result.PutCString("".join(GlobalListOutput))
+    membuff = read_dump_memory(out, value, 2)
+    if membuff is None:
+        out.flush(result)
         return
 
-    err = lldb.SBError()
-    target = lldb.debugger.GetSelectedTarget()
-    size = 0x100
-    while size != 0:
-        membuff = target.GetProcess().ReadMemory(value, size, err)
-        if err.Success() is False and size == 0:
-            output(str(err))
-            result.PutCString("".join(GlobalListOutput))
-            return
-        if err.Success() is True:
-            break
-        size = size - 2
-    membuff = membuff + "\x00" * (0x100 - size)
+    if as_json is True:
+        output_json(out, dump_record(value, membuff, "H"))
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
 
-    color(BLUE)
+    out.color(BLUE)
     if is_i386() or is_arm():
-        output("[0x0000:0x%.08X]" % value)
-        output("--------------------------------------------")
+        out.write("[0x0000:0x%.08X]" % value)
+        out.write("--------------------------------------------")
     elif is_x64():
-        output("[0x0000:0x%.016lX]" % value)
-        output("--------------------------------------------")
-    color_bold()
-    output("[data]")
-    color_reset()
-    output("\n")
+        out.write("[0x0000:0x%.016lX]" % value)
+        out.write("--------------------------------------------")
+    out.bold()
+    out.write("[data]")
+    out.reset()
+    out.write("\n")
+    bold = out.theme.bold
+    reset = out.theme.reset
     index = 0
     while index < 0x100:
         data = struct.unpack("HHHHHHHH", membuff[index:index + 0x10])
@@ -1670,8 +2361,10 @@ def dw(debugger, command, result, dict):
             szaddr = "0x%.08X" % value
         elif is_x64():
             szaddr = "0x%.016lX" % value
-        output("\033[1m %s:\033[0m %.04X %.04X %.04X %.04X %.04X %.04X %.04X %.04X \033[1m%s\033[0m" % (
+        out.write("%s %s:%s %.04X %.04X %.04X %.04X %.04X %.04X %.04X %.04X %s%s%s" % (
+            bold,
             szaddr,
+            reset,
             data[0],
             data[1],
             data[2],
@@ -1680,49 +2373,3329 @@ def dw(debugger, command, result, dict):
             data[5],
             data[6],
             data[7],
-            quotechars(membuff[index:index + 0x10])))
+            bold,
+            quotechars(membuff[index:index + 0x10]),
+            reset))
         if index + 0x10 != 0x100:
-            output("\n")
+            out.write("\n")
         index += 0x10
         value += 0x10
-    color_reset()
-    result.PutCString("".join(GlobalListOutput))
+    out.reset()
+    out.flush(result)
     result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
 
 
+def iphone_preflight(host, port):
+    '''
+        Checks that host resolves and is routable without sending a
+        single packet (a connected UDP socket only does the route
+        lookup). A TCP probe would use up debugserver's only connection.
+        Returns None or the error text.
+    '''
+    try:
+        addr = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]
+        sock = socket.socket(addr[0], socket.SOCK_DGRAM)
+        try:
+            sock.connect(addr[4])
+        finally:
+            sock.close()
+    except (socket.error, socket.gaierror) as e:
+        return str(e)
+    return None
+
+
+def iphone_connect(out, url, timeout, retries):
+    '''
+        Runs process connect up to retries times, waiting IPHONE_BACKOFF
+        seconds after the first failure and doubling it after each next
+        one. lldb's gdb-remote packet timeout is set to timeout so no
+        attempt hangs longer than that. Returns True once connected.
+    '''
+    res = lldb.SBCommandReturnObject()
+    handleCmd = lldb.debugger.GetCommandInterpreter().HandleCommand
+    handleCmd("settings set plugin.process.gdb-remote.packet-timeout %d" % timeout, res)
+    delay = IPHONE_BACKOFF
+    for attempt in range(1, retries + 1):
+        res = lldb.SBCommandReturnObject()
+        handleCmd("process connect connect://" + url, res)
+        if res.Succeeded() is True:
+            return True
+        out.write("Attempt %d/%d failed : %s\n" % (attempt, retries,
+                  res.GetError().strip() or res.GetOutput().strip()))
+        if attempt < retries:
+            time.sleep(delay)
+            delay *= 2
+    return False
+
+
+def iphone_status(out):
+    '''
+        Prints the connection state and the round trip latency of
+        IPHONE_PINGS qC packets (the cheapest request debugserver answers).
+    '''
+    process = lldb.debugger.GetSelectedTarget().GetProcess()
+    if IphoneURL is None or process.IsValid() is False:
+        out.write("Not connected")
+        return
+    out.write("Connected to : %s (%s)\n" % (IphoneURL,
+              lldb.SBDebugger.StateAsCString(process.GetState())))
+    times = []
+    handleCmd = lldb.debugger.GetCommandInterpreter().HandleCommand
+    for i in range(IPHONE_PINGS):
+        res = lldb.SBCommandReturnObject()
+        start = time.time()
+        handleCmd("process plugin packet send qC", res)
+        if res.Succeeded() is False:
+            out.write("Ping failed : " + res.GetError().strip())
+            return
+        times.append((time.time() - start) * 1000)
+    out.write("Round trip   : min %.2f ms, avg %.2f ms, max %.2f ms" % (
+        min(times), sum(times) / len(times), max(times)))
+
+
 def IphoneConnect(debugger, command, result, dict):
     '''
-        Connect to iDevice.
+        Connect to iDevice. The host is checked first, then process
+        connect is retried with exponential backoff, each attempt bounded
+        by the timeout (seconds).
 
         Example:
             iphone 192.168.0.2:5555
+            iphone 192.168.0.2:5555 --timeout 10 --retries 6
+            iphone status          (round trip latency)
     '''
-    global GlobalListOutput
-    GlobalListOutput = []
+    global IphoneURL
+
+    out = OutputBuffer()
+
+    cmd = command.split()
+    if len(cmd) == 1 and cmd[0] == "status":
+        iphone_status(out)
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
+
+    timeout = IPHONE_TIMEOUT
+    retries = IPHONE_RETRIES
+    try:
+        if "--timeout" in cmd:
+            i = cmd.index("--timeout")
+            timeout = int(cmd.pop(i + 1), 0)
+            cmd.pop(i)
+        if "--retries" in cmd:
+            i = cmd.index("--retries")
+            retries = max(int(cmd.pop(i + 1), 0), 1)
+            cmd.pop(i)
+    except (IndexError, ValueError):
+        cmd = []
+
+    if len(cmd) != 1 or ":" not in cmd[0]:
+        out.write("Connect to remote iPhone debug server")
+        out.write("\n")
+        out.write("iphone <ipaddress:port> [--timeout seconds] [--retries count] | status")
+        out.write("\n")
+        out.write("iphone 192.168.0.2:5555")
+        out.flush(result)
+        result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        return
 
-    if len(command) == 0 or ":" not in command:
-        output("Connect to remote iPhone debug server")
-        output("\n")
-        output("iphone <ipaddress:port>")
-        output("\n")
-        output("iphone 192.168.0.2:5555")
-        result.PutCString("".join(GlobalListOutput))
+    url = cmd[0]
+    host, port = url.rsplit(":", 1)
+    error = iphone_preflight(host, port)
+    if error is not None:
+        out.write("Can't reach %s : %s" % (host, error))
+        out.flush(result)
         result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
         return
 
     res = lldb.SBCommandReturnObject()
     lldb.debugger.GetCommandInterpreter().HandleCommand("platform select remote-ios", res)
     if res.Succeeded() is True:
-        output(res.GetOutput())
+        out.write(res.GetOutput())
     else:
-        output("Error running platform select remote-ios")
-        result.PutCString("".join(GlobalListOutput))
+        out.write("Error running platform select remote-ios")
+        out.flush(result)
         result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
         return
-    lldb.debugger.GetCommandInterpreter().HandleCommand("process connect connect://" + command, res)
-    if res.Succeeded() is True:
-        output("Connected to iphone at : " + command)
+    if iphone_connect(out, url, timeout, retries) is True:
+        IphoneURL = url
+        out.write("Connected to iphone at : " + url + "\n")
+        remote_enable(out, REMOTE_WINDOW)
     else:
-        output(res.GetOutput())
-    result.PutCString("".join(GlobalListOutput))
+        out.write("Giving up on " + url)
+    out.flush(result)
     result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class SymbolIndex(object):
+    '''
+        Code symbols of one module sorted by file address. Lookups and name
+        matching are done with bisect/regex in Python instead of one SB
+        call per address.
+    '''
+    def __init__(self, module):
+        syms = []
+        for i in range(module.GetNumSymbols()):
+            sym = module.GetSymbolAtIndex(i)
+            if sym.GetType() != lldb.eSymbolTypeCode:
+                continue
+            start = sym.GetStartAddress().GetFileAddress()
+            if start == lldb.LLDB_INVALID_ADDRESS:
+                continue
+            end = sym.GetEndAddress().GetFileAddress()
+            if end == lldb.LLDB_INVALID_ADDRESS or end < start:
+                end = start
+            syms.append((start, end, sym.GetName()))
+        syms.sort()
+        self.starts = array.array(REG_ARRAY_TYPE, [x[0] for x in syms])
+        self.ends = array.array(REG_ARRAY_TYPE, [x[1] for x in syms])
+        self.names = [x[2] for x in syms]
+        self.module = module.GetFileSpec().GetFilename()
+        self.by_name = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def extent(self, i):
+        '''
+            Returns (start, end) file addresses of symbol i. Symbols without
+            a size extend up to the next symbol, the last one is empty.
+        '''
+        start = self.starts[i]
+        end = self.ends[i]
+        if end == start and i + 1 < len(self.starts):
+            end = self.starts[i + 1]
+        return (start, end)
+
+    def lookup(self, addr):
+        '''
+            Returns the index of the symbol containing file address addr or
+            None.
+        '''
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0:
+            return None
+        start, end = self.extent(i)
+        if start < end <= addr:
+            return None
+        return i
+
+    def match(self, regex):
+        '''
+            Returns the indexes of the symbols whose name matches regex.
+        '''
+        search = re.compile(regex).search
+        return [i for i, name in enumerate(self.names) if search(name)]
+
+    def find(self, name):
+        '''
+            Returns the index of the symbol called name or None. The name
+            map is built on the first call.
+        '''
+        if self.by_name is None:
+            self.by_name = dict((x, i) for i, x in enumerate(self.names))
+        return self.by_name.get(name)
+
+
+def get_symbol_index(module):
+    '''
+        Returns the SymbolIndex of module, built once per module UUID.
+    '''
+    key = module.GetUUIDString() or str(module.GetFileSpec())
+    index = SymbolIndexes.get(key)
+    if index is None:
+        index = SymbolIndex(module)
+        SymbolIndexes[key] = index
+    return index
+
+
+def get_module_slide(target, module):
+    '''
+        Returns load address - file address of module in target.
+    '''
+    for i in range(module.GetNumSections()):
+        sec = module.GetSectionAtIndex(i)
+        load = sec.GetLoadAddress(target)
+        if load != lldb.LLDB_INVALID_ADDRESS:
+            return load - sec.GetFileAddress()
+    return 0
+
+
+def find_module(target, name):
+    '''
+        Returns the module of target whose file name is name or None.
+    '''
+    for i in range(target.GetNumModules()):
+        module = target.GetModuleAtIndex(i)
+        if module.GetFileSpec().GetFilename() == name:
+            return module
+    return None
+
+
+class ModuleMap(object):
+    '''
+        Load ranges of the sections of every module of a target, each with
+        its module, slide and (built on first use) SymbolIndex, so many
+        addresses find their symbol with bisect instead of SB calls.
+    '''
+    def __init__(self, target, key):
+        self.key = key
+        self.ranges = []
+        self.modules = []
+        for i in range(target.GetNumModules()):
+            module = target.GetModuleAtIndex(i)
+            for j in range(module.GetNumSections()):
+                sec = module.GetSectionAtIndex(j)
+                load = sec.GetLoadAddress(target)
+                if load == lldb.LLDB_INVALID_ADDRESS or sec.GetByteSize() == 0:
+                    continue
+                self.ranges.append((load, load + sec.GetByteSize(), len(self.modules)))
+            self.modules.append([module, get_module_slide(target, module), None])
+        self.ranges.sort()
+        self.starts = [x[0] for x in self.ranges]
+
+    def find(self, addr):
+        '''
+            Returns (SymbolIndex, slide) of the module containing load
+            address addr or None.
+        '''
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0 or addr >= self.ranges[i][1]:
+            return None
+        entry = self.modules[self.ranges[i][2]]
+        if entry[2] is None:
+            entry[2] = get_symbol_index(entry[0])
+        return (entry[2], entry[1])
+
+
+def get_module_map(target):
+    '''
+        Returns the ModuleMap of target, built again when the process or
+        its number of modules changed (dlopen, relaunch).
+    '''
+    global CurrentModuleMap
+
+    key = (target.GetProcess().GetProcessID(), target.GetNumModules())
+    modmap = CurrentModuleMap
+    if modmap is None or modmap.key != key:
+        modmap = ModuleMap(target, key)
+        CurrentModuleMap = modmap
+    return modmap
+
+
+def symbolicate(target, addr):
+    '''
+        Returns "module`symbol+offset" for load address addr.
+    '''
+    found = get_module_map(target).find(addr)
+    if found is None:
+        return "0x%x" % addr
+    index, slide = found
+    file_addr = addr - slide
+    i = index.lookup(file_addr)
+    if i is None:
+        return "%s`0x%x" % (index.module, file_addr)
+    offset = file_addr - index.starts[i]
+    if offset:
+        return "%s`%s+%d" % (index.module, index.names[i], offset)
+    return "%s`%s" % (index.module, index.names[i])
+
+
+def calltrace_callback(frame, bp_loc, dict):
+    '''
+        Breakpoint callback of calltrace. Only bumps the hit counter of the
+        function and records the caller, returns False to auto-continue.
+    '''
+    with StateLock:
+        start = time.time()
+        trace = CallTrace
+        if trace is None:
+            return False
+        pc = frame.GetPC()
+        slot = trace["slots"].get(pc)
+        if slot is not None:
+            trace["counts"][slot] += 1
+            if trace["lr"] is not None:
+                caller = frame.FindRegister(trace["lr"]).GetValueAsUnsigned()
+            else:
+                err = lldb.SBError()
+                caller = frame.GetThread().GetProcess().ReadPointerFromMemory(
+                    frame.GetSP(), err)
+            key = (slot, caller)
+            callers = trace["callers"]
+            callers[key] = callers.get(key, 0) + 1
+        trace["hits"] += 1
+        trace["time"] += time.time() - start
+        return False
+
+
+def calltrace_start(out, target, module_name, regex):
+    global CallTrace
+
+    if module_name is not None:
+        module = find_module(target, module_name)
+        if module is None:
+            out.write("No module named : " + module_name)
+            return
+        modules = [module]
+    else:
+        modules = [target.GetModuleAtIndex(i) for i in range(target.GetNumModules())]
+
+    calltrace_stop(out, target)
+    trace = {"slots": {}, "names": [], "addrs": [], "callers": {},
+             "hits": 0, "time": 0.0, "lr": None}
+    if is_arm():
+        trace["lr"] = "lr"
+    for module in modules:
+        index = get_symbol_index(module)
+        slide = get_module_slide(target, module)
+        if regex is None:
+            matches = range(len(index))
+        else:
+            try:
+                matches = index.match(regex)
+            except re.error:
+                out.write("Invalid regex : " + regex)
+                return
+        for i in matches:
+            addr = index.starts[i] + slide
+            if addr in trace["slots"]:
+                continue
+            trace["slots"][addr] = len(trace["names"])
+            trace["names"].append("%s`%s" % (index.module, index.names[i]))
+            trace["addrs"].append(addr)
+    trace["counts"] = array.array(REG_ARRAY_TYPE, [0] * len(trace["names"]))
+
+    created = time.time()
+    for addr in trace["addrs"]:
+        bp = target.BreakpointCreateByAddress(addr)
+        bp.AddName("calltrace")
+        bp.SetScriptCallbackFunction("lldbinit.calltrace_callback")
+    created = time.time() - created
+    with StateLock:
+        CallTrace = trace
+    out.write("Tracing %d functions (breakpoints set in %.2f s)" % (
+        len(trace["addrs"]), created))
+
+
+def calltrace_stop(out, target):
+    global CallTrace
+
+    ids = [bp.GetID() for bp in target.breakpoint_iter() if bp.MatchesName("calltrace")]
+    for bp_id in ids:
+        target.BreakpointDelete(bp_id)
+    with StateLock:
+        if CallTrace is not None:
+            out.write("Removed %d calltrace breakpoints\n" % len(ids))
+        CallTrace = None
+
+
+def calltrace_top_callers(trace):
+    '''
+        Returns {slot: (caller, count)} with the most frequent caller of
+        every traced function.
+    '''
+    top = {}
+    for (slot, caller), count in trace["callers"].items():
+        if slot not in top or count > top[slot][1]:
+            top[slot] = (caller, count)
+    return top
+
+
+def calltrace_report(out, target, count):
+    trace = CallTrace
+    counts = trace["counts"]
+    hot = sorted([i for i in range(len(counts)) if counts[i]],
+                 key=lambda i: counts[i], reverse=True)[:count]
+    top = calltrace_top_callers(trace)
+    out.bold()
+    out.write("%10s  %-18s  %-40s  %s\n" % ("hits", "address", "function", "top caller"))
+    out.reset()
+    for i in hot:
+        caller = ""
+        if i in top:
+            caller = symbolicate(target, top[i][0])
+        out.write("%10d  0x%.016lX  %-40s  %s\n" % (counts[i], trace["addrs"][i],
+                                                  trace["names"][i], caller))
+    if trace["hits"]:
+        out.write("%d hits, %.2f us per callback" % (
+            trace["hits"], trace["time"] * 1e6 / trace["hits"]))
+
+
+def calltrace_export(out, target, filename):
+    trace = CallTrace
+    counts = trace["counts"]
+    top = calltrace_top_callers(trace)
+    try:
+        f = open(filename, "w")
+    except IOError:
+        out.write("Failed to open file : " + filename)
+        return
+    writer = csv.writer(f)
+    writer.writerow(["function", "address", "hits", "top_caller", "top_caller_hits"])
+    for i in sorted(range(len(counts)), key=lambda i: counts[i], reverse=True):
+        caller, caller_hits = top.get(i, (0, 0))
+        writer.writerow([trace["names"][i], "0x%x" % trace["addrs"][i], counts[i],
+                         caller and symbolicate(target, caller) or "", caller_hits])
+    f.close()
+    out.write("Exported %d functions to %s" % (len(counts), filename))
+
+
+def calltrace(debugger, command, result, dict):
+    '''
+        Count calls of functions with auto-continuing breakpoints. Every
+        code symbol of a module, or symbols matching a regex (in a module or
+        in all modules) are traced.
+
+        Example:
+            calltrace libsystem_malloc.dylib
+            calltrace MyApp ViewController
+            calltrace ^objc_retain
+            calltrace report [count]
+            calltrace export calls.csv
+            calltrace stop
+    '''
+
+    out = OutputBuffer()
+
+    target = lldb.debugger.GetSelectedTarget()
+    cmd = command.split()
+    if len(cmd) == 0:
+        out.write("calltrace <module|regex> | <module> <regex> | report [count] | export <file> | stop")
+    elif cmd[0] == "stop":
+        calltrace_stop(out, target)
+    elif cmd[0] in ("report", "export") and CallTrace is None:
+        out.write("calltrace is not running")
+    elif cmd[0] == "report":
+        count = 30
+        if len(cmd) > 1:
+            try:
+                count = int(cmd[1], 0)
+            except ValueError:
+                pass
+        calltrace_report(out, target, count)
+    elif cmd[0] == "export" and len(cmd) == 2:
+        calltrace_export(out, target, cmd[1])
+    elif len(cmd) == 2:
+        calltrace_start(out, target, cmd[0], cmd[1])
+    elif find_module(target, cmd[0]) is not None:
+        calltrace_start(out, target, cmd[0], None)
+    else:
+        calltrace_start(out, target, None, cmd[0])
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def get_disassembly_flavor():
+    if is_i386() or is_x64():
+        return "intel"
+    return None
+
+
+def insn_record(target, insn, addr):
+    return InsnRecord(addr, insn.GetByteSize(), insn.GetMnemonic(target),
+                      insn.GetOperands(target), insn.GetComment(target),
+                      insn.DoesBranch())
+
+
+def read_instructions(target, addr, count):
+    '''
+        Returns up to count InsnRecords disassembled at load address addr.
+    '''
+    records = []
+    insns = target.ReadInstructions(lldb.SBAddress(addr, target), count,
+                                    get_disassembly_flavor())
+    for insn in insns:
+        load = insn.GetAddress().GetLoadAddress(target)
+        records.append(insn_record(target, insn, load))
+    return records
+
+
+def disassemble_buffer(target, addr, buf):
+    '''
+        Returns InsnRecords of the code in buf, which was read at load
+        address addr. The whole buffer is disassembled with one SB call.
+    '''
+    records = []
+    insns = target.GetInstructionsWithFlavor(addr, get_disassembly_flavor(), buf)
+    for insn in insns:
+        size = insn.GetByteSize()
+        if size == 0:
+            break
+        records.append(insn_record(target, insn, addr))
+        addr += size
+    return records
+
+
+def branch_target(record):
+    '''
+        Returns the destination of a direct branch record or None.
+    '''
+    if record.branch is False:
+        return None
+    match = re.search(r"(?:^|[\s,#])(0x[0-9a-fA-F]+)\s*$", record.operands)
+    if match is None:
+        return None
+    return int(match.group(1), 16)
+
+
+def basic_blocks(records, start, end):
+    '''
+        Returns the sorted start addresses of the basic blocks of the
+        function [start, end) disassembled in records.
+    '''
+    leaders = set([start])
+    for record in records:
+        if record.branch is False:
+            continue
+        after = record.addr + record.size
+        if after < end:
+            leaders.add(after)
+        dest = branch_target(record)
+        if dest is not None and start <= dest < end:
+            leaders.add(dest)
+    return sorted(leaders)
+
+
+def get_module_base(target, module):
+    '''
+        Returns the lowest load address of the sections of module.
+    '''
+    base = None
+    for i in range(module.GetNumSections()):
+        load = module.GetSectionAtIndex(i).GetLoadAddress(target)
+        if load == lldb.LLDB_INVALID_ADDRESS or load == 0:
+            continue
+        if base is None or load < base:
+            base = load
+    return base or 0
+
+
+def cov_callback(frame, bp_loc, dict):
+    '''
+        Breakpoint callback of cov. Marks the block as hit and continues.
+    '''
+    with StateLock:
+        state = Coverage
+        if state is not None:
+            slot = state["slots"].get(frame.GetPC())
+            if slot is not None:
+                state["hits"][slot >> 3] |= 1 << (slot & 7)
+    # a one-shot breakpoint is only removed when it stops, disabling the
+    # location is what makes each block trap once
+    bp_loc.SetEnabled(False)
+    return False
+
+
+def cov_place(target, addrs):
+    ids = []
+    for addr in addrs:
+        bp = target.BreakpointCreateByAddress(addr)
+        bp.AddName("cov")
+        bp.SetScriptCallbackFunction("lldbinit.cov_callback")
+        ids.append(bp.GetID())
+    return ids
+
+
+def cov_worker(target, module, state):
+    '''
+        Enumerates the basic blocks of module function by function and
+        places their breakpoints in batches of COV_BATCH. Runs on its own
+        thread so the prompt comes back immediately.
+    '''
+    index = get_symbol_index(module)
+    slide = state["slide"]
+    batch = []
+    for i in range(len(index)):
+        if Coverage is not state:
+            return
+        start, end = index.extent(i)
+        if end <= start or end - start > COV_MAX_FUNCTION:
+            continue
+        err = lldb.SBError()
+        buf = target.ReadMemory(lldb.SBAddress(start + slide, target),
+                                end - start, err)
+        if err.Success() is False or not buf:
+            continue
+        records = disassemble_buffer(target, start + slide, buf)
+        leaders = basic_blocks(records, start + slide, end + slide)
+        leaders.append(end + slide)
+        for j in range(len(leaders) - 1):
+            addr = leaders[j]
+            if addr in state["slots"]:
+                continue
+            slot = len(state["starts"])
+            state["slots"][addr] = slot
+            state["starts"].append(addr - slide)
+            state["sizes"].append(min(leaders[j + 1] - addr, 0xFFFF))
+            if slot >> 3 >= len(state["hits"]):
+                state["hits"].append(0)
+            batch.append(addr)
+        if len(batch) >= COV_BATCH:
+            if cov_place_batch(target, state, batch) is False:
+                return
+            batch = []
+    if cov_place_batch(target, state, batch) is True:
+        state["done"] = True
+
+
+def cov_place_batch(target, state, batch):
+    '''
+        Places batch unless cov stop (or a new cov start) replaced state.
+        The breakpoints are created outside of StateLock so callbacks
+        aren't held up, when state was replaced meanwhile they are
+        deleted again so none is left behind.
+    '''
+    with StateLock:
+        if Coverage is not state:
+            return False
+    ids = cov_place(target, batch)
+    with StateLock:
+        if Coverage is state:
+            state["placed"] += len(batch)
+            return True
+    for bp_id in ids:
+        target.BreakpointDelete(bp_id)
+    return False
+
+
+def cov_start(out, target, name):
+    global Coverage
+
+    module = find_module(target, name)
+    if module is None:
+        out.write("No module named : " + name)
+        return
+    cov_stop(out, target)
+    Coverage = {"module": name, "uuid": module.GetUUIDString(),
+                "path": str(module.GetFileSpec()),
+                "slide": get_module_slide(target, module),
+                "base": get_module_base(target, module),
+                "slots": {}, "starts": array.array(REG_ARRAY_TYPE),
+                "sizes": array.array("H"), "hits": bytearray(),
+                "placed": 0, "done": False}
+    thread.start_new_thread(cov_worker, (target, module, Coverage))
+    out.write("Collecting coverage of %s in the background (see cov status)" % name)
+
+
+def cov_stop(out, target):
+    global Coverage
+
+    # once Coverage is reset under the lock cov_worker places no more
+    # breakpoints, they are deleted outside of it so a callback waiting
+    # for the lock can't hold up the delete
+    with StateLock:
+        state = Coverage
+        Coverage = None
+    ids = [bp.GetID() for bp in target.breakpoint_iter() if bp.MatchesName("cov")]
+    for bp_id in ids:
+        target.BreakpointDelete(bp_id)
+    if state is not None:
+        out.write("Removed %d coverage breakpoints\n" % len(ids))
+
+
+def cov_hit_slots(state):
+    hits = state["hits"]
+    return [i for i in range(len(state["starts"])) if hits[i >> 3] & (1 << (i & 7))]
+
+
+def cov_save_drcov(state, f):
+    '''
+        Writes drcov version 2 output: a text module table followed by a
+        binary table of {uint32 start, uint16 size, uint16 module id}.
+    '''
+    slots = cov_hit_slots(state)
+    base = state["base"]
+    end = base
+    for i in range(len(state["starts"])):
+        end = max(end, state["starts"][i] + state["slide"] + state["sizes"][i])
+    f.write(b"DRCOV VERSION: 2\n")
+    f.write(b"DRCOV FLAVOR: drcov\n")
+    f.write(b"Module Table: version 2, count 1\n")
+    f.write(b"Columns: id, base, end, entry, checksum, timestamp, path\n")
+    f.write((" 0, 0x%.016x, 0x%.016x, 0x%.016x, 0x%.08x, 0x%.08x, %s\n" % (
+        base, end, 0, 0, 0, state["path"])).encode("utf-8"))
+    f.write(("BB Table: %d bbs\n" % len(slots)).encode("utf-8"))
+    entry = struct.Struct("<IHH")
+    for i in slots:
+        f.write(entry.pack(state["starts"][i] + state["slide"] - base, state["sizes"][i], 0))
+
+
+def cov_save_compact(state, f):
+    '''
+        Writes "LLCOV1", the module UUID, the block count, the block start
+        file addresses (uint64) and the hit bitmap.
+    '''
+    f.write(b"LLCOV1\0")
+    uuid = (state["uuid"] or "").encode("utf-8")
+    f.write(struct.pack("<H", len(uuid)) + uuid)
+    f.write(struct.pack("<I", len(state["starts"])))
+    f.write(struct.pack("<%dQ" % len(state["starts"]), *state["starts"]))
+    f.write(bytes(state["hits"]))
+
+
+def cov(debugger, command, result, dict):
+    '''
+        Basic block coverage of a module. Blocks are found by disassembling
+        every function of the module, each block start gets a breakpoint
+        which marks it in a bitmap and is disabled after its first hit.
+        cov save writes drcov format
+        (or a compact bitmap with "compact").
+
+        Example:
+            cov start MyApp
+            cov status
+            cov save /tmp/myapp.drcov
+            cov save /tmp/myapp.cov compact
+            cov stop
+    '''
+
+    out = OutputBuffer()
+
+    target = lldb.debugger.GetSelectedTarget()
+    cmd = command.split()
+    if len(cmd) == 2 and cmd[0] == "start":
+        cov_start(out, target, cmd[1])
+    elif len(cmd) == 1 and cmd[0] == "stop":
+        cov_stop(out, target)
+    elif len(cmd) >= 1 and cmd[0] in ("status", "save") and Coverage is None:
+        out.write("Coverage is not running")
+    elif len(cmd) == 1 and cmd[0] == "status":
+        out.write("Module      : %s\n" % Coverage["module"])
+        out.write("Blocks      : %d%s\n" % (len(Coverage["starts"]),
+                                         Coverage["done"] is False and " (enumerating)" or ""))
+        out.write("Breakpoints : %d\n" % Coverage["placed"])
+        out.write("Hit         : %d" % len(cov_hit_slots(Coverage)))
+    elif len(cmd) in (2, 3) and cmd[0] == "save":
+        try:
+            f = open(cmd[1], "wb")
+        except IOError:
+            out.write("Failed to open file : " + cmd[1])
+            out.flush(result)
+            return
+        if len(cmd) == 3 and cmd[2] == "compact":
+            cov_save_compact(Coverage, f)
+        else:
+            cov_save_drcov(Coverage, f)
+        f.close()
+        out.write("Saved coverage to : " + cmd[1])
+    else:
+        out.write("cov start <module> | status | save <file> [compact] | stop")
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class LRUCache(object):
+    '''
+        Small least recently used cache on top of OrderedDict.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.data.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+def msgtrace_class_name(trace, process, receiver):
+    '''
+        Returns the class name of receiver from the isa -> name cache. The
+        name comes from the OBJC_CLASS_$_ symbol of the class object, so no
+        expression is evaluated.
+    '''
+    if trace["tagged"] and receiver & trace["tagged"]:
+        return "<tagged 0x%x>" % receiver
+    err = lldb.SBError()
+    isa = process.ReadPointerFromMemory(receiver, err) & trace["isa_mask"]
+    if err.Success() is False:
+        return "<0x%x>" % receiver
+    name = trace["classes"].get(isa)
+    if name is None:
+        name = trace["target"].ResolveLoadAddress(isa).GetSymbol().GetName()
+        if name is None:
+            name = "<isa 0x%x>" % isa
+        elif name.startswith("OBJC_METACLASS_$_"):
+            name = "+" + name[17:]
+        elif name.startswith("OBJC_CLASS_$_"):
+            name = name[13:]
+        trace["classes"].put(isa, name)
+    return name
+
+
+def msgtrace_callback(frame, bp_loc, dict):
+    '''
+        Breakpoint callback of msgtrace. Reads receiver and selector from
+        the argument registers, resolves both through caches and appends
+        a record to the log. Returns False to auto-continue.
+    '''
+    with StateLock:
+        trace = MsgTrace
+        if trace is None:
+            return False
+        if trace["stack_args"] is True:
+            err = lldb.SBError()
+            process = frame.GetThread().GetProcess()
+            sp = frame.GetSP()
+            receiver = process.ReadPointerFromMemory(sp + 4, err)
+            sel = process.ReadPointerFromMemory(sp + 8, err)
+        else:
+            receiver = frame.FindRegister(trace["regs"][0]).GetValueAsUnsigned()
+            if receiver == 0:
+                return False
+            sel = frame.FindRegister(trace["regs"][1]).GetValueAsUnsigned()
+            process = frame.GetThread().GetProcess()
+
+        name = msgtrace_class_name(trace, process, receiver)
+        if trace["filter"] is not None and trace["filter"](name) is None:
+            return False
+        selector = trace["selectors"].get(sel)
+        if selector is None:
+            err = lldb.SBError()
+            selector = process.ReadCStringFromMemory(sel, 256, err)
+            if err.Success() is False or not selector:
+                selector = "0x%x" % sel
+            trace["selectors"].put(sel, selector)
+
+        if name[0] == "+":
+            record = "+[%s %s]" % (name[1:], selector)
+        else:
+            record = "-[%s %s]" % (name, selector)
+        trace["log"].append(record)
+        trace["count"] += 1
+        if trace["file"] is not None:
+            trace["pending"].append(record)
+            if len(trace["pending"]) >= MSGTRACE_FLUSH:
+                msgtrace_flush(trace)
+        return False
+
+
+def msgtrace_flush(trace):
+    '''
+        Write the records logged since the last flush to the log file.
+    '''
+    if trace["file"] is not None and trace["pending"]:
+        trace["file"].write("\n".join(trace["pending"]) + "\n")
+        trace["file"].flush()
+    trace["pending"] = []
+
+
+def msgtrace_start(out, target, pattern, filename):
+    global MsgTrace
+
+    msgtrace_stop(out, target)
+    trace = {"target": target, "count": 0, "pending": [],
+             "selectors": LRUCache(MSGTRACE_CACHE_SIZE),
+             "classes": LRUCache(MSGTRACE_CACHE_SIZE),
+             "log": deque(maxlen=MSGTRACE_LOG_SIZE), "file": None,
+             "filter": None, "stack_args": False, "regs": None,
+             "isa_mask": 0xFFFFFFFFFFFFFFFF, "tagged": 0, "start": time.time()}
+    if is_arm64():
+        trace["regs"] = ("x0", "x1")
+        trace["isa_mask"] = 0x0000000FFFFFFFF8
+        trace["tagged"] = 1 << 63
+    elif is_arm():
+        trace["regs"] = ("r0", "r1")
+    elif is_x64():
+        trace["regs"] = ("rdi", "rsi")
+        trace["isa_mask"] = 0x00007FFFFFFFFFF8
+        trace["tagged"] = 1
+    else:
+        trace["stack_args"] = True
+    if pattern is not None:
+        try:
+            trace["filter"] = re.compile(pattern).search
+        except re.error:
+            out.write("Invalid class filter : " + pattern)
+            return
+    if filename is not None:
+        try:
+            trace["file"] = open(filename, "a")
+        except IOError:
+            out.write("Failed to open file : " + filename)
+            return
+
+    bp = target.BreakpointCreateByName("objc_msgSend")
+    bp.AddName("msgtrace")
+    bp.SetScriptCallbackFunction("lldbinit.msgtrace_callback")
+    with StateLock:
+        MsgTrace = trace
+    out.write("Tracing objc_msgSend (%d locations)" % bp.GetNumLocations())
+
+
+def msgtrace_stop(out, target):
+    global MsgTrace
+
+    ids = [bp.GetID() for bp in target.breakpoint_iter() if bp.MatchesName("msgtrace")]
+    for bp_id in ids:
+        target.BreakpointDelete(bp_id)
+    # a callback flushes under the lock, the file is closed under it too
+    with StateLock:
+        trace = MsgTrace
+        if trace is None:
+            return
+        MsgTrace = None
+        msgtrace_flush(trace)
+        if trace["file"] is not None:
+            trace["file"].close()
+    elapsed = time.time() - trace["start"]
+    out.write("Traced %d messages (%.0f/s)\n" % (trace["count"], trace["count"] / max(elapsed, 1e-6)))
+
+
+def msgtrace(debugger, command, result, dict):
+    '''
+        Trace objc_msgSend with an auto-continuing breakpoint callback.
+        Receiver and selector are read from the argument registers (x0/x1,
+        r0/r1 or rdi/rsi), selector strings and class names are cached by
+        SEL and isa pointer. Records are kept in memory and, with -o, also
+        appended to a file in batches.
+
+        Example:
+            msgtrace on
+            msgtrace on ^UIView -o /tmp/msgs.log
+            msgtrace show [count]
+            msgtrace stats
+            msgtrace off
+    '''
+
+    out = OutputBuffer()
+
+    target = lldb.debugger.GetSelectedTarget()
+    cmd = command.split()
+    filename = None
+    if "-o" in cmd:
+        i = cmd.index("-o")
+        if i + 1 < len(cmd):
+            filename = cmd[i + 1]
+        cmd = cmd[:i] + cmd[i + 2:]
+
+    if len(cmd) in (1, 2) and cmd[0] == "on":
+        pattern = None
+        if len(cmd) == 2:
+            pattern = cmd[1]
+        msgtrace_start(out, target, pattern, filename)
+    elif len(cmd) == 1 and cmd[0] == "off":
+        msgtrace_stop(out, target)
+    elif len(cmd) >= 1 and cmd[0] in ("show", "stats") and MsgTrace is None:
+        out.write("msgtrace is not running")
+    elif len(cmd) in (1, 2) and cmd[0] == "show":
+        count = 50
+        if len(cmd) == 2:
+            try:
+                count = int(cmd[1], 0)
+            except ValueError:
+                pass
+        log = list(MsgTrace["log"])
+        out.write("\n".join(log[-count:]))
+    elif len(cmd) == 1 and cmd[0] == "stats":
+        trace = MsgTrace
+        elapsed = time.time() - trace["start"]
+        out.write("Messages  : %d (%.0f/s)\n" % (trace["count"], trace["count"] / max(elapsed, 1e-6)))
+        for name in ("selectors", "classes"):
+            cache = trace[name]
+            out.write("%-9s : %d cached, %d hits, %d misses\n" % (
+                name.capitalize(), len(cache.data), cache.hits, cache.misses))
+    else:
+        out.write("msgtrace on [class regex] [-o file] | show [count] | stats | off")
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class ContextLog(object):
+    '''
+        Appends rendered contexts to a file from a writer thread. The stop
+        path only puts the text into a bounded queue, when the queue is
+        full the context is dropped and counted instead of waiting for the
+        disk. Files are rotated when they grow over max_size. Write and
+        rotation errors are counted, the writer keeps draining the queue.
+    '''
+    def __init__(self, filename, max_size, compress, colors):
+        self.filename = filename
+        self.max_size = max_size
+        self.compress = compress
+        self.colors = colors
+        self.queue = queue.Queue(CTXLOG_QUEUE_SIZE)
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.errors = 0
+        self.closed = False
+        self.file = open(filename, "a")
+        thread.start_new_thread(self.writer, ())
+
+    def put(self, text):
+        try:
+            self.queue.put_nowait(text)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # never wait on a full queue, the writer also stops on the flag
+        # once it has drained the queue
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def writer(self):
+        ansi = re.compile("\033\\[[0-9;]*m")
+        while True:
+            # close() couldn't queue None when the queue was full
+            if self.closed is True and self.queue.empty():
+                break
+            text = self.queue.get()
+            if text is None:
+                break
+            if self.colors is False:
+                text = ansi.sub("", text)
+            try:
+                if self.file.closed:
+                    # a failed rotation left no file open
+                    self.file = open(self.filename, "a")
+                self.file.write(text)
+                self.file.write("\n")
+                self.file.flush()
+                self.written += 1
+                if self.max_size and self.file.tell() >= self.max_size:
+                    self.rotate()
+            except (IOError, OSError):
+                self.errors += 1
+        try:
+            self.file.close()
+        except (IOError, OSError):
+            self.errors += 1
+
+    def rotate(self):
+        '''
+            Shift filename.N to filename.N+1 (keeping CTXLOG_KEEP files),
+            move the current file to filename.1 and start a new one.
+        '''
+        self.file.close()
+        suffix = self.compress and ".gz" or ""
+        for i in range(CTXLOG_KEEP - 1, 0, -1):
+            old = "%s.%d%s" % (self.filename, i, suffix)
+            if os.path.exists(old):
+                os.rename(old, "%s.%d%s" % (self.filename, i + 1, suffix))
+        if self.compress is True:
+            src = open(self.filename, "rb")
+            dst = gzip.open(self.filename + ".1.gz", "wb")
+            shutil.copyfileobj(src, dst)
+            dst.close()
+            src.close()
+            os.remove(self.filename)
+        else:
+            os.rename(self.filename, self.filename + ".1")
+        self.rotations += 1
+        self.file = open(self.filename, "a")
+
+
+def ctxlog(debugger, command, result, dict):
+    '''
+        Append every rendered context (text or JSON) to a file. Writing
+        happens on a background thread, contexts are dropped (and counted)
+        rather than stalling the stop when it falls behind.
+
+        Example:
+            ctxlog /tmp/session.log
+            ctxlog /tmp/session.log --max-size 50 --gzip   (rotate at 50 MB)
+            ctxlog /tmp/session.log --colors               (keep ANSI colors)
+            ctxlog status
+            ctxlog off
+    '''
+    global ContextLogger
+
+    out = OutputBuffer()
+
+    cmd = command.split()
+    if len(cmd) == 1 and cmd[0] == "off":
+        if ContextLogger is not None:
+            ContextLogger.close()
+            out.write("Stopped logging to : " + ContextLogger.filename)
+        ContextLogger = None
+    elif len(cmd) == 1 and cmd[0] == "status":
+        log = ContextLogger
+        if log is None:
+            out.write("ctxlog is off")
+        else:
+            out.write("File      : %s\n" % log.filename)
+            out.write("Written   : %d\n" % log.written)
+            out.write("Queued    : %d\n" % log.queue.qsize())
+            out.write("Dropped   : %d\n" % log.dropped)
+            out.write("Errors    : %d\n" % log.errors)
+            out.write("Rotations : %d" % log.rotations)
+    elif len(cmd) >= 1 and not cmd[0].startswith("-"):
+        max_size = 0
+        if "--max-size" in cmd:
+            i = cmd.index("--max-size")
+            try:
+                max_size = int(float(cmd[i + 1]) * 1024 * 1024)
+            except (IndexError, ValueError):
+                out.write("--max-size <megabytes>")
+                out.flush(result)
+                return
+        if ContextLogger is not None:
+            ContextLogger.close()
+        try:
+            ContextLogger = ContextLog(cmd[0], max_size, "--gzip" in cmd,
+                                       "--colors" in cmd)
+        except IOError:
+            ContextLogger = None
+            out.write("Failed to open file : " + cmd[0])
+            out.flush(result)
+            return
+        out.write("Logging contexts to : " + cmd[0])
+    else:
+        out.write("ctxlog <file> [--max-size MB] [--gzip] [--colors] | status | off")
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class ContextSnapshot(object):
+    '''
+        A stop saved by ctxsave. The file is mapped read-only and only the
+        header is parsed on load, memory is sliced out of the mapping when
+        a command reads it.
+
+        Layout: CTXSAVE_MAGIC, u32 header size, JSON header, then the raw
+        memory windows at the offsets (from the end of the header) listed
+        in the header.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, "rb")
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if self.map[0:len(CTXSAVE_MAGIC)] != CTXSAVE_MAGIC:
+            self.map.close()
+            raise ValueError("not a ctxsave file")
+        start = len(CTXSAVE_MAGIC) + 4
+        (size,) = struct.unpack("<I", self.map[start - 4:start])
+        header = json.loads(self.map[start:start + size].decode("utf-8"))
+        self.triple = str(header["triple"])
+        self.thread = header["thread"]
+        self.stop = header["stop"]
+        self.regs = dict((str(k), v) for k, v in header["regs"].items())
+        self.code = [InsnRecord(**x) for x in header["code"]]
+        # (addr, size, file offset) sorted by address
+        self.memory = sorted((x[0], x[1], start + size + x[2])
+                             for x in header["memory"])
+
+    def read_memory(self, addr, size):
+        '''
+            Returns the saved bytes from addr up to size or the end of its
+            window, None if addr wasn't saved.
+        '''
+        i = bisect.bisect_right(self.memory, (addr, 1 << 64, 0)) - 1
+        if i < 0:
+            return None
+        start, length, offset = self.memory[i]
+        if addr >= start + length:
+            return None
+        offset += addr - start
+        return self.map[offset:offset + min(size, start + length - addr)]
+
+    def disassemble(self, addr, count):
+        '''
+            Returns up to count InsnRecords at addr, disassembled from the
+            saved bytes with a target created from the triple only. Falls
+            back to the instructions saved with the stop.
+        '''
+        buf = self.read_memory(addr, count * 16)
+        if buf is not None:
+            target = get_triple_target(self.triple)
+            if target.IsValid():
+                records = disassemble_buffer(target, addr, buf)
+                if len(records) > 0:
+                    return records[:count]
+        return [x for x in self.code if x.addr >= addr][:count]
+
+    def close(self):
+        self.map.close()
+
+
+def ctx_save_windows(regs, window):
+    '''
+        Address ranges saved by ctxsave: code around pc and the stack
+        around sp (mostly above it where the frames and arguments are).
+        Overlapping ranges are merged.
+    '''
+    pc = regs.get(get_pc_name(), 0)
+    sp = regs.get(is_i386() and "esp" or is_x64() and "rsp" or "sp", 0)
+    ranges = sorted([(max(pc - window // 2, 0), pc + window // 2),
+                     (max(sp - window // 4, 0), sp + window * 3 // 4)])
+    merged = [list(ranges[0])]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def ctxsave(debugger, command, result, dict):
+    '''
+        Save the current stop (registers, instructions at pc, stop reason
+        and memory around pc and sp) to a file which can be inspected
+        later without a process with replay.
+
+        Example:
+            ctxsave /tmp/crash.ctx
+            ctxsave /tmp/crash.ctx 0x4000      (bytes around pc and sp)
+    '''
+    out = OutputBuffer()
+
+    cmd = command.split()
+    if len(cmd) not in (1, 2):
+        out.write("ctxsave <file> [window]")
+        out.flush(result)
+        return
+    window = CTXSAVE_WINDOW
+    if len(cmd) == 2:
+        try:
+            window = int(cmd[1], 0)
+        except ValueError:
+            out.write("Bad window size : " + cmd[1])
+            out.flush(result)
+            return
+
+    context = get_stop()
+    thread = context.thread
+    target = context.target
+    process = context.process
+    regs = context.read_registers()
+    pc = regs.get(get_pc_name(), 0)
+
+    memory = []
+    blobs = []
+    offset = 0
+    sp = regs.get(is_i386() and "esp" or is_x64() and "rsp" or "sp", 0)
+    for start, end in ctx_save_windows(regs, window):
+        # unreadable pages at the edges shrink the window page by page
+        # toward pc for code and toward sp for the stack
+        anchor = start <= pc < end and pc or sp
+        while start < end:
+            err = lldb.SBError()
+            data = process.ReadMemory(start, end - start, err)
+            if err.Success() is True:
+                memory.append([start, len(data), offset])
+                blobs.append(data)
+                offset += len(data)
+                break
+            if end - start <= 0x1000:
+                break
+            if anchor - start > end - anchor:
+                start += 0x1000
+            else:
+                end -= 0x1000
+
+    header = {"triple": target.triple, "thread": thread.GetThreadID(),
+              "stop": context.stop_reason, "regs": regs,
+              "code": [x._asdict() for x in read_instructions(target, pc, CTXSAVE_INSNS)]}
+    header["memory"] = memory
+    data = json.dumps(header).encode("utf-8")
+
+    try:
+        f = open(cmd[0], "wb")
+        f.write(CTXSAVE_MAGIC)
+        f.write(struct.pack("<I", len(data)))
+        f.write(data)
+        for blob in blobs:
+            f.write(blob)
+        f.close()
+    except IOError:
+        out.write("Failed to write file : " + cmd[0])
+        out.flush(result)
+        return
+
+    out.write("Saved %d registers, %d bytes of memory to : %s" % (
+        len(regs), offset, cmd[0]))
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def replay(debugger, command, result, dict):
+    '''
+        Load a stop saved with ctxsave. While a replay is loaded ctx, u,
+        dd, dq, ddword and dw show the saved stop instead of the process.
+        Only the memory saved around pc and sp can be dumped.
+
+        Example:
+            replay /tmp/crash.ctx
+            replay off
+    '''
+    global Replay
+
+    out = OutputBuffer()
+
+    cmd = command.split()
+    if len(cmd) == 1 and cmd[0] == "off":
+        if Replay is not None:
+            Replay.close()
+            out.write("Closed replay : " + Replay.filename)
+        Replay = None
+    elif len(cmd) == 1:
+        try:
+            snapshot = ContextSnapshot(cmd[0])
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            out.write("Failed to load %s : %s" % (cmd[0], e))
+            out.flush(result)
+            return
+        if Replay is not None:
+            Replay.close()
+        Replay = snapshot
+        size = sum(x[1] for x in snapshot.memory)
+        out.write("Replaying %s (%s, thread 0x%x, %d bytes of memory)" % (
+            cmd[0], snapshot.triple, snapshot.thread, size))
+    else:
+        out.write("replay <file> | off")
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def function_bounds(target, out, name):
+    '''
+        Returns (start, end, SymbolIndex, symbol) of the function called
+        name or containing the address expression name, start and end
+        being load addresses. Only the module containing the function
+        gets its SymbolIndex built. Returns None after reporting the error.
+    '''
+    addr = resolve_address(out, target, name)
+    if addr is None:
+        return None
+    module = target.ResolveLoadAddress(addr).GetModule()
+    if module.IsValid() is False:
+        out.write("No module contains 0x%x" % addr)
+        return None
+    index = get_symbol_index(module)
+    slide = get_module_slide(target, module)
+    sym = index.lookup(addr - slide)
+    if sym is None:
+        out.write("No function contains 0x%x" % addr)
+        return None
+    start, end = index.extent(sym)
+    if end <= start or end - start > COV_MAX_FUNCTION:
+        end = start + COV_MAX_FUNCTION
+    return (start + slide, end + slide, index, sym)
+
+
+def iter_function(target, start, end, page):
+    '''
+        Generator of the InsnRecords from start up to end, disassembled
+        page instructions at a time so only one page is held in memory.
+    '''
+    addr = start
+    while addr < end:
+        records = read_instructions(target, addr, page)
+        if len(records) == 0:
+            return
+        for record in records:
+            if record.addr >= end:
+                return
+            yield record
+            addr = record.addr + record.size
+        if addr <= records[0].addr:
+            return
+
+
+class FunctionCursor(object):
+    '''
+        Position of uf inside a function, so repeating the command (or
+        pressing enter) prints the next page.
+    '''
+    def __init__(self, command, target, bounds, page):
+        self.command = command
+        self.start, self.end, self.index, self.sym = bounds
+        self.page = page
+        self.printed = 0
+        self.records = iter_function(target, self.start, self.end, page)
+        self.done = False
+
+
+def uf_annotation(target, cursor, record):
+    '''
+        Annotation of an instruction: the offset inside the function for
+        local branches, module`symbol+offset for other branches and calls,
+        lldb's comment otherwise.
+    '''
+    dest = branch_target(record)
+    if dest is None:
+        return record.comment
+    if cursor.start <= dest < cursor.end:
+        return "<+%d>" % (dest - cursor.start)
+    return symbolicate(target, dest)
+
+
+def uf(debugger, command, result, dict):
+    '''
+        Disassemble the function containing an address or named by a
+        symbol, one page at a time. Repeat the command (or press enter)
+        for the next page. The function is never disassembled as a whole
+        so huge functions start printing immediately.
+
+        Example:
+            uf main
+            uf $pc
+            uf 0x100000f10 200       (200 instructions per page)
+    '''
+    global UfCursor
+
+    out = OutputBuffer()
+    target = lldb.debugger.GetSelectedTarget()
+
+    cmd = command.split()
+    if len(cmd) not in (1, 2):
+        out.write("uf <addr|symbol> [page size]")
+        out.flush(result)
+        return
+    page = UF_PAGE
+    if len(cmd) == 2:
+        try:
+            page = int(cmd[1], 0)
+        except ValueError:
+            out.write("Bad page size : " + cmd[1])
+            out.flush(result)
+            return
+
+    cursor = UfCursor
+    if cursor is None or cursor.command != command or cursor.done is True:
+        bounds = function_bounds(target, out, cmd[0])
+        if bounds is None:
+            out.flush(result)
+            return
+        cursor = FunctionCursor(command, target, bounds, page)
+        UfCursor = cursor
+        out.write("%s`%s [0x%x-0x%x]:\n" % (cursor.index.module,
+                  cursor.index.names[cursor.sym], cursor.start, cursor.end))
+
+    pc = get_frame().GetPC()
+    count = 0
+    for record in cursor.records:
+        out.write(pc == record.addr and "->  " or "    ")
+        out.write(("0x%x <+%d>: %-7s %s" % (record.addr,
+                   record.addr - cursor.start, record.mnemonic,
+                   record.operands)).rstrip())
+        note = uf_annotation(target, cursor, record)
+        if note:
+            out.write("  ; " + note)
+        out.write("\n")
+        count += 1
+        if count == cursor.page:
+            break
+    cursor.printed += count
+    if count < cursor.page:
+        cursor.done = True
+        out.write("[end of function, %d instructions]" % cursor.printed)
+    else:
+        out.write("[%d instructions, repeat for more]" % cursor.printed)
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def get_triple_target(triple):
+    '''
+        Returns a target without a file for triple, used to disassemble
+        bytes for another arch or instruction set (e.g. thumb) than the
+        selected target. Targets are created once per triple in a private
+        debugger so the user's target list is left alone.
+    '''
+    target = TripleTargets.get(triple)
+    if target is None:
+        target = lldb.SBDebugger.Create(False).CreateTargetWithFileAndTargetTriple("", triple)
+        TripleTargets[triple] = target
+    return target
+
+
+def get_cache_path(kind, key):
+    '''
+        Returns the path of the on-disk cache file kind/key under
+        CACHE_DIR, creating the directory when needed.
+    '''
+    path = os.path.join(CACHE_DIR, kind)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return os.path.join(path, re.sub(r"[^\w.-]", "_", key))
+
+
+'''
+    Gadget terminators per instruction set: (regex over the bytes,
+    alignment, struct format of the terminator, (mask, value) pairs). The
+    regex finds candidates, a candidate is kept when its word masked by
+    one of the masks equals the value.
+'''
+GADGET_KINDS = {
+    # ret, ret imm16, jmp reg, call reg
+    "x86": (b"\xc3|\xc2..|\xff[\xd0-\xd7\xe0-\xe7]", 1, None, ()),
+    # ret, br, blr
+    "arm64": (b"..[\x1f\x3f\x5f]\xd6", 4, "<I",
+              ((0xfffffc1f, 0xd65f0000), (0xfffffc1f, 0xd61f0000),
+               (0xfffffc1f, 0xd63f0000))),
+    # bx reg, blx reg, pop {..., pc}
+    "arm": (b"[\x10-\x3f]\xff\x2f\xe1|.[\x80-\xff]\xbd\xe8", 4, "<I",
+            ((0xfffffff0, 0xe12fff10), (0xfffffff0, 0xe12fff30),
+             (0xffff8000, 0xe8bd8000))),
+    # bx reg, blx reg, pop {..., pc}
+    "thumb": (b".[\x47\xbd]", 2, "<H",
+              ((0xff87, 0x4700), (0xff87, 0x4780), (0xff00, 0xbd00))),
+}
+
+
+def gadget_scan(sections, kind):
+    '''
+        Returns [(section index, offset, size)] of the gadget terminators
+        found in the section bytes. The regex pass runs in this process,
+        lldb isn't safe to fork.
+    '''
+    pattern, align, fmt, checks = GADGET_KINDS[kind]
+    regex = re.compile(b"(?=(" + pattern + b"))", re.DOTALL)
+    found = []
+    for i, data in enumerate(sections):
+        for m in regex.finditer(data):
+            start = m.start()
+            if start % align != 0:
+                continue
+            if fmt is not None:
+                if start + struct.calcsize(fmt) > len(data):
+                    continue
+                (word,) = struct.unpack_from(fmt, data, start)
+                if not any(word & mask == value for mask, value in checks):
+                    continue
+            found.append((i, start, m.end(1) - start))
+    return found
+
+
+def gadget_decode(disasm, flavor, addr, buf, back):
+    '''
+        Returns the InsnRecords of buf (read at addr) when it decodes to
+        at most GADGET_MAX_INSNS instructions, the last one starting at
+        offset back and ending with buf, None otherwise. Only the sizes
+        are fetched until the sequence is known to fit, so most of the
+        candidate starts cost one SB call per instruction.
+    '''
+    insns = []
+    pos = 0
+    for insn in disasm.GetInstructionsWithFlavor(addr, flavor, buf):
+        size = insn.GetByteSize()
+        if size == 0 or len(insns) == GADGET_MAX_INSNS:
+            return None
+        insns.append((addr + pos, insn))
+        pos += size
+    if len(insns) == 0 or pos != len(buf) or insns[-1][0] != addr + back:
+        return None
+    return [insn_record(disasm, insn, load) for load, insn in insns]
+
+
+def module_sections(target, module, permissions):
+    '''
+        Returns [(load address, bytes, permissions)] of the sections of
+        module which have all of permissions. The bytes of read-only
+        sections come from the object file when lldb has it, everything
+        else from process memory.
+    '''
+    sections = []
+    pending = [module.GetSectionAtIndex(i) for i in range(module.GetNumSections())]
+    while len(pending) > 0:
+        sec = pending.pop(0)
+        if sec.GetNumSubSections() > 0:
+            pending.extend(sec.GetSubSectionAtIndex(i) for i in range(sec.GetNumSubSections()))
+            continue
+        perms = sec.GetPermissions()
+        if perms & permissions != permissions:
+            continue
+        load = sec.GetLoadAddress(target)
+        if load == lldb.LLDB_INVALID_ADDRESS or sec.GetByteSize() == 0:
+            continue
+        err = lldb.SBError()
+        data = None
+        if perms & lldb.ePermissionsWritable == 0:
+            sbdata = sec.GetSectionData()
+            if sbdata.IsValid() and sbdata.GetByteSize() == sec.GetByteSize():
+                data = sbdata.ReadRawData(err, 0, sbdata.GetByteSize())
+        if data is None or err.Fail():
+            err = lldb.SBError()
+            data = target.GetProcess().ReadMemory(load, sec.GetByteSize(), err)
+            if err.Fail():
+                continue
+        sections.append((load, data, perms))
+    return sections
+
+
+def gadget_kinds(target):
+    '''
+        Returns [(kind, disassembly target)] to scan for target's arch.
+        32-bit ARM modules mix ARM and Thumb code so both are scanned.
+    '''
+    if is_arm64():
+        return [("arm64", target)]
+    if is_arm():
+        return [("arm", get_triple_target("armv7-apple-ios")),
+                ("thumb", get_triple_target("thumbv7-apple-ios"))]
+    return [("x86", target)]
+
+
+def gadget_build(target, module):
+    '''
+        Returns [(module offset, "insn ; insn ; ret")] of module: every
+        sequence of up to GADGET_MAX_INSNS instructions without branches
+        that decodes exactly up to a terminator.
+    '''
+    base = get_module_base(target, module)
+    loaded = module_sections(target, module, lldb.ePermissionsExecutable)
+    sections = [x[1] for x in loaded]
+    gadgets = {}
+    for kind, disasm in gadget_kinds(target):
+        align = GADGET_KINDS[kind][1]
+        max_back = kind == "x86" and GADGET_MAX_BYTES or (GADGET_MAX_INSNS - 1) * align
+        flavor = get_disassembly_flavor()
+        for i, offset, size in gadget_scan(sections, kind):
+            load, data = loaded[i][:2]
+            end = offset + size
+            for back in range(0, max_back + 1, align):
+                start = offset - back
+                if start < 0:
+                    break
+                records = gadget_decode(disasm, flavor, load + start, data[start:end], back)
+                if records is None:
+                    continue
+                if any(x.branch or not x.mnemonic for x in records[:-1]):
+                    continue
+                text = " ; ".join(("%s %s" % (x.mnemonic, x.operands)).strip()
+                                  for x in records)
+                gadgets[load + start - base] = text
+    return sorted(gadgets.items())
+
+
+def get_gadgets(target, module):
+    '''
+        Returns the gadgets of module, from memory, the on-disk cache of
+        its UUID or a new scan (which is then cached).
+    '''
+    uuid = module.GetUUIDString() or str(module.GetFileSpec())
+    gadgets = GadgetCache.get(uuid)
+    if gadgets is not None:
+        return gadgets
+    try:
+        path = get_cache_path("gadgets", uuid + ".json")
+    except OSError:
+        # no cache directory, scan without caching on disk
+        path = None
+    try:
+        f = open(path)
+        gadgets = [tuple(x) for x in json.load(f)]
+        f.close()
+    except (IOError, TypeError, ValueError):
+        gadgets = gadget_build(target, module)
+        if path is not None:
+            try:
+                f = open(path, "w")
+                json.dump(gadgets, f)
+                f.close()
+            except (IOError, OSError):
+                pass
+    GadgetCache[uuid] = gadgets
+    return gadgets
+
+
+def gadgets(debugger, command, result, dict):
+    '''
+        List ROP/JOP gadgets (sequences ending in ret, jmp/call reg, bx/blx
+        reg, pop {..., pc}, br/blr) of a module as module offsets. The
+        first run scans the executable sections and caches the result per
+        module UUID under ~/.lldbinit, later runs only filter the cache.
+
+        Example:
+            gadgets libsystem_c.dylib
+            gadgets libsystem_c.dylib "^pop rdi ; ret$"
+    '''
+    out = OutputBuffer()
+    target = lldb.debugger.GetSelectedTarget()
+
+    cmd = command.split(None, 1)
+    if len(cmd) == 0:
+        out.write("gadgets <module> [regex]")
+        out.flush(result)
+        return
+    module = find_module(target, cmd[0])
+    if module is None:
+        out.write("No module named : " + cmd[0])
+        out.flush(result)
+        return
+    search = None
+    if len(cmd) == 2:
+        try:
+            search = re.compile(cmd[1].strip().strip("\"'")).search
+        except re.error as e:
+            out.write("Bad regex : " + str(e))
+            out.flush(result)
+            return
+
+    start = time.time()
+    found = get_gadgets(target, module)
+    elapsed = time.time() - start
+    shown = 0
+    for offset, text in found:
+        if search is not None and search(text) is None:
+            continue
+        if shown < GADGETS_SHOW:
+            out.write("%s+0x%x: %s\n" % (cmd[0], offset, text))
+        shown += 1
+    if shown > GADGETS_SHOW:
+        out.write("... %d more\n" % (shown - GADGETS_SHOW))
+    out.write("%d of %d gadgets (%.3fs)" % (shown, len(found), elapsed))
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class RemoteSession(object):
+    '''
+        State of remote mode. On every stop the memory around pc and sp is
+        read with one request per window and served from here until the
+        next stop, and the gdb-remote packets sent since the previous stop
+        are counted from lldb's packet log.
+    '''
+    def __init__(self, window, log):
+        self.window = window
+        self.log = log
+        self.log_offset = 0
+        self.stop_id = None
+        self.windows = []
+        self.stops = 0
+        self.packets = 0
+        self.last_packets = 0
+        self.prefetched = 0
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, process, regs):
+        stop_id = process.GetStopID()
+        if stop_id == self.stop_id:
+            return
+        self.stop_id = stop_id
+        self.windows = []
+        for start, end in ctx_save_windows(regs, self.window):
+            err = lldb.SBError()
+            data = process.ReadMemory(start, end - start, err)
+            if err.Success() is True:
+                self.windows.append((start, data))
+                self.prefetched += len(data)
+
+    def read_memory(self, addr, size):
+        '''
+            Returns size bytes at addr if they were prefetched at this
+            stop, None otherwise.
+        '''
+        if lldb.debugger.GetSelectedTarget().GetProcess().GetStopID() == self.stop_id:
+            for start, data in self.windows:
+                if start <= addr and addr + size <= start + len(data):
+                    self.hits += 1
+                    return data[addr - start:addr - start + size]
+        self.misses += 1
+        return None
+
+    def invalidate(self):
+        '''
+            Drops the prefetched memory, the next stop reads it again.
+        '''
+        self.stop_id = None
+        self.windows = []
+
+    def count_packets(self):
+        '''
+            Counts the packets lldb sent since the last call.
+        '''
+        try:
+            f = open(self.log)
+        except IOError:
+            return 0
+        f.seek(self.log_offset)
+        count = 0
+        for line in f:
+            if "send packet" in line:
+                count += 1
+        self.log_offset = f.tell()
+        f.close()
+        self.stops += 1
+        self.packets += count
+        self.last_packets = count
+        return count
+
+
+def remote_code(target, regs):
+    '''
+        Lines of the [code] view disassembled from the prefetched memory
+        at pc, None if it isn't there.
+    '''
+    pc = regs.get(get_pc_name(), 0)
+    buf = RemoteMode.read_memory(pc, 8 * 16)
+    if buf is None:
+        return None
+    disasm = target
+    if is_arm() and not is_arm64() and (regs.get("cpsr", 0) >> 5) & 1:
+        disasm = get_triple_target("thumbv7-apple-ios")
+    records = disassemble_buffer(disasm, pc, buf)
+    if len(records) == 0:
+        return None
+    return format_insn_lines(records[:8], pc)
+
+
+def remote_enable(out, window):
+    '''
+        Turns remote mode on: registers are read with a single g packet,
+        the memory cache line is grown to the prefetch window and packets
+        are logged to count round trips.
+    '''
+    global RemoteMode
+
+    remote_disable()
+    log = os.path.join(tempfile.gettempdir(), "lldbinit-packets-%d.log" % os.getpid())
+    res = lldb.SBCommandReturnObject()
+    handleCmd = lldb.debugger.GetCommandInterpreter().HandleCommand
+    for setting in REMOTE_SETTINGS:
+        handleCmd(setting, res)
+    handleCmd("settings set target.process.memory-cache-line-size 0x%x" % window, res)
+    handleCmd("log enable -f %s gdb-remote packets" % log, res)
+    RemoteMode = RemoteSession(window, log)
+    out.write("Remote mode on (prefetch window 0x%x)" % window)
+
+
+def remote_disable():
+    global RemoteMode
+
+    if RemoteMode is None:
+        return
+    res = lldb.SBCommandReturnObject()
+    lldb.debugger.GetCommandInterpreter().HandleCommand("log disable gdb-remote packets", res)
+    try:
+        os.remove(RemoteMode.log)
+    except OSError:
+        pass
+    RemoteMode = None
+
+
+def remote(debugger, command, result, dict):
+    '''
+        Remote mode for slow debugserver connections, enabled by iphone.
+        Each stop reads the registers with one packet, prefetches the
+        memory around pc and sp in one read per window for the context
+        and the dump commands, and shows the packets sent since the last
+        stop.
+
+        Example:
+            remote on
+            remote on 0x2000     (prefetch window)
+            remote stats
+            remote off
+    '''
+    out = OutputBuffer()
+
+    cmd = command.split()
+    if len(cmd) in (1, 2) and cmd[0] == "on":
+        window = REMOTE_WINDOW
+        if len(cmd) == 2:
+            try:
+                window = int(cmd[1], 0)
+            except ValueError:
+                out.write("Bad window size : " + cmd[1])
+                out.flush(result)
+                return
+        remote_enable(out, window)
+    elif len(cmd) == 1 and cmd[0] == "off":
+        remote_disable()
+        out.write("Remote mode off")
+    elif len(cmd) == 1 and cmd[0] == "stats":
+        session = RemoteMode
+        if session is None:
+            out.write("Remote mode is off")
+        else:
+            out.write("Stops        : %d\n" % session.stops)
+            out.write("Packets      : %d (%.1f per stop)\n" % (
+                session.packets, session.packets / float(max(session.stops, 1))))
+            out.write("Prefetched   : %d bytes\n" % session.prefetched)
+            out.write("Window reads : %d hits, %d misses" % (session.hits, session.misses))
+    else:
+        out.write("remote on [window] | off | stats")
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def module_ranges(target):
+    '''
+        Returns sorted [(load start, load end, module name)] of the
+        sections of all modules, to find the module of many addresses
+        with bisect instead of an SB call each.
+    '''
+    ranges = []
+    for i in range(target.GetNumModules()):
+        module = target.GetModuleAtIndex(i)
+        name = module.GetFileSpec().GetFilename()
+        for j in range(module.GetNumSections()):
+            sec = module.GetSectionAtIndex(j)
+            load = sec.GetLoadAddress(target)
+            if load == lldb.LLDB_INVALID_ADDRESS or sec.GetByteSize() == 0:
+                continue
+            ranges.append((load, load + sec.GetByteSize(), name))
+    ranges.sort()
+    return ranges
+
+
+def range_module(ranges, addr):
+    i = bisect.bisect_right(ranges, (addr, 1 << 64, "")) - 1
+    if i >= 0 and addr < ranges[i][1]:
+        return ranges[i][2]
+    return None
+
+
+class StringScanner(object):
+    '''
+        Finds printable runs of at least minlen characters (ASCII or
+        UTF-16LE) in data fed chunk by chunk. A run reaching the end of a
+        chunk is held back and completed with the next one.
+    '''
+    def __init__(self, minlen, utf16):
+        self.utf16 = utf16
+        if utf16 is True:
+            self.pattern = re.compile(("(?:[\x20-\x7e\t]\x00){%d,}" % minlen).encode("latin-1"))
+        else:
+            self.pattern = re.compile(("[\x20-\x7e\t]{%d,}" % minlen).encode("latin-1"))
+        self.carry = b""
+        self.carry_addr = 0
+
+    def tail(self, data):
+        '''
+            Returns the offset of the printable run at the end of data.
+        '''
+        if self.utf16 is False:
+            return len(data.rstrip(STRINGS_PRINTABLE))
+        starts = []
+        for end in (len(data), len(data) - 1):
+            i = end
+            while i >= 2 and data[i - 1:i] == b"\x00" and \
+                    data[i - 2:i - 1] in STRINGS_PRINTABLE:
+                i -= 2
+            if end == len(data) - 1 and (end < 0 or data[end:] not in STRINGS_PRINTABLE):
+                continue
+            starts.append(i)
+        return min(starts)
+
+    def decode(self, run):
+        if self.utf16 is True:
+            return run.decode("utf-16-le")
+        return run.decode("latin-1")
+
+    def feed(self, addr, data, last=False):
+        '''
+            Scans data read at addr. Returns [(address, text)] of the runs
+            which are complete. Call with last=True (or reset) at the end
+            of contiguous memory.
+        '''
+        if self.carry and self.carry_addr + len(self.carry) == addr:
+            addr = self.carry_addr
+            data = self.carry + data
+        self.carry = b""
+        held = len(data)
+        if last is False:
+            held = self.tail(data)
+            # a run longer than this is cut instead of carried further
+            if held == 0 and len(data) >= 2 * STRINGS_CHUNK:
+                held = len(data)
+        found = []
+        for m in self.pattern.finditer(data):
+            if m.end() > held:
+                held = m.start()
+                break
+            found.append((addr + m.start(), self.decode(m.group(0))))
+        if held < len(data):
+            self.carry = data[held:]
+            self.carry_addr = addr + held
+        return found
+
+
+def strings_scan(process, start, end, minlen, utf16):
+    '''
+        Returns [(address, text)] of the strings in [start, end), read
+        STRINGS_CHUNK bytes at a time. Unreadable regions are skipped
+        whole using the memory region info.
+    '''
+    scanner = StringScanner(minlen, utf16)
+    found = []
+    addr = start
+    while addr < end:
+        size = min(STRINGS_CHUNK, end - addr)
+        err = lldb.SBError()
+        data = process.ReadMemory(addr, size, err)
+        if err.Success() is True and data:
+            found.extend(scanner.feed(addr, data, addr + len(data) >= end))
+            addr += len(data)
+            continue
+        found.extend(scanner.feed(addr, b"", True))
+        info = lldb.SBMemoryRegionInfo()
+        if process.GetMemoryRegionInfo(addr, info).Success() and \
+                info.IsReadable() is False and info.GetRegionEnd() > addr:
+            addr = info.GetRegionEnd()
+        else:
+            addr += size
+    return found
+
+
+def strings_module(target, module, minlen, utf16):
+    '''
+        Returns [(address, text)] of the strings in the sections of
+        module. Strings of read-only sections are cached per module UUID
+        as module offsets, writable sections are scanned every time.
+    '''
+    base = get_module_base(target, module)
+    uuid = module.GetUUIDString() or str(module.GetFileSpec())
+    key = "%s-%d%s" % (uuid, minlen, utf16 and "-utf16" or "")
+    static = StringsCache.get(key)
+    path = None
+    if static is None:
+        try:
+            path = get_cache_path("strings", key + ".json")
+        except OSError:
+            # no cache directory, scan without caching on disk
+            path = None
+        try:
+            f = open(path)
+            static = [tuple(x) for x in json.load(f)]
+            f.close()
+        except (IOError, TypeError, ValueError):
+            static = None
+    scan_static = static is None
+    if scan_static is True:
+        static = []
+    found = []
+    for load, data, permissions in module_sections(target, module, lldb.ePermissionsReadable):
+        writable = permissions & lldb.ePermissionsWritable != 0
+        if writable is False and scan_static is False:
+            continue
+        scanner = StringScanner(minlen, utf16)
+        for addr, text in scanner.feed(load, data, True):
+            if writable is True:
+                found.append((addr, text))
+            else:
+                static.append((addr - base, text))
+    if scan_static is True:
+        StringsCache[key] = static
+        if path is not None:
+            try:
+                f = open(path, "w")
+                json.dump(static, f)
+                f.close()
+            except (IOError, OSError):
+                pass
+    found.extend((offset + base, text) for offset, text in static)
+    found.sort()
+    return found
+
+
+def strings(debugger, command, result, dict):
+    '''
+        Extract printable strings (at least minlen characters, default 4)
+        from a memory range or from the sections of a module. Read-only
+        module sections are cached per module UUID.
+
+        Example:
+            strings libsystem_c.dylib
+            strings a.out 8 --utf16
+            strings 0x100000000-0x100100000
+            strings 0x7fff5fbff000+0x1000 6
+    '''
+    out = OutputBuffer()
+    target = lldb.debugger.GetSelectedTarget()
+
+    cmd = command.split()
+    utf16 = "--utf16" in cmd
+    cmd = [x for x in cmd if x != "--utf16"]
+    minlen = STRINGS_MINLEN
+    try:
+        if len(cmd) == 2:
+            minlen = max(int(cmd[1], 0), 1)
+    except ValueError:
+        cmd = []
+    if len(cmd) not in (1, 2):
+        out.write("strings <start-end|start+size|module> [minlen] [--utf16]")
+        out.flush(result)
+        return
+
+    start_time = time.time()
+    module = find_module(target, cmd[0])
+    if module is not None:
+        found = strings_module(target, module, minlen, utf16)
+        ranges = None
+    else:
+        match = re.match(r"^(\w+)([-+])(\w+)$", cmd[0])
+        try:
+            start = int(match.group(1), 0)
+            end = int(match.group(3), 0)
+        except (AttributeError, ValueError):
+            out.write("No module or range : " + cmd[0])
+            out.flush(result)
+            return
+        if match.group(2) == "+":
+            end = start + end
+        found = strings_scan(target.GetProcess(), start, end, minlen, utf16)
+        ranges = module_ranges(target)
+    elapsed = time.time() - start_time
+
+    for addr, text in found[:STRINGS_SHOW]:
+        owner = module is not None and cmd[0] or range_module(ranges, addr)
+        out.write("0x%x %s: %s\n" % (addr, owner or "-", text))
+    if len(found) > STRINGS_SHOW:
+        out.write("... %d more\n" % (len(found) - STRINGS_SHOW))
+    out.write("%d strings (%.3fs)" % (len(found), elapsed))
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class WatchedRange(object):
+    '''
+        Memory shown in the [data] view of the context. prev holds the
+        bytes of the last render to highlight what changed.
+    '''
+    def __init__(self, expr, addr, length):
+        self.expr = expr
+        self.addr = addr
+        self.length = length
+        self.prev = None
+
+
+def read_memory_spans(process, ranges):
+    '''
+        Returns {WatchedRange: bytes or None} reading ranges which are
+        at most WATCHMEM_GAP bytes apart with a single read.
+    '''
+    contents = {}
+    spans = []
+    for watched in sorted(ranges, key=lambda x: x.addr):
+        end = watched.addr + watched.length
+        if spans and watched.addr <= spans[-1][1] + WATCHMEM_GAP:
+            spans[-1][1] = max(spans[-1][1], end)
+            spans[-1][2].append(watched)
+        else:
+            spans.append([watched.addr, end, [watched]])
+    replay = get_replay()
+    for start, end, members in spans:
+        data = None
+        if replay is not None:
+            data = replay.read_memory(start, end - start)
+        elif RemoteMode is not None:
+            data = RemoteMode.read_memory(start, end - start)
+        if data is None and replay is None:
+            err = lldb.SBError()
+            data = process.ReadMemory(start, end - start, err)
+            if err.Fail():
+                data = None
+        for watched in members:
+            if data is None or len(data) < watched.addr + watched.length - start:
+                # the span failed, read the range alone
+                contents[watched] = None
+                if replay is None:
+                    err = lldb.SBError()
+                    alone = process.ReadMemory(watched.addr, watched.length, err)
+                    if err.Success():
+                        contents[watched] = alone
+            else:
+                offset = watched.addr - start
+                contents[watched] = data[offset:offset + watched.length]
+    return contents
+
+
+def dump_watched_line(out, addr, data, prev):
+    '''
+        One dd style line of up to 16 bytes, bytes differing from prev
+        in the modified register color.
+    '''
+    out.bold()
+    if is_x64():
+        out.write("0x%.016lX :" % addr)
+    else:
+        out.write("0x%.08X :" % addr)
+    out.reset()
+    data = bytearray(data)
+    for i in range(len(data)):
+        if i == 8:
+            out.write(" -")
+        if prev is not None and (i >= len(prev) or prev[i] != data[i]):
+            out.color(COLOR_REGVAL_MODIFIED)
+            out.write(" %.02X" % data[i])
+            out.reset()
+        else:
+            out.write(" %.02X" % data[i])
+    out.write("   " * (16 - len(data)) + (len(data) <= 8 and "  " or ""))
+    out.bold()
+    out.write(" " + quotechars(bytes(data)))
+    out.reset()
+    out.write("\n")
+
+
+def render_watched(out, process):
+    '''
+        Render the [data] view of the ranges added with watchmem.
+    '''
+    out.write("\n")
+    out.color(COLOR_SEPARATOR)
+    if is_x64():
+        out.write("-" * 119)
+    else:
+        out.write("-" * 81)
+    out.bold()
+    out.write("[data]\n")
+    out.reset()
+    contents = read_memory_spans(process, WatchedMemory)
+    for watched in WatchedMemory:
+        data = contents[watched]
+        out.write("%s (%d bytes)" % (watched.expr, watched.length))
+        if data is None:
+            out.write(" : unreadable\n")
+            continue
+        prev = watched.prev
+        watched.prev = data
+        if WatchmemCollapse is True and prev == data:
+            out.write(" : unchanged\n")
+            continue
+        out.write("\n")
+        old = prev is not None and bytearray(prev) or None
+        for i in range(0, len(data), 16):
+            dump_watched_line(out, watched.addr + i, data[i:i + 16],
+                              old is not None and old[i:i + 16] or None)
+
+
+def watchmem(debugger, command, result, dict):
+    '''
+        Memory dumped in a [data] view of every context, bytes changed
+        since the previous stop are highlighted. Close ranges are read
+        together.
+
+        Example:
+            watchmem add $rsp 0x40
+            watchmem add 0x100008000
+            watchmem list
+            watchmem del 0
+            watchmem collapse on     (one line for unchanged ranges)
+            watchmem clear
+    '''
+    global WatchmemCollapse
+
+    out = OutputBuffer()
+
+    cmd = command.split()
+    if len(cmd) in (2, 3) and cmd[0] == "add":
+        length = WATCHMEM_LENGTH
+        if len(cmd) == 3:
+            try:
+                length = int(cmd[2], 0)
+            except ValueError:
+                out.write("Bad length : " + cmd[2])
+                out.flush(result)
+                return
+        addr = dump_address(out, cmd[1])
+        if addr is None:
+            out.flush(result)
+            return
+        WatchedMemory.append(WatchedRange(cmd[1], addr, max(length, 1)))
+        out.write("Watching %d bytes at 0x%x" % (length, addr))
+    elif len(cmd) == 2 and cmd[0] == "del":
+        try:
+            del WatchedMemory[int(cmd[1], 0)]
+        except (ValueError, IndexError):
+            out.write("No watched range : " + cmd[1])
+            out.flush(result)
+            return
+    elif len(cmd) == 1 and cmd[0] == "clear":
+        del WatchedMemory[:]
+    elif len(cmd) == 2 and cmd[0] == "collapse" and cmd[1] in ("on", "off"):
+        WatchmemCollapse = cmd[1] == "on"
+    elif len(cmd) == 0 or cmd == ["list"]:
+        for i, watched in enumerate(WatchedMemory):
+            out.write("%d: 0x%x %d bytes (%s)\n" % (i, watched.addr,
+                      watched.length, watched.expr))
+    else:
+        out.write("watchmem add <expr> [len] | del <n> | list | clear | collapse on|off")
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class Condition(object):
+    '''
+        Condition of runto and stepuntil: comparisons joined by &&, each
+        of a register or a memory byte ([reg], [reg+off] or [addr]) with
+        a number, e.g. "rax == 0 && [rdi+4] != 0x41". It is compiled once
+        to an lldb expression for native breakpoint and watchpoint
+        conditions and to terms evaluated in Python when stepping.
+    '''
+    def __init__(self, text):
+        # (base register or None, number, is memory, operator, value)
+        self.terms = []
+        for part in text.split("&&"):
+            match = CONDITION_TERM.match(part)
+            if match is None:
+                raise ValueError("can't parse : " + part.strip())
+            left = match.group(1)
+            memory = left[0] == "["
+            if memory is True:
+                left = left[1:-1]
+            operand = CONDITION_OPERAND.match(left.strip())
+            if operand is None:
+                raise ValueError("can't parse : " + left)
+            base, sign, offset = operand.groups()
+            try:
+                number = int(base, 0)
+                base = None
+            except ValueError:
+                number = 0
+            if offset is not None:
+                number += sign == "-" and -int(offset, 0) or int(offset, 0)
+            self.terms.append((base, number, memory, match.group(2),
+                               int(match.group(3), 0)))
+        self.lldb_expr = " && ".join(self.term_expr(x) for x in self.terms)
+
+    def term_expr(self, term):
+        base, number, memory, op, value = term
+        if base is None:
+            operand = "0x%x" % number
+        elif number:
+            operand = "($%s + %d)" % (base, number)
+        else:
+            operand = "$" + base
+        if memory is True:
+            operand = "*(unsigned char *)" + operand
+        return "%s %s 0x%x" % (operand, op, value)
+
+    def registers(self):
+        return [x[0] for x in self.terms if x[0] is not None]
+
+    def watch_address(self):
+        '''
+            Returns the address of a single byte compare at a fixed
+            address, which a hardware watchpoint can catch, or None.
+        '''
+        if len(self.terms) == 1 and self.terms[0][0] is None and self.terms[0][2] is True:
+            return self.terms[0][1]
+        return None
+
+    def test(self, frame, process):
+        for base, number, memory, op, value in self.terms:
+            current = number
+            if base is not None:
+                current += frame.FindRegister(base).GetValueAsUnsigned()
+            if memory is True:
+                err = lldb.SBError()
+                data = process.ReadMemory(current, 1, err)
+                if err.Fail():
+                    return False
+                current = bytearray(data)[0]
+            if not CONDITION_OPERATORS[op](current, value):
+                return False
+        return True
+
+
+def runto_cleanup(target):
+    '''
+        Removes the breakpoint or watchpoint of a previous runto or
+        stepuntil, called on the next stop.
+    '''
+    global RuntoPending
+    global RuntoWatchpoint
+
+    ids = [bp.GetID() for bp in target.breakpoint_iter() if bp.MatchesName("runto")]
+    for bp_id in ids:
+        target.BreakpointDelete(bp_id)
+    if RuntoWatchpoint is not None:
+        target.DeleteWatchpoint(RuntoWatchpoint)
+    RuntoWatchpoint = None
+    RuntoPending = False
+
+
+def find_symbol_address(target, name):
+    '''
+        Returns the load address of the symbol called name, found with a
+        single SBTarget.FindSymbols call, or None.
+    '''
+    symbols = target.FindSymbols(name)
+    for i in range(symbols.GetSize()):
+        addr = symbols.GetContextAtIndex(i).GetSymbol().GetStartAddress().GetLoadAddress(target)
+        if addr != lldb.LLDB_INVALID_ADDRESS:
+            return addr
+    return None
+
+
+def resolve_address(out, target, text):
+    '''
+        Returns the load address of text: a number, a symbol name or an
+        address expression. Numbers cost no SB call and names one lookup,
+        no SymbolIndex is built. Returns None after reporting the error.
+    '''
+    try:
+        return int(text, 0)
+    except ValueError:
+        pass
+    if SYMBOL_NAME.match(text) is not None:
+        addr = find_symbol_address(target, text)
+        if addr is not None:
+            return addr
+    return dump_address(out, text)
+
+
+def step_instructions(context, until, budget, visit=None):
+    '''
+        Single steps the thread of context (into calls) until until(frame)
+        returns True or budget steps were made. visit(frame) is called
+        with every frame about to execute one more counted instruction.
+        Steps are synchronous SB calls with the stop hook suppressed.
+        Returns (steps, True if until was met, seconds).
+    '''
+    thread = context.thread
+    process = context.process
+    was_async = lldb.debugger.GetAsync()
+    lldb.debugger.SetAsync(False)
+    suppress_hook(True)
+    steps = 0
+    met = False
+    start = time.time()
+    try:
+        while steps < budget:
+            thread.StepInstruction(False)
+            steps += 1
+            if process.GetState() != lldb.eStateStopped:
+                break
+            frame = thread.GetFrameAtIndex(0)
+            if until(frame) is True:
+                met = True
+                break
+            if visit is not None and steps < budget:
+                visit(frame)
+    finally:
+        suppress_hook(False)
+        lldb.debugger.SetAsync(was_async)
+    return (steps, met, max(time.time() - start, 1e-6))
+
+
+def parse_condition(out, frame, text):
+    '''
+        Returns the Condition of text or None after reporting the error.
+    '''
+    try:
+        cond = Condition(text)
+    except ValueError as e:
+        out.write(str(e))
+        return None
+    for reg in cond.registers():
+        if frame.FindRegister(reg).IsValid() is False:
+            out.write("Unknown register : " + reg)
+            return None
+    return cond
+
+
+def runto(debugger, command, result, dict):
+    '''
+        Continue until an address or symbol is reached, optionally only
+        when a condition holds. The condition is evaluated by lldb as a
+        breakpoint condition, not by stepping.
+
+        Example:
+            runto 0x100000f40
+            runto malloc if rdi > 0x1000
+            runto 0x100000f40 if rax == 0 && [rsi] == 0x41
+    '''
+    global RuntoPending
+
+    out = OutputBuffer()
+    target = lldb.debugger.GetSelectedTarget()
+
+    parts = re.split(r"\s+if\s+", command.strip(), 1)
+    if len(parts[0]) == 0:
+        out.write("runto <addr|symbol> [if <cond>]")
+        out.flush(result)
+        return
+    cond = None
+    if len(parts) == 2:
+        cond = parse_condition(out, get_frame(), parts[1])
+        if cond is None:
+            out.flush(result)
+            return
+
+    addr = resolve_address(out, target, parts[0])
+    if addr is None:
+        out.flush(result)
+        return
+
+    runto_cleanup(target)
+    bp = target.BreakpointCreateByAddress(addr)
+    bp.AddName("runto")
+    bp.SetOneShot(True)
+    if cond is not None:
+        bp.SetCondition(cond.lldb_expr)
+    RuntoPending = True
+    out.write("Running to 0x%x%s\n" % (addr, cond is not None and " if " + cond.lldb_expr or ""))
+    out.flush(result)
+
+    target.GetProcess().Continue()
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def stepuntil(debugger, command, result, dict):
+    '''
+        Run until a condition holds. A byte compare at a fixed address is
+        caught by a hardware watchpoint with the condition attached, any
+        other condition is checked after each single step with the
+        context rendering suppressed (at most STEPUNTIL_MAX steps).
+
+        Example:
+            stepuntil rax == 0x2a
+            stepuntil [rbp-8] == 0 && rcx != 0
+            stepuntil [0x100008010] == 0x41     (hardware watchpoint)
+    '''
+    global RuntoPending
+    global RuntoWatchpoint
+
+    out = OutputBuffer()
+    context = get_stop()
+
+    if len(command.strip()) == 0:
+        out.write("stepuntil <cond>")
+        out.flush(result)
+        return
+    cond = parse_condition(out, context.frame, command)
+    if cond is None:
+        out.flush(result)
+        return
+
+    target = context.target
+    runto_cleanup(target)
+    addr = cond.watch_address()
+    if addr is not None:
+        err = lldb.SBError()
+        watchpoint = target.WatchAddress(addr, 1, False, True, err)
+        if err.Success() is True and watchpoint.IsValid():
+            watchpoint.SetCondition(cond.lldb_expr)
+            RuntoWatchpoint = watchpoint.GetID()
+            RuntoPending = True
+            out.write("Watching 0x%x until %s\n" % (addr, cond.lldb_expr))
+            out.flush(result)
+            context.process.Continue()
+            result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+            return
+
+    process = context.process
+    steps, met, elapsed = step_instructions(
+        context, lambda frame: cond.test(frame, process), STEPUNTIL_MAX)
+
+    out.write("%s after %d steps (%.0f steps/s)\n" % (
+        met and "Condition met" or "Stopped", steps, steps / elapsed))
+    out.flush(result)
+    if process.GetState() == lldb.eStateStopped:
+        handleHookStop(debugger, "", result, dict, live=True)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class PCHistogram(object):
+    '''
+        Execution count per pc. The dict only maps a pc to its slot, the
+        counts live in an array so hot loops just bump an integer.
+    '''
+    def __init__(self):
+        self.slots = {}
+        self.pcs = array.array(REG_ARRAY_TYPE)
+        self.counts = array.array(REG_ARRAY_TYPE)
+
+    def add(self, pc):
+        slot = self.slots.get(pc)
+        if slot is None:
+            self.slots[pc] = len(self.pcs)
+            self.pcs.append(pc)
+            self.counts.append(1)
+        else:
+            self.counts[slot] += 1
+
+    def top(self, count):
+        order = sorted(range(len(self.pcs)), key=lambda i: self.counts[i], reverse=True)
+        return [(self.pcs[i], self.counts[i]) for i in order[:count]]
+
+
+def run_to_address(context, addr):
+    '''
+        Continues the process synchronously (stop hook suppressed) until
+        addr through a one-shot breakpoint. Returns True if the thread
+        stopped there.
+    '''
+    target = context.target
+    bp = target.BreakpointCreateByAddress(addr)
+    bp.SetOneShot(True)
+    was_async = lldb.debugger.GetAsync()
+    lldb.debugger.SetAsync(False)
+    suppress_hook(True)
+    try:
+        context.process.Continue()
+    finally:
+        suppress_hook(False)
+        lldb.debugger.SetAsync(was_async)
+    target.BreakpointDelete(bp.GetID())
+    if context.process.GetState() != lldb.eStateStopped:
+        return False
+    return context.thread.GetFrameAtIndex(0).GetPC() == addr
+
+
+def icount(debugger, command, result, dict):
+    '''
+        Count the instructions executed from start to end (calls
+        included) by single stepping with the context suppressed, then
+        show the total, the steps per second and the hottest addresses.
+        When pc isn't at start the process first runs to it. Stepping
+        stops after budget instructions (ICOUNT_BUDGET by default).
+
+        Example:
+            icount 0x100000f10 0x100000f60
+            icount my_func 0x100000f60 50000
+            icount $pc 0x100000f60 50000 40    (top 40 addresses)
+    '''
+    out = OutputBuffer()
+    context = get_stop()
+    target = context.target
+
+    cmd = command.split()
+    budget = ICOUNT_BUDGET
+    top = ICOUNT_TOP
+    try:
+        if len(cmd) >= 3:
+            budget = int(cmd[2], 0)
+        if len(cmd) == 4:
+            top = int(cmd[3], 0)
+    except ValueError:
+        cmd = []
+    if len(cmd) not in (2, 3, 4):
+        out.write("icount <start> <end> [budget] [top]")
+        out.flush(result)
+        return
+    start = resolve_address(out, target, cmd[0])
+    end = resolve_address(out, target, cmd[1])
+    if start is None or end is None:
+        out.flush(result)
+        return
+
+    if context.frame.GetPC() != start:
+        if run_to_address(context, start) is False:
+            out.write("Didn't reach 0x%x" % start)
+            out.flush(result)
+            result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+            return
+        context = get_stop()
+
+    hist = PCHistogram()
+    hist.add(start)
+    steps, met, elapsed = step_instructions(
+        context, lambda frame: frame.GetPC() == end, budget,
+        lambda frame: hist.add(frame.GetPC()))
+
+    out.write("%d instructions from 0x%x to 0x%x%s, %d addresses\n" % (
+        steps, start, end, not met and " (end not reached)" or "",
+        len(hist.pcs)))
+    out.write("%.3f s, %.0f steps/s\n" % (elapsed, steps / elapsed))
+    for pc, count in hist.top(top):
+        out.write("%10d %5.1f%%  0x%x %s\n" % (count, count * 100.0 / max(steps, 1),
+                  pc, symbolicate(target, pc)))
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def wlog_callback(frame, wp, dict):
+    '''
+        Watchpoint callback of wlog. Reads only the watched bytes,
+        appends (watchpoint, thread, pc, old, new) to the log and returns
+        False so the process continues without rendering a context.
+    '''
+    watch = WatchLogRanges.get(wp.GetID())
+    if watch is None:
+        return False
+    addr, size, old = watch
+    err = lldb.SBError()
+    new = frame.GetThread().GetProcess().ReadMemory(addr, size, err)
+    if err.Fail():
+        new = None
+    else:
+        WatchLogRanges[wp.GetID()] = (addr, size, new)
+    with StateLock:
+        WatchLog.append((wp.GetID(), frame.GetThread().GetThreadID(),
+                         frame.GetPC(), old, new))
+    return False
+
+
+def wlog_hex(data):
+    if data is None:
+        return "??"
+    return binascii.hexlify(data).decode("ascii")
+
+
+def wlog(debugger, command, result, dict):
+    '''
+        Log accesses to memory with a hardware watchpoint which continues
+        by itself. Each hit records the thread, the pc after the access
+        and the watched bytes before and after it in a ring buffer of
+        WLOG_SIZE entries.
+
+        Example:
+            wlog $rdi+8 8          (writes, default)
+            wlog 0x100008010 4 rw
+            wlog show              (last 50 accesses)
+            wlog show 500
+            wlog off               (remove the wlog watchpoints)
+    '''
+    out = OutputBuffer()
+    target = lldb.debugger.GetSelectedTarget()
+
+    cmd = command.split()
+    if len(cmd) in (1, 2) and cmd[0] == "show":
+        count = 50
+        if len(cmd) == 2:
+            try:
+                count = int(cmd[1], 0)
+            except ValueError:
+                pass
+        with StateLock:
+            entries = list(WatchLog)[-count:]
+        for wp_id, tid, pc, old, new in entries:
+            out.write("wp %d tid 0x%x pc 0x%x %s : %s -> %s\n" % (
+                wp_id, tid, pc, symbolicate(target, pc), wlog_hex(old),
+                wlog_hex(new)))
+        out.write("%d of %d logged accesses" % (len(entries), len(WatchLog)))
+    elif len(cmd) == 1 and cmd[0] == "off":
+        for wp_id in list(WatchLogRanges):
+            target.DeleteWatchpoint(wp_id)
+        out.write("Removed %d watchpoints" % len(WatchLogRanges))
+        WatchLogRanges.clear()
+    elif len(cmd) == 2 or len(cmd) == 3 and cmd[2] in ("r", "w", "rw"):
+        mode = len(cmd) == 3 and cmd[2] or "w"
+        try:
+            size = int(cmd[1], 0)
+        except ValueError:
+            out.write("Bad length : " + cmd[1])
+            out.flush(result)
+            return
+        addr = dump_address(out, cmd[0])
+        if addr is None:
+            out.flush(result)
+            return
+        err = lldb.SBError()
+        wp = target.WatchAddress(addr, size, "r" in mode, "w" in mode, err)
+        if err.Fail() or wp.IsValid() is False:
+            out.write("Can't watch %d bytes at 0x%x : %s" % (size, addr, err))
+            out.flush(result)
+            return
+        err = lldb.SBError()
+        old = target.GetProcess().ReadMemory(addr, size, err)
+        WatchLogRanges[wp.GetID()] = (addr, size, err.Success() and old or None)
+        res = lldb.SBCommandReturnObject()
+        lldb.debugger.GetCommandInterpreter().HandleCommand(
+            "watchpoint command add -F lldbinit.wlog_callback %d" % wp.GetID(), res)
+        out.write("Watchpoint %d logs %s accesses to 0x%x-0x%x" % (
+            wp.GetID(), mode, addr, addr + size))
+    else:
+        out.write("wlog <expr> <len> [r|w|rw] | show [count] | off")
+
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+class DataLayout(object):
+    '''
+        A structure layout compiled to one struct.Struct. fields holds
+        (name, offset, kind, count) in unpack order, kind being a DT_TYPES
+        name, "char" for char arrays or "raw" for other bytes.
+    '''
+    def __init__(self, name, size, fields, endian="<", ptr="Q"):
+        self.name = name
+        types = dict(DT_TYPES, ptr=ptr)
+        fmt = endian
+        pos = 0
+        self.fields = []
+        for field, offset, kind, count in sorted(fields, key=lambda f: f[1]):
+            if offset < pos:
+                # unions and bitfields overlap the previous field
+                continue
+            if offset > pos:
+                fmt += "%dx" % (offset - pos)
+            if kind in types:
+                fmt += "%d%s" % (count, types[kind])
+                pos = offset + count * struct.calcsize("<" + types[kind])
+            else:
+                fmt += "%ds" % count
+                pos = offset + count
+            self.fields.append((field, offset, kind, count))
+        if size > pos:
+            fmt += "%dx" % (size - pos)
+        self.struct = struct.Struct(fmt)
+
+    def unpack(self, data):
+        if hasattr(self.struct, "iter_unpack"):
+            return self.struct.iter_unpack(data)
+        return (self.struct.unpack_from(data, i)
+                for i in range(0, len(data), self.struct.size))
+
+    def render(self, out, values):
+        index = 0
+        for field, offset, kind, count in self.fields:
+            if kind in DT_TYPES:
+                value = values[index:index + count]
+                index += count
+                if kind in ("float", "double"):
+                    text = ", ".join("%g" % v for v in value)
+                else:
+                    text = ", ".join("0x%x" % v for v in value)
+                if count > 1:
+                    text = "[" + text + "]"
+            else:
+                value = values[index]
+                index += 1
+                if kind == "char":
+                    text = '"' + quotechars(value.split(b"\x00")[0].decode("latin-1")) + '"'
+                else:
+                    text = binascii.hexlify(value).decode("ascii")
+            out.write("%s0x%.04x%s %-20s : %s\n" % (out.theme.bold, offset, out.theme.reset,
+                                                   field, text))
+
+
+def dt_sbtype_fields(sbtype):
+    '''
+        Returns the (name, offset, kind, count) fields of a debug info type.
+    '''
+    fields = []
+    for i in range(sbtype.GetNumberOfFields()):
+        member = sbtype.GetFieldAtIndex(i)
+        if member.IsBitfield():
+            continue
+        ftype = member.GetType().GetCanonicalType()
+        size = ftype.GetByteSize()
+        basic = ftype.GetBasicType()
+        if ftype.IsPointerType():
+            kind = "ptr"
+        elif basic == lldb.eBasicTypeFloat and size == 4:
+            kind = "float"
+        elif basic == lldb.eBasicTypeDouble and size == 8:
+            kind = "double"
+        elif ftype.IsArrayType() and ftype.GetArrayElementType().GetByteSize() == 1:
+            kind = "char"
+        elif size in (1, 2, 4, 8) and ftype.GetNumberOfFields() == 0:
+            kind = "u%d" % (size * 8)
+        else:
+            kind = "raw"
+        count = kind in DT_TYPES and 1 or size
+        fields.append((member.GetName() or "<anonymous>", member.GetOffsetInBytes(), kind, count))
+    return fields
+
+
+def dt_parse_file(out, path, ptr):
+    '''
+        Reads the user layouts of path, one field per line:
+            <layout> <offset> <type>[count] <field>
+        and optionally "<layout> size <size>" for the stride. Types are the
+        DT_TYPES names (ptr has the pointer size of the target, struct
+        format ptr), char[n] for strings or raw[n] for bytes. Bad lines
+        are reported into out and skipped.
+    '''
+    types = dict(DT_TYPES, ptr=ptr)
+    layouts = OrderedDict()
+    sizes = {}
+    with open(path) as f:
+        for number, text in enumerate(f, 1):
+            line = text.split("#")[0].split()
+            if len(line) == 0:
+                continue
+            try:
+                if len(line) == 3 and line[1] == "size":
+                    sizes[line[0]] = int(line[2], 0)
+                    if sizes[line[0]] < 0:
+                        raise ValueError
+                    continue
+                match = len(line) == 4 and re.match(r"^(\w+)(?:\[(\w+)\])?$", line[2])
+                if not match or (match.group(1) not in types and match.group(1) not in ("char", "raw")):
+                    raise ValueError
+                offset = int(line[1], 0)
+                count = 1
+                if match.group(2) is not None:
+                    count = int(match.group(2), 0)
+                if offset < 0 or count < 0:
+                    raise ValueError
+                layouts.setdefault(line[0], []).append((line[3], offset, match.group(1), count))
+            except ValueError:
+                out.write("%s:%d: bad layout line : %s\n" % (path, number, text.strip()))
+    result = {}
+    for name, fields in layouts.items():
+        end = max(offset + (kind in types and struct.calcsize("<" + types[kind]) or 1) * count
+                  for field, offset, kind, count in fields)
+        size = max(sizes.get(name, 0), end)
+        if size == 0:
+            out.write("%s: empty layout : %s\n" % (path, name))
+            continue
+        result[name] = DataLayout(name, size, fields, ptr=ptr)
+    return result
+
+
+def get_layout(out, target, name):
+    '''
+        Returns the DataLayout of name, from DT_FILE first and then from the
+        debug info of target. Layouts are compiled once; the file is parsed
+        again only when it changes or the pointer size does.
+    '''
+    ptr = target.GetAddressByteSize() == 4 and "I" or "Q"
+    try:
+        stamp = (os.path.getmtime(DT_FILE), ptr)
+    except OSError:
+        stamp = None
+    if stamp != DtLayouts["stamp"]:
+        DtLayouts["stamp"] = stamp
+        try:
+            DtLayouts["file"] = stamp is not None and dt_parse_file(out, DT_FILE, ptr) or {}
+        except IOError as e:
+            out.write("Can't read %s : %s\n" % (DT_FILE, e))
+            DtLayouts["file"] = {}
+    layout = DtLayouts["file"].get(name)
+    if layout is not None:
+        return layout
+    key = (target.GetExecutable().GetFilename(), name)
+    layout = DtLayouts["types"].get(key)
+    if layout is None:
+        sbtype = target.FindFirstType(name)
+        if sbtype.IsValid() is False or sbtype.GetNumberOfFields() == 0:
+            return None
+        endian = target.GetByteOrder() == lldb.eByteOrderBig and ">" or "<"
+        layout = DataLayout(name, sbtype.GetByteSize(), dt_sbtype_fields(sbtype), endian, ptr)
+        DtLayouts["types"][key] = layout
+    return layout
+
+
+def dt(debugger, command, result, dict):
+    '''
+        Display memory as a structure. The layout comes from ~/.lldbinit/layouts
+        (see dt_parse_file) or from the debug info of the target. With a
+        count the array of structures is decoded from a single read.
+
+        Example:
+            dt mach_header_64 0x100000000
+            dt my_node $rdi 4
+    '''
+    out = OutputBuffer()
+    target = lldb.debugger.GetSelectedTarget()
+
+    cmd = command.split()
+    if len(cmd) not in (2, 3):
+        out.write("dt <layout> <addr> [count]")
+        out.flush(result)
+        return
+    layout = get_layout(out, target, cmd[0])
+    if layout is None:
+        out.write("Unknown layout : " + cmd[0])
+        out.flush(result)
+        return
+    count = 1
+    if len(cmd) == 3:
+        try:
+            count = int(cmd[2], 0)
+        except ValueError:
+            count = 0
+        if count < 1:
+            out.write("Bad count : " + cmd[2])
+            out.flush(result)
+            return
+    addr = dump_address(out, cmd[1])
+    if addr is None:
+        out.flush(result)
+        return
+
+    size = layout.struct.size * count
+    membuff = get_stop().read_memory(addr, size)
+    if membuff is None or len(membuff) < size:
+        out.write("Can't read 0x%x bytes at 0x%x" % (size, addr))
+        out.flush(result)
+        return
+
+    for index, values in enumerate(layout.unpack(membuff)):
+        out.color(BLUE)
+        out.write("[%s 0x%x]" % (layout.name, addr + index * layout.struct.size))
+        if count > 1:
+            out.write(" #%d" % index)
+        out.reset()
+        out.write("\n")
+        layout.render(out, values)
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+def bt2_read_chunk(process, addr, ptr):
+    '''
+        Reads the stack from addr in one BT2_CHUNK read, falling back to
+        the end of the page and then to a single frame record.
+    '''
+    err = lldb.SBError()
+    for size in (BT2_CHUNK, 0x1000 - (addr & 0xfff), 2 * ptr):
+        if size < 2 * ptr:
+            continue
+        data = process.ReadMemory(addr, size, err)
+        if err.Success():
+            return data
+    return None
+
+
+def bt2_walk_fp(process, fp, ptr, limit):
+    '''
+        Returns the return addresses found by following the chain of
+        saved frame pointers from fp, each record being [saved fp,
+        return address]. The stack is read in chunks rather than one
+        record at a time.
+    '''
+    fmt = ptr == 4 and "<II" or "<QQ"
+    # the low bit of an ARM return address is the Thumb state
+    mask = is_arm() and ~1 or ~0
+    frames = []
+    base = 0
+    data = b""
+    while fp != 0 and len(frames) < limit:
+        if fp < base or fp + 2 * ptr > base + len(data):
+            data = bt2_read_chunk(process, fp, ptr)
+            if data is None:
+                break
+            base = fp
+        next_fp, ret = struct.unpack_from(fmt, data, fp - base)
+        if ret == 0:
+            break
+        frames.append(ret & mask)
+        # the stack grows down, a saved fp below the current one is garbage
+        if next_fp <= fp:
+            break
+        fp = next_fp
+    return frames
+
+
+def get_backtrace(stop, use_fp):
+    '''
+        Returns the pcs of the backtrace of the stopped thread, from the
+        frames of lldb or from the frame pointer chain when use_fp is set
+        or lldb couldn't unwind past the first frames (stripped code).
+        Backtraces are kept in the StopContext, so repeating bt2 at the
+        same stop doesn't unwind again.
+    '''
+    frames = stop.backtraces.get(use_fp)
+    if frames is not None:
+        return frames
+    thread = stop.thread
+    frames = []
+    if use_fp is False:
+        count = min(thread.GetNumFrames(), BT2_MAX)
+        frames = [thread.GetFrameAtIndex(i).GetPC() for i in range(count)]
+    if len(frames) < 3:
+        regs = stop.regs
+        pc = regs.get(get_pc_name(), stop.frame.GetPC())
+        fp = 0
+        for name in BT2_FP_REGS:
+            if name in regs:
+                fp = regs[name]
+                break
+        frames = [pc] + bt2_walk_fp(stop.process, fp, stop.target.GetAddressByteSize(), BT2_MAX)
+    stop.backtraces[use_fp] = frames
+    return frames
+
+
+def bt2_symbol(stop, addr):
+    name = stop.symbols.get(addr)
+    if name is None:
+        name = symbolicate(stop.target, addr)
+        stop.symbols[addr] = name
+    return name
+
+
+def bt2_stream(result):
+    '''
+        Makes the output appended to result appear as it is added, so a
+        deep backtrace is printed while it is rendered.
+    '''
+    try:
+        result.SetImmediateOutputFile(lldb.debugger.GetOutputFileHandle())
+    except Exception:
+        pass
+
+
+def bt2(debugger, command, result, dict):
+    '''
+        Compact backtrace of the selected thread. Frames come from lldb,
+        or from the frame pointer chain with --fp or when lldb can't
+        unwind. Runs of the same frame (recursion) are folded into one
+        line.
+
+        Example:
+            bt2
+            bt2 20
+            bt2 --fp
+    '''
+    out = OutputBuffer()
+    stop = get_stop()
+
+    cmd = command.split()
+    use_fp = "--fp" in cmd
+    if use_fp is True:
+        cmd.remove("--fp")
+    count = BT2_MAX
+    try:
+        if len(cmd) == 1:
+            count = int(cmd[0], 0)
+    except ValueError:
+        cmd = [None, None]
+    if len(cmd) > 1:
+        out.write("bt2 [count] [--fp]")
+        out.flush(result)
+        return
+
+    frames = get_backtrace(stop, use_fp)[:count]
+    if len(frames) > BT2_FLUSH:
+        bt2_stream(result)
+    bold = out.theme.bold
+    reset = out.theme.reset
+    fmt = "0x%%.0%dx" % (stop.target.GetAddressByteSize() * 2)
+    lines = 0
+    i = 0
+    while i < len(frames):
+        j = i + 1
+        while j < len(frames) and frames[j] == frames[i]:
+            j += 1
+        out.write("%s#%-4d%s " % (bold, i, reset))
+        out.color(BLUE)
+        out.write(fmt % frames[i])
+        out.reset()
+        out.write(" " + bt2_symbol(stop, frames[i]))
+        if j - i > 1:
+            out.color(YELLOW)
+            out.write(" (x%d, #%d-#%d)" % (j - i, i, j - 1))
+            out.reset()
+        out.write("\n")
+        lines += 1
+        if lines % BT2_FLUSH == 0:
+            out.flush(result)
+            out = OutputBuffer()
+        i = j
+    out.write("%d frames%s" % (len(frames), use_fp and " (frame pointers)" or ""))
+    out.flush(result)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+
+
+ArchInfo = namedtuple("ArchInfo",
+                      "triple arch pointer_size pc sp fp big_endian")
+
+
+def get_arch_info():
+    '''
+        Returns the ArchInfo of the selected target, built once per triple.
+    '''
+    target = lldb.debugger.GetSelectedTarget()
+    triple = target.GetTriple() or ""
+    info = ArchInfos.get(triple)
+    if info is None:
+        arch = triple.split("-")[0]
+        if arch.startswith("i"):
+            names = ("eip", "esp", "ebp")
+        elif arch == "x86_64" or arch == "x86_64h":
+            names = ("rip", "rsp", "rbp")
+        elif arch.startswith("arm64") or arch == "aarch64":
+            names = ("pc", "sp", "fp")
+        else:
+            names = ("pc", "sp", "r7")
+        info = ArchInfo(triple, arch, target.GetAddressByteSize(), names[0], names[1],
+                        names[2], target.GetByteOrder() == lldb.eByteOrderBig)
+        ArchInfos[triple] = info
+    return info
+
+
+class api(object):
+    '''
+        Stable entry points for other lldb scripts, so they share the
+        caches of lldbinit instead of making their own SB calls:
+
+            import lldbinit
+            regs = lldbinit.api.registers()
+            data = lldbinit.api.read_memory(regs["rsp"], 0x40)
+
+        Everything per stop (registers, memory, disassembly, backtrace,
+        symbol names) lives in the StopContext of the stop and is dropped
+        when the process resumes or another thread is selected. A script
+        that writes registers or memory itself calls invalidate(), which
+        also drops the memory prefetched by remote mode. Symbol indexes
+        are kept per module UUID for the whole session. Returned
+        dicts and lists are shared and must not be modified.
+    '''
+    VERSION = 1
+
+    @staticmethod
+    def stop():
+        return get_stop()
+
+    @staticmethod
+    def arch():
+        return get_arch_info()
+
+    @staticmethod
+    def registers():
+        return get_stop().regs
+
+    @staticmethod
+    def register(name):
+        return get_stop().regs.get(name)
+
+    @staticmethod
+    def read_memory(addr, size):
+        return get_stop().read_memory(addr, size)
+
+    @staticmethod
+    def disassemble(addr, count):
+        return get_stop().disassemble(addr, count)
+
+    @staticmethod
+    def backtrace(use_fp=False):
+        return get_backtrace(get_stop(), use_fp)
+
+    @staticmethod
+    def symbol_index(module):
+        '''
+            SymbolIndex of module, an SBModule or the file name of one.
+        '''
+        if isinstance(module, str):
+            module = find_module(lldb.debugger.GetSelectedTarget(), module)
+            if module is None:
+                return None
+        return get_symbol_index(module)
+
+    @staticmethod
+    def symbolicate(addr):
+        return bt2_symbol(get_stop(), addr)
+
+    @staticmethod
+    def invalidate():
+        global CurrentStop
+        with StateLock:
+            CurrentStop = None
+            if RemoteMode is not None:
+                RemoteMode.invalidate()
+
+    @staticmethod
+    def stats():
+        return dict(HookStats)
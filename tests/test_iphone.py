@@ -0,0 +1,142 @@
+'''
+    Tests of iphone connect: the host preflight and the retries of process
+    connect with exponential backoff. lldbinit is loaded against a small
+    stand-in lldb module whose command interpreter records the commands
+    and fails process connect a given number of times.
+
+    Run with: python -m unittest discover tests
+'''
+import os
+import socket
+import sys
+import types
+import unittest
+
+try:
+    import thread
+except ImportError:
+    import _thread as thread
+    sys.modules["thread"] = thread
+
+
+# one stand-in lldb module is shared by the test modules, as lldbinit is
+# imported only once
+lldb = sys.modules.get("lldb") or types.ModuleType("lldb")
+lldb.eReturnStatusSuccessFinishResult = 2
+lldb.eStopReasonNone = 0
+lldb.LLDB_INVALID_ADDRESS = 0xffffffffffffffff
+sys.modules["lldb"] = lldb
+
+
+class SBCommandReturnObject(object):
+    def __init__(self):
+        self.succeeded = True
+        self.error = ""
+
+    def Succeeded(self):
+        return self.succeeded
+
+    def GetError(self):
+        return self.error
+
+    def GetOutput(self):
+        return ""
+
+
+class CommandInterpreter(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.commands = []
+
+    def HandleCommand(self, command, res):
+        self.commands.append(command)
+        if command.startswith("process connect") and self.failures > 0:
+            self.failures -= 1
+            res.succeeded = False
+            res.error = "error: failed to connect to port\n"
+
+
+class Debugger(object):
+    def __init__(self, failures):
+        self.interpreter = CommandInterpreter(failures)
+
+    def GetCommandInterpreter(self):
+        return self.interpreter
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lldbinit  # noqa: E402
+
+
+class IphoneConnectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = {"debugger": getattr(lldb, "debugger", None),
+                      "SBCommandReturnObject": getattr(lldb, "SBCommandReturnObject", None)}
+        lldb.SBCommandReturnObject = SBCommandReturnObject
+        self.sleep = lldbinit.time.sleep
+        self.delays = []
+        lldbinit.time.sleep = self.delays.append
+
+    def tearDown(self):
+        lldbinit.time.sleep = self.sleep
+        for name, value in self.saved.items():
+            setattr(lldb, name, value)
+
+    def connect(self, failures, retries):
+        lldb.debugger = Debugger(failures)
+        out = lldbinit.OutputBuffer()
+        connected = lldbinit.iphone_connect(out, "192.168.0.2:5555", 7, retries)
+        return connected, out.getvalue(), lldb.debugger.interpreter.commands
+
+    def test_connects_first_time(self):
+        connected, output, commands = self.connect(0, 4)
+        self.assertTrue(connected)
+        self.assertEqual(output, "")
+        self.assertEqual(self.delays, [])
+        self.assertEqual(commands, [
+            "settings set plugin.process.gdb-remote.packet-timeout 7",
+            "process connect connect://192.168.0.2:5555"])
+
+    def test_retries_with_backoff(self):
+        connected, output, commands = self.connect(2, 4)
+        self.assertTrue(connected)
+        self.assertEqual(len(commands), 4)
+        self.assertEqual(self.delays, [lldbinit.IPHONE_BACKOFF, lldbinit.IPHONE_BACKOFF * 2])
+        self.assertEqual(output, "Attempt 1/4 failed : error: failed to connect to port\n"
+                                 "Attempt 2/4 failed : error: failed to connect to port\n")
+
+    def test_gives_up_after_retries(self):
+        connected, output, commands = self.connect(10, 3)
+        self.assertFalse(connected)
+        self.assertEqual(len(commands), 1 + 3)
+        # no wait after the last attempt
+        self.assertEqual(self.delays, [lldbinit.IPHONE_BACKOFF, lldbinit.IPHONE_BACKOFF * 2])
+        self.assertIn("Attempt 3/3 failed", output)
+
+
+class IphonePreflightTest(unittest.TestCase):
+
+    def test_routable_host_sends_nothing(self):
+        # nothing listens on the port, a TCP probe would be refused
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        self.assertIsNone(lldbinit.iphone_preflight("127.0.0.1", port))
+
+    def test_unresolvable_host(self):
+        getaddrinfo = lldbinit.socket.getaddrinfo
+
+        def fail(*args):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        lldbinit.socket.getaddrinfo = fail
+        try:
+            error = lldbinit.iphone_preflight("no-such-device.local", 5555)
+        finally:
+            lldbinit.socket.getaddrinfo = getaddrinfo
+        self.assertIn("Name or service not known", error)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+'''
+    Tests of remote mode: the memory RemoteSession prefetches around pc
+    and sp at a stop, the reads it serves from it and the gdb-remote
+    packets it counts from lldb's packet log. lldbinit is loaded against
+    a small stand-in lldb module.
+
+    Run with: python -m unittest discover tests
+'''
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+try:
+    import thread
+except ImportError:
+    import _thread as thread
+    sys.modules["thread"] = thread
+
+
+# one stand-in lldb module is shared by the test modules, as lldbinit is
+# imported only once
+lldb = sys.modules.get("lldb") or types.ModuleType("lldb")
+lldb.eReturnStatusSuccessFinishResult = 2
+lldb.eStopReasonNone = 0
+lldb.LLDB_INVALID_ADDRESS = 0xffffffffffffffff
+sys.modules["lldb"] = lldb
+
+
+class SBError(object):
+    def __init__(self):
+        self.failed = False
+
+    def Success(self):
+        return not self.failed
+
+    def Fail(self):
+        return self.failed
+
+
+class Process(object):
+    '''
+        Memory is readable from 0x1000, each byte is its address & 0xff.
+    '''
+    def __init__(self):
+        self.stop_id = 1
+        self.reads = []
+
+    def GetStopID(self):
+        return self.stop_id
+
+    def ReadMemory(self, addr, size, err):
+        self.reads.append((addr, size))
+        if addr < 0x1000:
+            err.failed = True
+            return None
+        return bytes(bytearray((addr + i) & 0xff for i in range(size)))
+
+
+class Target(object):
+    triple = "x86_64-apple-macosx"
+
+    def __init__(self, process):
+        self.process = process
+
+    def GetProcess(self):
+        return self.process
+
+
+class Debugger(object):
+    def __init__(self, target):
+        self.target = target
+
+    def GetSelectedTarget(self):
+        return self.target
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lldbinit  # noqa: E402
+
+
+WINDOW = 0x100
+PC = 0x100000f10
+SP = 0x7fff0000
+
+
+class RemoteSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.process = Process()
+        stand_ins = {"debugger": Debugger(Target(self.process)), "SBError": SBError}
+        self.saved = dict((name, getattr(lldb, name, None)) for name in stand_ins)
+        for name, value in stand_ins.items():
+            setattr(lldb, name, value)
+        self.tmp = tempfile.mkdtemp()
+        self.session = lldbinit.RemoteSession(WINDOW, os.path.join(self.tmp, "packets.log"))
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(lldb, name, value)
+        shutil.rmtree(self.tmp)
+
+    def prefetch(self):
+        self.session.prefetch(self.process, {"rip": PC, "rsp": SP})
+
+    def test_prefetch_reads_each_window_once_per_stop(self):
+        self.prefetch()
+        self.assertEqual(self.process.reads, [(SP - WINDOW // 4, WINDOW),
+                                              (PC - WINDOW // 2, WINDOW)])
+        self.assertEqual(self.session.prefetched, 2 * WINDOW)
+        self.prefetch()
+        self.assertEqual(len(self.process.reads), 2)
+        self.process.stop_id += 1
+        self.prefetch()
+        self.assertEqual(len(self.process.reads), 4)
+
+    def test_prefetch_skips_unreadable_windows(self):
+        self.session.prefetch(self.process, {"rip": 0x10, "rsp": SP})
+        self.assertEqual([start for start, data in self.session.windows], [SP - WINDOW // 4])
+        self.assertEqual(self.session.prefetched, WINDOW)
+        self.assertIsNone(self.session.read_memory(0x10, 4))
+
+    def test_read_memory_hit(self):
+        self.prefetch()
+        reads = len(self.process.reads)
+        data = self.session.read_memory(PC, 4)
+        self.assertEqual(data, bytes(bytearray([0x10, 0x11, 0x12, 0x13])))
+        self.assertEqual(self.session.read_memory(SP + 0x10, 8), bytes(bytearray(range(0x10, 0x18))))
+        self.assertEqual(self.session.hits, 2)
+        self.assertEqual(self.session.misses, 0)
+        self.assertEqual(len(self.process.reads), reads)
+
+    def test_read_memory_miss(self):
+        self.prefetch()
+        # outside of both windows and across the end of the pc window
+        self.assertIsNone(self.session.read_memory(0x5000, 4))
+        self.assertIsNone(self.session.read_memory(PC + WINDOW // 2 - 2, 4))
+        self.assertEqual(self.session.misses, 2)
+        self.assertEqual(self.session.hits, 0)
+
+    def test_read_memory_misses_after_resume(self):
+        self.prefetch()
+        self.process.stop_id += 1
+        self.assertIsNone(self.session.read_memory(PC, 4))
+        self.assertEqual(self.session.misses, 1)
+
+    def test_invalidate_drops_windows(self):
+        self.prefetch()
+        self.session.invalidate()
+        self.assertIsNone(self.session.read_memory(PC, 4))
+        self.prefetch()
+        self.assertEqual(len(self.process.reads), 4)
+
+    def test_count_packets_since_last_call(self):
+        self.assertEqual(self.session.count_packets(), 0)
+        self.assertEqual(self.session.stops, 0)
+        f = open(self.session.log, "w")
+        f.write("p1 send packet: $qC#b4\n"
+                "p1 read packet: $QC1f03#00\n"
+                "p1 send packet: $g#67\n")
+        f.close()
+        self.assertEqual(self.session.count_packets(), 2)
+        self.assertEqual(self.session.count_packets(), 0)
+        f = open(self.session.log, "a")
+        f.write("p1 send packet: $m1000,100#00\n")
+        f.close()
+        self.assertEqual(self.session.count_packets(), 1)
+        self.assertEqual(self.session.stops, 3)
+        self.assertEqual(self.session.packets, 3)
+        self.assertEqual(self.session.last_packets, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
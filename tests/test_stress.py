@@ -0,0 +1,294 @@
+'''
+    Stress test of the state shared between commands, the stop hook and
+    breakpoint/watchpoint callbacks. lldbinit is loaded against a small
+    stand-in lldb module, callbacks are driven from several threads (as
+    lldb runs them on its own threads) while commands run on the main one.
+
+    Run with: python -m unittest discover tests
+'''
+import os
+import sys
+import tempfile
+import threading
+import types
+import unittest
+
+try:
+    import thread
+except ImportError:
+    import _thread as thread
+    sys.modules["thread"] = thread
+
+
+# one stand-in lldb module is shared by the test modules, as lldbinit is
+# imported only once
+lldb = sys.modules.get("lldb") or types.ModuleType("lldb")
+lldb.eReturnStatusSuccessFinishResult = 2
+lldb.eStopReasonNone = 0
+lldb.LLDB_INVALID_ADDRESS = 0xffffffffffffffff
+
+
+class SBError(object):
+    def Success(self):
+        return True
+
+    def Fail(self):
+        return False
+
+
+class SBCommandReturnObject(object):
+    def __init__(self):
+        self.out = []
+
+    def PutCString(self, s):
+        self.out.append(s)
+
+    def SetStatus(self, status):
+        pass
+
+    def GetOutput(self):
+        return "".join(self.out)
+
+
+class Value(object):
+    def __init__(self, value):
+        self.value = value
+
+    def GetValueAsUnsigned(self):
+        return self.value
+
+
+class Symbol(object):
+    def GetName(self):
+        return "OBJC_CLASS_$_Foo"
+
+
+class Address(object):
+    def GetSymbol(self):
+        return Symbol()
+
+
+class Process(object):
+    def __init__(self):
+        self.stop_id = 1
+
+    def GetProcessID(self):
+        return 42
+
+    def GetStopID(self):
+        return self.stop_id
+
+    def GetSelectedThread(self):
+        return THREAD
+
+    def ReadMemory(self, addr, size, err):
+        return bytes(bytearray((addr + i) & 0xff for i in range(size)))
+
+    def ReadPointerFromMemory(self, addr, err):
+        return 0x1000
+
+    def ReadCStringFromMemory(self, addr, size, err):
+        return "sel%d" % (addr & 0xf)
+
+
+class Frame(object):
+    def __init__(self, frame_id):
+        self.frame_id = frame_id
+
+    def GetFrameID(self):
+        return self.frame_id
+
+    def GetPC(self):
+        return 0x1000 + self.frame_id
+
+    def GetSP(self):
+        return 0x8000
+
+    def GetThread(self):
+        return THREAD
+
+    def FindRegister(self, name):
+        return Value(0x2000)
+
+
+class Thread(object):
+    def __init__(self):
+        self.frame = Frame(0)
+
+    def GetThreadID(self):
+        return 0x100
+
+    def GetProcess(self):
+        return PROCESS
+
+    def GetSelectedFrame(self):
+        return self.frame
+
+
+class Breakpoint(object):
+    def AddName(self, name):
+        return True
+
+    def SetScriptCallbackFunction(self, name):
+        pass
+
+    def GetNumLocations(self):
+        return 1
+
+
+class Target(object):
+    triple = "x86_64-apple-macosx"
+
+    def GetProcess(self):
+        return PROCESS
+
+    def GetNumModules(self):
+        return 0
+
+    def BreakpointCreateByName(self, name):
+        return Breakpoint()
+
+    def ResolveLoadAddress(self, addr):
+        return Address()
+
+    def breakpoint_iter(self):
+        return iter(())
+
+
+class Debugger(object):
+    def GetSelectedTarget(self):
+        return TARGET
+
+
+class Watchpoint(object):
+    def GetID(self):
+        return 1
+
+
+PROCESS = Process()
+THREAD = Thread()
+TARGET = Target()
+lldb.SBError = SBError
+lldb.SBCommandReturnObject = SBCommandReturnObject
+lldb.debugger = Debugger()
+sys.modules["lldb"] = lldb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lldbinit  # noqa: E402
+
+
+HAMMER_THREADS = 4
+ROUNDS = 200
+
+
+class StressTest(unittest.TestCase):
+
+    def hammer(self, callback):
+        '''
+            Calls callback from HAMMER_THREADS threads until the returned
+            stop function is called, which joins them and reraises the
+            first exception of a thread.
+        '''
+        done = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                while not done.is_set():
+                    callback()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(HAMMER_THREADS)]
+        for t in threads:
+            t.start()
+
+        def stop():
+            done.set()
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+        return stop
+
+    def test_wlog(self):
+        lldbinit.WatchLogRanges[1] = (0x2000, 4, b"\0\0\0\0")
+        stop = self.hammer(lambda: lldbinit.wlog_callback(THREAD.frame, Watchpoint(), {}))
+        try:
+            for i in range(ROUNDS):
+                result = SBCommandReturnObject()
+                lldbinit.wlog(None, "show 5", result, {})
+                self.assertIn("logged accesses", result.GetOutput())
+        finally:
+            stop()
+        lldbinit.WatchLogRanges.clear()
+
+    def test_msgtrace_stop_while_tracing(self):
+        for i in range(20):
+            path = os.path.join(tempfile.mkdtemp(), "msgtrace.log")
+            out = lldbinit.OutputBuffer()
+            lldbinit.msgtrace_start(out, TARGET, None, path)
+            stop = self.hammer(lambda: lldbinit.msgtrace_callback(THREAD.frame, None, {}))
+            try:
+                lldbinit.msgtrace_stop(out, TARGET)
+            finally:
+                stop()
+            self.assertIsNone(lldbinit.MsgTrace)
+
+    def test_calltrace(self):
+        trace = {"slots": {0x1000: 0}, "names": ["a.out`main"], "addrs": [0x1000],
+                 "callers": {}, "hits": 0, "time": 0.0, "lr": None,
+                 "counts": [0]}
+        lldbinit.CallTrace = trace
+        stop = self.hammer(lambda: lldbinit.calltrace_callback(THREAD.frame, None, {}))
+        try:
+            for i in range(ROUNDS):
+                with lldbinit.StateLock:
+                    self.assertEqual(trace["counts"][0], trace["hits"])
+        finally:
+            stop()
+            lldbinit.calltrace_stop(lldbinit.OutputBuffer(), TARGET)
+        self.assertEqual(sum(trace["callers"].values()), trace["hits"])
+
+    def test_stop_context_and_hook_suppression(self):
+        def select():
+            lldbinit.suppress_hook(True)
+            try:
+                stop = lldbinit.get_stop()
+                self.assertEqual(stop.frame.GetFrameID(), stop.key[3])
+            finally:
+                lldbinit.suppress_hook(False)
+
+        stop = self.hammer(select)
+        try:
+            for i in range(ROUNDS):
+                THREAD.frame = Frame(i % 3)
+                PROCESS.stop_id += 1
+        finally:
+            stop()
+        self.assertEqual(lldbinit.HookSuppressed, 0)
+
+    def test_concurrent_commands_keep_their_output(self):
+        lldbinit.WatchLogRanges.clear()
+        lldbinit.WatchLog.clear()
+        outputs = []
+
+        def command():
+            result = SBCommandReturnObject()
+            lldbinit.wlog(None, "bogus arguments here", result, {})
+            outputs.append(result.GetOutput())
+
+        stop = self.hammer(command)
+        try:
+            for i in range(ROUNDS):
+                result = SBCommandReturnObject()
+                lldbinit.wlog(None, "show", result, {})
+                self.assertEqual(result.GetOutput(), "0 of 0 logged accesses")
+        finally:
+            stop()
+        for output in outputs:
+            self.assertEqual(output, "wlog <expr> <len> [r|w|rw] | show [count] | off")
+
+
+if __name__ == "__main__":
+    unittest.main()